@@ -0,0 +1,542 @@
+"""
+Benchmarks of s3Fetch against a local S3 stand-in.
+
+A small fake S3 endpoint (ListObjectsV2, HeadBucket, HeadObject and ranged,
+If-Match checked GetObject) runs in a child process and serves synthetic
+buckets of a controlled shape:
+
+    bench-tiny  N tiny keys (1,000,000 by default) in 1000-key directories,
+                mostly .json with some .csv and .gz
+    bench-deep  keys under a deep prefix tree, for sharded listing
+    bench-huge  a few huge objects, generated on the fly
+
+Object contents are generated from a fixed block and the ETags are their
+real MD5 (multipart-style above 8 MiB), so every run sees the same bytes.
+The benchmarks go through the tool's own functions and client setup:
+listing (serial and sharded), filter latency over the key set, and small-
+and huge-object downloads. Results are printed as JSON, tagged with the
+commit, and two result files can be compared:
+
+    python3 benchmarks/bench_s3fetch.py --output before.json
+    python3 benchmarks/bench_s3fetch.py --output after.json --compare before.json
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import platform
+import re
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Contents of every object: this block, repeated.
+BLOCK_SIZE = 1024 * 1024
+# Part size of the multipart-style ETags of objects above it.
+ETAG_PART_SIZE = 8 * 1024 * 1024
+LAST_MODIFIED = 1704067200
+LIST_MAX_KEYS = 1000
+
+DEFAULT_TINY_KEYS = 1000000
+DEFAULT_DEEP_DEPTH = 6
+DEFAULT_DEEP_FANOUT = 4
+DEFAULT_HUGE_COUNT = 3
+DEFAULT_HUGE_MB = 256
+DEFAULT_SMALL_OBJECTS = 5000
+DEFAULT_REPEAT = 3
+
+# Filters timed over the bench-tiny key set, in the filter prompt syntax.
+FILTER_PATTERNS = (
+    'prefix:data/0042/',
+    'ext:csv',
+    'glob:*7.json',
+    r'^data/0[0-4]\d\d/\d{6}5\.json$',
+    '12345',
+)
+
+def build_block():
+    return b''.join(hashlib.sha256(i.to_bytes(4, 'big')).digest() for i in range(BLOCK_SIZE // 32))
+
+BLOCK = build_block()
+
+def iter_content(start, end):
+    """
+    Yields the bytes [start, end) of an object's contents.
+    """
+    block = memoryview(BLOCK)
+    position = start
+    while position < end:
+        offset = position % BLOCK_SIZE
+        count = min(BLOCK_SIZE - offset, end - position)
+        yield block[offset:offset + count]
+        position += count
+
+_etags = {}
+
+def etag_for(size):
+    """
+    Real ETag of an object of this size; contents only depend on the size.
+    """
+    etag = _etags.get(size)
+    if etag is None:
+        if size < ETAG_PART_SIZE:
+            digest = hashlib.md5()
+            for chunk in iter_content(0, size):
+                digest.update(chunk)
+            etag = f'"{digest.hexdigest()}"'
+        else:
+            parts = []
+            for start in range(0, size, ETAG_PART_SIZE):
+                digest = hashlib.md5()
+                for chunk in iter_content(start, min(size, start + ETAG_PART_SIZE)):
+                    digest.update(chunk)
+                parts.append(digest.digest())
+            etag = f'"{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}"'
+        _etags[size] = etag
+    return etag
+
+def tiny_key(i):
+    extension = '.csv' if i % 10 == 0 else '.gz' if i % 100 == 1 else '.json'
+    return f'data/{i // 1000:04d}/{i:07d}{extension}'
+
+def build_buckets(tiny_keys, deep_depth, deep_fanout, huge_count, huge_mb):
+    """
+    Returns {bucket: (sorted keys, sizes)} of the synthetic buckets.
+    """
+    buckets = {}
+    tiny = [(tiny_key(i), 64 + (i * 7919) % 960) for i in range(tiny_keys)]
+    deep = []
+    for leaf in range(deep_fanout ** deep_depth):
+        parts = []
+        for _ in range(deep_depth):
+            parts.append(f'd{leaf % deep_fanout}')
+            leaf //= deep_fanout
+        prefix = '/'.join(parts)
+        deep.extend((f'{prefix}/f{j}.txt', 512 + j) for j in range(2))
+    huge = [(f'huge/blob-{i}.bin', huge_mb * 1024 * 1024) for i in range(huge_count)]
+    for name, objects in (('bench-tiny', tiny), ('bench-deep', deep), ('bench-huge', huge)):
+        objects.sort()
+        buckets[name] = ([key for key, _ in objects], [size for _, size in objects])
+    return buckets
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """
+    Path-style S3 requests of the operations the tool uses.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    buckets = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self._send(status, body.encode(), [('Content-Type', 'application/xml')])
+
+    def _route(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return unquote(bucket), unquote(key), parse_qs(url.query, keep_blank_values=True)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._route()
+        if bucket not in self.buckets:
+            return self._error(404, 'NoSuchBucket')
+        keys, sizes = self.buckets[bucket]
+        if not key:
+            if self.command == 'HEAD':
+                return self._send(200, headers=[('x-amz-bucket-region', 'us-east-1')])
+            return self._list(bucket, keys, sizes, query)
+        position = bisect.bisect_left(keys, key)
+        if position == len(keys) or keys[position] != key:
+            return self._error(404, 'NoSuchKey')
+        self._object(sizes[position])
+
+    def _list(self, bucket, keys, sizes, query):
+        value = lambda name, default='': query.get(name, [default])[0]
+        prefix = value('prefix')
+        delimiter = value('delimiter')
+        max_keys = min(int(value('max-keys', LIST_MAX_KEYS)), LIST_MAX_KEYS)
+        token = value('continuation-token')
+        start_after = unquote(token) if token else value('start-after')
+        start = max(bisect.bisect_left(keys, prefix), bisect.bisect_right(keys, start_after))
+        if start_after and delimiter and start_after.endswith(delimiter):
+            # The token was a common prefix: skip everything under it.
+            start = bisect.bisect_left(keys, start_after[:-1] + chr(ord(delimiter[-1]) + 1), start)
+        encode = quote if value('encoding-type') == 'url' else escape
+        contents = []
+        common_prefixes = []
+        last = None
+        position = start
+        while position < len(keys) and len(contents) + len(common_prefixes) < max_keys:
+            key = keys[position]
+            if not key.startswith(prefix):
+                break
+            cut = key.find(delimiter, len(prefix)) if delimiter else -1
+            if cut >= 0:
+                common_prefix = key[:cut + len(delimiter)]
+                common_prefixes.append(f'<CommonPrefixes><Prefix>{encode(common_prefix)}</Prefix></CommonPrefixes>')
+                last = common_prefix
+                position = bisect.bisect_left(keys, common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1), position)
+                continue
+            contents.append(
+                f'<Contents><Key>{encode(key)}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified>'
+                f'<ETag>{escape(etag_for(sizes[position]))}</ETag><Size>{sizes[position]}</Size>'
+                f'<StorageClass>STANDARD</StorageClass></Contents>'
+            )
+            last = key
+            position += 1
+        truncated = position < len(keys) and keys[position].startswith(prefix)
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+            f'<Name>{bucket}</Name><Prefix>{encode(prefix)}</Prefix><MaxKeys>{max_keys}</MaxKeys>',
+            f'<KeyCount>{len(contents) + len(common_prefixes)}</KeyCount>',
+            f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>',
+        ]
+        if delimiter:
+            parts.append(f'<Delimiter>{encode(delimiter)}</Delimiter>')
+        if value('encoding-type'):
+            parts.append('<EncodingType>url</EncodingType>')
+        if truncated:
+            parts.append(f'<NextContinuationToken>{quote(last, safe="")}</NextContinuationToken>')
+        parts.extend(contents)
+        parts.extend(common_prefixes)
+        parts.append('</ListBucketResult>')
+        self._send(200, ''.join(parts).encode(), [('Content-Type', 'application/xml')])
+
+    def _object(self, size):
+        etag = etag_for(size)
+        if_match = self.headers.get('If-Match')
+        # S3 accepts the ETag with or without its quotes.
+        if if_match and if_match.strip('"') not in (etag.strip('"'), '*'):
+            return self._error(412, 'PreconditionFailed')
+        start, end = 0, size
+        status = 200
+        headers = [
+            ('ETag', etag),
+            ('Last-Modified', formatdate(LAST_MODIFIED, usegmt=True)),
+            ('Accept-Ranges', 'bytes'),
+            ('Content-Type', 'binary/octet-stream'),
+        ]
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            if start >= size:
+                return self._error(416, 'InvalidRange')
+            status = 206
+            headers.append(('Content-Range', f'bytes {start}-{end - 1}/{size}'))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for chunk in iter_content(start, end):
+            self.wfile.write(chunk)
+
+def serve(args):
+    """
+    Runs the fake endpoint and prints its port on the first line of stdout.
+    """
+    FakeS3Handler.buckets = build_buckets(
+        args.tiny_keys, args.deep_depth, args.deep_fanout, args.huge_count, args.huge_mb
+    )
+    for keys, sizes in FakeS3Handler.buckets.values():
+        for size in set(sizes):
+            etag_for(size)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeS3Handler)
+    server.daemon_threads = True
+    server.request_queue_size = 256
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+def start_server(args):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--serve',
+        '--tiny-keys', str(args.tiny_keys), '--deep-depth', str(args.deep_depth),
+        '--deep-fanout', str(args.deep_fanout), '--huge-count', str(args.huge_count),
+        '--huge-mb', str(args.huge_mb),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, f'http://127.0.0.1:{port}'
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, text=True
+        ).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+def timed(repeat, run, before=None):
+    """
+    Runs run() repeat times and returns (median seconds, last result).
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - started)
+    return statistics.median(seconds), result
+
+def create_tool_client(s3fetch, tool_argv):
+    """
+    Returns the parsed tool options, transfer settings and a client set up
+    the way the tool sets up its own.
+    """
+    args = s3fetch.parse_args(list(tool_argv))
+    settings = s3fetch.TransferSettings.from_args(args)
+    controller = s3fetch.create_throttle_controller(args, settings)
+    return args, settings, s3fetch.create_s3_client(settings, args.list_workers, controller)
+
+def bench_listing(s3fetch, s3, tool_argv, bucket, repeat, extra_argv=()):
+    args = s3fetch.parse_args(list(tool_argv) + list(extra_argv))
+    seconds, catalog = timed(repeat, lambda: s3fetch.list_bucket(s3, bucket, args, show_progress=False))
+    return {
+        'keys': len(catalog),
+        'seconds': round(seconds, 4),
+        'keys_per_second': round(len(catalog) / seconds, 1),
+    }, catalog
+
+def bench_filters(s3fetch, catalog, repeat):
+    """
+    Times each filter on a fresh key index (first_ms, which includes the
+    parts of the index the filter builds) and on a warm one (ms).
+    """
+    results = {}
+    for pattern in FILTER_PATTERNS:
+        key_index = s3fetch.KeyIndex(catalog)
+        started = time.perf_counter()
+        s3fetch.filter_positions(catalog, key_index, pattern)
+        first_seconds = time.perf_counter() - started
+        seconds, positions = timed(
+            repeat, lambda: s3fetch.filter_positions(catalog, key_index, pattern)
+        )
+        results[pattern] = {
+            'matches': len(positions),
+            'first_ms': round(first_seconds * 1000, 3),
+            'ms': round(seconds * 1000, 3),
+        }
+    return results
+
+def bench_download(s3fetch, tool_argv, bucket, keys, catalog, repeat):
+    args, settings, client = create_tool_client(s3fetch, tool_argv)
+    total_bytes = sum(catalog.size_of(key) for key in keys)
+    destination = tempfile.mkdtemp(prefix='s3fetch-bench-')
+    failures = []
+
+    def clean():
+        shutil.rmtree(destination, ignore_errors=True)
+        os.makedirs(destination)
+
+    def run():
+        # The fake objects' bytes and ETags depend only on their size, so
+        # deduplication would copy most of them instead of downloading them.
+        failures.extend(s3fetch.download_files(
+            client, bucket, keys, destination, catalog, settings, args.resume_threshold * 1024 * 1024,
+            dedup='off'
+        ))
+
+    try:
+        seconds, _ = timed(repeat, run, clean)
+    finally:
+        shutil.rmtree(destination, ignore_errors=True)
+    return {
+        'objects': len(keys),
+        'bytes': total_bytes,
+        'failures': len(failures),
+        'seconds': round(seconds, 4),
+        'objects_per_second': round(len(keys) / seconds, 1),
+        'bytes_per_second': round(total_bytes / seconds, 1),
+    }
+
+def run_benchmarks(args):
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+    })
+    os.environ.pop('AWS_PROFILE', None)
+    sys.path.insert(0, REPO_DIR)
+    import s3Fetch as s3fetch
+
+    log(f"Starting the fake S3 endpoint with {args.tiny_keys} tiny keys...")
+    process, endpoint = start_server(args)
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    tool_argv = shlex.split(args.s3fetch_args)
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'shape': {
+            'tiny_keys': args.tiny_keys,
+            'deep_depth': args.deep_depth,
+            'deep_fanout': args.deep_fanout,
+            'huge_count': args.huge_count,
+            'huge_mb': args.huge_mb,
+            'small_objects': args.small_objects,
+        },
+        's3fetch_args': args.s3fetch_args,
+        'repeat': args.repeat,
+        'results': {},
+    }
+    results = report['results']
+    try:
+        _, _, s3 = create_tool_client(s3fetch, tool_argv)
+        log("Listing bench-tiny serially...")
+        results['list_tiny_serial'], catalog = bench_listing(
+            s3fetch, s3, tool_argv, 'bench-tiny', args.repeat
+        )
+        log("Listing bench-tiny in shards...")
+        results['list_tiny_sharded'], _ = bench_listing(
+            s3fetch, s3, tool_argv, 'bench-tiny', args.repeat, ['--parallel-listing', '--shard-depth', '2']
+        )
+        log("Listing bench-deep in shards...")
+        results['list_deep_sharded'], _ = bench_listing(
+            s3fetch, s3, tool_argv, 'bench-deep', args.repeat, ['--parallel-listing', '--shard-depth', '3']
+        )
+        log("Timing filters...")
+        results['filter_tiny'] = bench_filters(s3fetch, catalog, args.repeat)
+        log(f"Downloading {args.small_objects} small objects...")
+        results['download_small'] = bench_download(
+            s3fetch, tool_argv, 'bench-tiny', catalog.keys[:args.small_objects], catalog, args.repeat
+        )
+        if args.huge_count:
+            log(f"Downloading {args.huge_count} objects of {args.huge_mb} MiB...")
+            huge_catalog = s3fetch.list_bucket(s3, 'bench-huge', s3fetch.parse_args(tool_argv), show_progress=False)
+            results['download_huge'] = bench_download(
+                s3fetch, tool_argv, 'bench-huge', list(huge_catalog.keys), huge_catalog, args.repeat
+            )
+    finally:
+        process.terminate()
+        process.wait()
+    return report
+
+def iter_metrics(results, path=()):
+    """
+    Yields (name, value) for every numeric result that is a rate or a
+    duration, the figures compared across runs.
+    """
+    for name, value in results.items():
+        if isinstance(value, dict):
+            yield from iter_metrics(value, path + (name,))
+        elif isinstance(value, (int, float)) and (name.endswith('_per_second') or name in ('seconds', 'ms')
+                                                  or name.endswith('_ms')):
+            yield '.'.join(path + (name,)), value
+
+def compare(baseline, current):
+    """
+    Prints each compared figure of both runs and the change; rates are
+    better when higher, durations when lower.
+    """
+    old = dict(iter_metrics(baseline['results']))
+    rows = []
+    for name, value in iter_metrics(current['results']):
+        if name not in old or not old[name]:
+            continue
+        change = (value - old[name]) / old[name] * 100
+        better = change > 0 if name.endswith('_per_second') else change < 0
+        rows.append((name, old[name], value, change, better))
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"{'metric':<{width}}  {'baseline':>14}  {'current':>14}  change", file=sys.stderr)
+    for name, old_value, value, change, better in rows:
+        mark = '' if abs(change) < 5 else ' better' if better else ' worse'
+        print(f"{name:<{width}}  {old_value:>14}  {value:>14}  {change:+.1f}%{mark}", file=sys.stderr)
+    print(
+        f"baseline {baseline.get('commit') or '?'} vs current {current.get('commit') or '?'}"
+        f"{' (uncommitted changes)' if current.get('dirty') else ''}",
+        file=sys.stderr
+    )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark s3Fetch against a local fake S3 endpoint.')
+    parser.add_argument('--tiny-keys', type=int, default=DEFAULT_TINY_KEYS,
+                        help='keys in bench-tiny (default: %(default)s)')
+    parser.add_argument('--deep-depth', type=int, default=DEFAULT_DEEP_DEPTH,
+                        help='prefix levels of bench-deep (default: %(default)s)')
+    parser.add_argument('--deep-fanout', type=int, default=DEFAULT_DEEP_FANOUT,
+                        help='sub-prefixes per level of bench-deep (default: %(default)s)')
+    parser.add_argument('--huge-count', type=int, default=DEFAULT_HUGE_COUNT,
+                        help='objects in bench-huge (default: %(default)s)')
+    parser.add_argument('--huge-mb', type=int, default=DEFAULT_HUGE_MB,
+                        help='size of the bench-huge objects in MiB (default: %(default)s)')
+    parser.add_argument('--small-objects', type=int, default=DEFAULT_SMALL_OBJECTS,
+                        help='bench-tiny objects downloaded (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='runs of each benchmark; the median is reported (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true',
+                        help='a tenth of the keys and objects, one run each')
+    parser.add_argument('--s3fetch-args', default='',
+                        help="s3Fetch options used by the benchmarks, e.g. '-w 32 --max-concurrency 4'")
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare the results with an earlier results file')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.tiny_keys //= 10
+        args.small_objects //= 10
+        args.huge_mb //= 4
+        args.repeat = 1
+    return args
+
+def main():
+    args = parse_args()
+    if args.serve:
+        serve(args)
+        return
+    report = run_benchmarks(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(json.load(baseline_file), report)
+
+if __name__ == '__main__':
+    main()
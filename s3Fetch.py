@@ -1,137 +1,3709 @@
+import time
+# Reference point of the startup budget checked by --startup-check.
+STARTED_AT = time.perf_counter()
+
 import sys
 import os
 import re
+import argparse
+import atexit
+import base64
+import bisect
+import collections
+import contextlib
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import json
+import random
+import sqlite3
 import threading
-from collections import Counter
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import site
+site_user_site = site.getusersitepackages()
+if site_user_site not in sys.path:
+    sys.path.append(site_user_site)
+
+package_to_module = {
+    'boto3': 'boto3',
+    'questionary': 'questionary',
+    'colorama': 'colorama',
+    'tqdm': 'tqdm',
+    'rich': 'rich',
+    'alive-progress': 'alive_progress',
+    'prompt_toolkit': 'prompt_toolkit',
+}
+
+def check_and_install_dependencies():
+    import subprocess
+    missing_packages = []
+    # find_spec locates the packages without importing them; the heavy ones
+    # are only imported when first used.
+    for package_name, module_name in package_to_module.items():
+        if importlib.util.find_spec(module_name) is None:
+            missing_packages.append(package_name)
+    if missing_packages:
+        print("The following packages are required to run the script:")
+        for pkg in missing_packages:
+            print(f"- {pkg}")
+        install = input("Do you want to install the missing dependencies? [y/N]: ").strip().lower()
+        if install == 'y':
+            in_virtualenv = (
+                hasattr(sys, 'real_prefix') or
+                (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)
+            )
+            for pkg in missing_packages:
+                print(f"Installing {pkg}...")
+                try:
+                    if in_virtualenv:
+                        subprocess.check_call([sys.executable, "-m", "pip", "install", pkg])
+                    else:
+                        subprocess.check_call([sys.executable, "-m", "pip", "install", pkg, "--user"])
+                except subprocess.CalledProcessError as e:
+                    print(f"Error installing {pkg}: {e}")
+                    print("Could not install the dependency. The script cannot continue.")
+                    sys.exit(1)
+            for pkg in missing_packages:
+                module_name = package_to_module[pkg]
+                try:
+                    globals()[module_name] = __import__(module_name)
+                except ImportError as e:
+                    print(f"Error importing {module_name} after installation: {e}")
+                    print("The script cannot continue.")
+                    sys.exit(1)
+            print("Dependencies installed successfully. Continuing with the script...")
+        else:
+            print("Dependencies not installed. The script cannot continue.")
+            sys.exit(1)
+
+check_and_install_dependencies()
+
+import colorama
+from colorama import init
+from rich.console import Console
+from rich.table import Table
+from rich import box
+
+import configparser
+from botocore.exceptions import (
+    BotoCoreError, ClientError, ConnectionError as BotocoreConnectionError, FlexibleChecksumError, HTTPClientError
+)
+
+class LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+# boto3, questionary, prompt_toolkit, tqdm and alive_progress take most of the
+# startup time, so they are imported when first used: '-h' and batch runs
+# never load the prompt libraries, and boto3 is preloaded in the background
+# while the first prompt is shown.
+boto3 = LazyModule('boto3')
+boto3_transfer = LazyModule('boto3.s3.transfer')
+botocore_config = LazyModule('botocore.config')
+questionary = LazyModule('questionary')
+prompt_toolkit_history = LazyModule('prompt_toolkit.history')
+tqdm = LazyModule('tqdm')
+alive_progress = LazyModule('alive_progress')
+
+init(autoreset=True)
+console = Console()
+
+custom_style = None
+
+def prompt_style():
+    """
+    Returns the questionary style, built on first use.
+    """
+    global custom_style
+    if custom_style is None:
+        from prompt_toolkit.styles import Style
+        custom_style = Style([
+            ('qmark', 'fg:#E91E63 bold'),
+            ('answer', 'fg:#2196f3 bold'),
+            ('instruction', ''),
+            ('pointer', 'fg:#673ab7 bold'),
+            ('highlighted', 'fg:#03a9f4 bold'),
+            ('selected', 'fg:#f44336 bold'),
+            ('separator', 'fg:#cc5454'),
+            ('text', ''),
+        ])
+    return custom_style
+
+def preload_modules(*names):
+    """
+    Imports modules in a background thread so they are ready when needed.
+    """
+    thread = threading.Thread(
+        target=lambda: [importlib.import_module(name) for name in names], daemon=True
+    )
+    thread.start()
+    return thread
+
+# Number of files downloaded at the same time.
+DEFAULT_DOWNLOAD_WORKERS = 10
+# Number of shards listed at the same time in parallel listing mode.
+DEFAULT_LIST_WORKERS = 16
+# Fields of an S3 Inventory CSV schema and the matching ORC and Parquet
+# columns; the other fields an inventory may have are not used.
+INVENTORY_FIELDS = {
+    'Key': 'key', 'Size': 'size', 'LastModifiedDate': 'last_modified_date', 'ETag': 'e_tag',
+    'StorageClass': 'storage_class', 'IsLatest': 'is_latest', 'IsDeleteMarker': 'is_delete_marker',
+}
+# Dated folders of an inventory configuration, each holding a manifest.json.
+INVENTORY_DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$')
+# Seconds a cached listing is used as is before it is refreshed.
+DEFAULT_CACHE_TTL = 3600
+# Number of bucket listings kept in the on-disk cache.
+DEFAULT_CACHE_MAX_LISTINGS = 20
+# Objects per compressed chunk in the listing cache.
+CACHE_CHUNK_SIZE = 1000000
+# Threads s3transfer uses for the parts of a single file (its own default).
+TRANSFER_MAX_CONCURRENCY = 10
+# s3transfer's default multipart threshold and part size, in MiB. Objects
+# below the threshold are fetched with a single get_object into their file.
+DEFAULT_MULTIPART_THRESHOLD_MB = 8
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 8
+# botocore's default connect and read timeouts, in seconds.
+DEFAULT_CONNECT_TIMEOUT = 60
+DEFAULT_READ_TIMEOUT = 60
+# Requests in flight tried by --auto-tune, the bytes each probe request
+# reads, and the throughput gain needed to try the next level.
+AUTO_TUNE_LEVELS = (8, 16, 32, 64, 128, 256)
+AUTO_TUNE_PROBE_BYTES = 256 * 1024
+AUTO_TUNE_MIN_GAIN = 1.15
+# Limits of the --auto-tune throughput probe: bytes read in all, seconds,
+# and the share of the selected bytes it may read (1 in N); a selection too
+# small for the first level is not probed.
+AUTO_TUNE_PROBE_MAX_BYTES = 64 * 1024 * 1024
+AUTO_TUNE_PROBE_SECONDS = 5
+AUTO_TUNE_PROBE_SHARE = 10
+# Largest part size --auto-tune picks for multipart downloads.
+AUTO_TUNE_MAX_CHUNKSIZE = 128 * 1024 * 1024
+# Size of the per-thread buffer small objects are read into.
+SMALL_OBJECT_BUFFER_SIZE = 256 * 1024
+# Suffix of the temporary file a small object is written to before it is
+# renamed over its local path.
+SMALL_OBJECT_SUFFIX = '.s3fetch-tmp'
+# Objects of at least this many MiB are downloaded in resumable byte ranges.
+DEFAULT_RESUME_THRESHOLD_MB = 64
+# Size of the byte ranges of a resumable download.
+RESUME_PART_SIZE = 8 * 1024 * 1024
+# Attempts per S3 request (first try included) when the throttle controller
+# handles retries.
+DEFAULT_MAX_ATTEMPTS = 8
+# Full-jitter backoff of retried requests: base delay and cap, in seconds.
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 20
+# A prefix's concurrency limit is cut at most once per this many seconds,
+# so one burst of errors does not collapse it.
+THROTTLE_DECREASE_INTERVAL = 0.5
+# Responses slower than this many times the fastest one seen for a prefix
+# (and slower than THROTTLE_SLOW_RESPONSE seconds) count as congestion.
+THROTTLE_LATENCY_FACTOR = 4
+THROTTLE_SLOW_RESPONSE = 1.0
+# Error codes S3 returns when it throttles a prefix.
+THROTTLE_ERROR_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'ProvisionedThroughputExceededException',
+}
+# Error codes of transient failures that are worth retrying.
+TRANSIENT_ERROR_CODES = {'RequestTimeout', 'InternalError', 'ServiceUnavailable'}
+# S3 clients kept per region across bucket switches, and buckets whose
+# region is remembered; the least recently used are evicted.
+DEFAULT_MAX_REGION_CLIENTS = 4
+DEFAULT_MAX_BUCKET_REGIONS = 256
+# Seconds between two redraws of the download progress bar.
+PROGRESS_REFRESH_INTERVAL = 0.25
+# Downloads of at least this size are listed next to the progress bar while
+# they run, up to PROGRESS_ACTIVE_FILES of them.
+PROGRESS_LARGE_FILE_SIZE = 64 * 1024 * 1024
+PROGRESS_ACTIVE_FILES = 3
+# Seconds a verified AWS identity is reused for unchanged credentials.
+DEFAULT_IDENTITY_TTL = 900
+# Seconds from the start of the script to the first prompt checked by
+# --startup-check.
+DEFAULT_STARTUP_BUDGET = 0.5
+# Environment variables that select or hold AWS credentials; they are part
+# of the credential fingerprint of the identity cache.
+CREDENTIAL_ENV_VARS = (
+    'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE',
+    'AWS_DEFAULT_PROFILE', 'AWS_SHARED_CREDENTIALS_FILE', 'AWS_CONFIG_FILE', 'AWS_ROLE_ARN',
+    'AWS_WEB_IDENTITY_TOKEN_FILE', 'AWS_CONTAINER_CREDENTIALS_RELATIVE_URI',
+    'AWS_CONTAINER_CREDENTIALS_FULL_URI', 'AWS_ENDPOINT_URL', 'AWS_ENDPOINT_URL_STS',
+)
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Phases timed by SessionMetrics; each of them can be profiled with --profile.
+METRICS_PHASES = ('identity', 'listing', 'filter', 'sync', 'download')
+# Downloads whose bytes do not match the object's ETag or checksum are
+# retried this many times in all with --verify.
+VERIFY_ATTEMPTS = 3
+# Bytes that arrive ahead of the hashing cursor of an object and are kept in
+# memory; beyond that only their offsets are kept and they are read back
+# from the file when the cursor reaches them.
+VERIFY_BUFFER_BYTES = 64 * 1024 * 1024
+# S3 additional checksums, in the order they are looked for in responses.
+CHECKSUM_ALGORITHMS = ('CRC64NVME', 'CRC32C', 'CRC32', 'SHA256', 'SHA1')
+# File the verification results are written to in the download directory.
+VERIFY_MANIFEST_NAME = '.s3fetch-verify.json'
+# How selected keys with the same ETag and size are created locally from the
+# one copy downloaded: auto tries a reflink and falls back to a copy.
+DEDUP_MODES = ('auto', 'reflink', 'hardlink', 'copy', 'off')
+DEFAULT_DEDUP_MODE = 'auto'
+# Linux ioctl cloning the extents of a file (Btrfs, XFS, bcachefs...).
+FICLONE = 0x40049409
+# Suffix of the temporary file a duplicate is created in before the rename.
+DUPLICATE_SUFFIX = '.s3fetch-copy'
+# tarfile stream modes of the archive formats of --archive; zip is written
+# with zipfile, which streams to unseekable outputs too.
+ARCHIVE_FORMATS = {'tar': 'w|', 'tar.gz': 'w|gz', 'tar.bz2': 'w|bz2', 'tar.xz': 'w|xz', 'zip': None}
+ARCHIVE_EXTENSIONS = (
+    ('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar.bz2', 'tar.bz2'), ('.tbz2', 'tar.bz2'),
+    ('.tar.xz', 'tar.xz'), ('.txz', 'tar.xz'), ('.zip', 'zip'), ('.tar', 'tar'),
+)
+# Bytes of small objects fetched ahead of the archive writer.
+ARCHIVE_BUFFER_BYTES = 64 * 1024 * 1024
+# Write buffer of the archive file, so it is written in large sequential
+# blocks.
+ARCHIVE_WRITE_BUFFER = 1024 * 1024
+# Suffix of the partial file of a resumable download; its manifest of
+# completed byte ranges is kept next to it with '.json' appended.
+PARTIAL_SUFFIX = '.s3fetch-part'
+
+def clear_screen():
+    # Clears with escape sequences instead of starting a 'clear' process.
+    console.clear()
+
+def format_size(num_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(num_bytes) < 1024 or unit == 'TiB':
+            break
+        num_bytes /= 1024
+    return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+
+class ObjectCatalog:
+    """
+    Compact store of the objects returned by a bucket listing.
+
+    Metadata is kept in parallel arrays indexed by position instead of one
+    dict per object. Keys stay in S3 listing order, so a key is found with a
+    binary search. Rows are only ever appended and the key column is written
+    last, so readers in other threads never see a key without its metadata.
+    """
+    __slots__ = (
+        'keys', 'sizes', 'etags', 'last_modified', 'storage_classes',
+        'storage_class_names', '_storage_class_ids', '_sorted'
+    )
+
+    def __init__(self):
+        self.keys = []
+        self.sizes = array('q')
+        self.etags = []
+        self.last_modified = array('d')
+        self.storage_classes = array('B')
+        self.storage_class_names = []
+        self._storage_class_ids = {}
+        self._sorted = True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def add(self, key, size, etag, last_modified, storage_class):
+        if self._sorted and self.keys and key < self.keys[-1]:
+            self._sorted = False
+        class_id = self._storage_class_id(storage_class)
+        self.sizes.append(size)
+        self.etags.append(etag.strip('"'))
+        self.last_modified.append(last_modified)
+        self.storage_classes.append(class_id)
+        self.keys.append(key)
+
+    def add_listing_page(self, page):
+        """
+        Adds the objects of one list_objects_v2 page, skipping folder markers.
+        """
+        for obj in page.get('Contents', ()):
+            key = obj['Key']
+            if key.endswith('/'):
+                continue
+            last_modified = obj.get('LastModified')
+            self.add(
+                key,
+                obj.get('Size', 0),
+                obj.get('ETag', ''),
+                last_modified.timestamp() if last_modified else 0.0,
+                obj.get('StorageClass', 'STANDARD')
+            )
+
+    def _storage_class_id(self, storage_class):
+        class_id = self._storage_class_ids.get(storage_class)
+        if class_id is None:
+            class_id = len(self.storage_class_names)
+            self.storage_class_names.append(storage_class)
+            self._storage_class_ids[storage_class] = class_id
+        return class_id
+
+    def extend(self, other, start=0, end=None):
+        """
+        Appends the rows start:end of another catalog, column by column.
+        """
+        end = len(other) if end is None else end
+        if start >= end:
+            return
+        if self._sorted and (not other._sorted or (self.keys and other.keys[start] < self.keys[-1])):
+            self._sorted = False
+        self.sizes.extend(other.sizes[start:end])
+        self.etags.extend(other.etags[start:end])
+        self.last_modified.extend(other.last_modified[start:end])
+        mapping = [self._storage_class_id(name) for name in other.storage_class_names]
+        if mapping == list(range(len(mapping))):
+            self.storage_classes.extend(other.storage_classes[start:end])
+        else:
+            self.storage_classes.extend(mapping[c] for c in other.storage_classes[start:end])
+        self.keys.extend(other.keys[start:end])
+
+    def slice(self, start, end):
+        part = ObjectCatalog()
+        part.extend(self, start, end)
+        return part
+
+    def row(self, position):
+        return (
+            self.keys[position], self.sizes[position], self.etags[position],
+            self.last_modified[position], self.storage_class_of(position)
+        )
+
+    def copy(self):
+        duplicate = ObjectCatalog()
+        duplicate.extend(self)
+        return duplicate
+
+    def sort(self):
+        if self._sorted:
+            return
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.keys = [self.keys[i] for i in order]
+        self.sizes = array('q', (self.sizes[i] for i in order))
+        self.etags = [self.etags[i] for i in order]
+        self.last_modified = array('d', (self.last_modified[i] for i in order))
+        self.storage_classes = array('B', (self.storage_classes[i] for i in order))
+        self._sorted = True
+
+    def index(self, key):
+        self.sort()
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return position
+        return -1
+
+    def size_of(self, key):
+        position = self.index(key)
+        return self.sizes[position] if position >= 0 else 0
+
+    def storage_class_of(self, position):
+        return self.storage_class_names[self.storage_classes[position]]
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def extension_stats(self, stats=None):
+        """
+        Returns {extension: [count, total bytes]} for every key that has one.
+        When stats is given, the counts are added to it.
+        """
+        stats = {} if stats is None else stats
+        sizes = self.sizes
+        for position, key in enumerate(self.keys):
+            ext = os.path.splitext(key)[1].lower()
+            if not ext:
+                continue
+            entry = stats.get(ext)
+            if entry is None:
+                stats[ext] = [1, sizes[position]]
+            else:
+                entry[0] += 1
+                entry[1] += sizes[position]
+        return stats
+
+def diff_catalogs(old, new):
+    """
+    Compares two sorted catalogs in a single merge pass. Returns the rows of
+    new that were added or changed and the keys of old that were removed.
+    """
+    old.sort()
+    new.sort()
+    changed_rows = []
+    removed_keys = []
+    old_position = new_position = 0
+    old_count, new_count = len(old), len(new)
+    while old_position < old_count or new_position < new_count:
+        old_key = old.keys[old_position] if old_position < old_count else None
+        new_key = new.keys[new_position] if new_position < new_count else None
+        if new_key is None or (old_key is not None and old_key < new_key):
+            removed_keys.append(old_key)
+            old_position += 1
+        elif old_key is None or new_key < old_key:
+            changed_rows.append(new.row(new_position))
+            new_position += 1
+        else:
+            new_row = new.row(new_position)
+            if new_row != old.row(old_position):
+                changed_rows.append(new_row)
+            old_position += 1
+            new_position += 1
+    return changed_rows, removed_keys
+
+def describe_listing_changes(old, new):
+    changed_rows, removed_keys = diff_catalogs(old, new)
+    return (
+        f"{len(new)} files, {len(changed_rows)} new or changed, "
+        f"{len(removed_keys)} removed"
+    )
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]()|\\')
+# Separates keys in the search text of a KeyIndex; S3 keys never contain it.
+KEY_SEPARATOR = '\0'
+
+class KeyIndex:
+    """
+    In-memory indexes over a complete, sorted catalog, built once per
+    listing. Prefix ranges come from binary searches on the sorted keys; the
+    extension index maps every extension to a sorted array of positions; and
+    literal text is found with str.find over all keys joined into one string,
+    mapping each hit back to its key through an array of key offsets. The
+    extension index and the search text are built on first use.
+    """
+    def __init__(self, catalog):
+        catalog.sort()
+        self.catalog = catalog
+        self.size = len(catalog)
+        self._extensions = None
+        self._text = None
+        self._offsets = None
+
+    def prefix_range(self, prefix):
+        keys = self.catalog.keys
+        low = bisect.bisect_left(keys, prefix, 0, self.size)
+        if not prefix:
+            return low, self.size
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return low, bisect.bisect_left(keys, upper_bound, low, self.size)
+
+    def extension_positions(self, ext, ignore_case=False):
+        if self._extensions is None:
+            keys = self.catalog.keys[:self.size]
+            key_extensions = [
+                '.' + tail if dot and '/' not in tail else ''
+                for _, dot, tail in map(str.rpartition, keys, itertools.repeat('.', len(keys)))
+            ]
+            extensions = {key_ext: array('I') for key_ext in set(key_extensions)}
+            for position, key_ext in enumerate(key_extensions):
+                extensions[key_ext].append(position)
+            self._extensions = extensions
+        if not ignore_case:
+            return self._extensions.get(ext, array('I'))
+        variants = [
+            positions for variant, positions in self._extensions.items() if variant.lower() == ext.lower()
+        ]
+        if len(variants) == 1:
+            return variants[0]
+        return array('I', sorted(position for positions in variants for position in positions))
+
+    def literal_positions(self, literal):
+        if self._text is None:
+            keys = self.catalog.keys[:self.size]
+            self._text = KEY_SEPARATOR.join(keys)
+            self._offsets = array('q', [0])
+            self._offsets.extend(itertools.accumulate(len(key) + 1 for key in keys))
+        text, offsets = self._text, self._offsets
+        positions = array('I')
+        start = 0
+        while True:
+            hit = text.find(literal, start)
+            if hit < 0:
+                return positions
+            position = bisect.bisect_right(offsets, hit) - 1
+            positions.append(position)
+            # Continue with the next key; one hit per key is enough.
+            start = offsets[position + 1]
+
+def regex_literal_prefix(pattern):
+    """
+    Returns (prefix, exact) for a regex anchored with '^': the literal text
+    every match starts with, and whether the pattern matches exactly the keys
+    with that prefix ('^prefix' or '^prefix.*'). Unanchored patterns and
+    alternations have no usable prefix.
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return '', False
+    prefix = []
+    position = 1
+    while position < len(pattern):
+        char = pattern[position]
+        if char == '\\':
+            if position + 1 >= len(pattern) or pattern[position + 1].isalnum():
+                break
+            prefix.append(pattern[position + 1])
+            position += 2
+        elif char in REGEX_METACHARACTERS:
+            break
+        else:
+            prefix.append(char)
+            position += 1
+    rest = pattern[position:]
+    if rest[:1] in ('*', '?', '{'):
+        # The quantifier makes the last literal character optional.
+        return ''.join(prefix[:-1]), False
+    return ''.join(prefix), rest in ('', '.*')
+
+def regex_extension(pattern):
+    r"""
+    Returns (extension, exact) when the regex only matches keys ending in a
+    literal extension, and whether it matches exactly those keys
+    ('\.gz$', '.*\.gz$' or '^.*\.gz$').
+    """
+    match = re.search(r'(\\+)\.([0-9A-Za-z]+)\$$', pattern)
+    # An even number of backslashes escapes a backslash, not the dot.
+    if not match or len(match.group(1)) % 2 == 0 or '|' in pattern:
+        return None, False
+    head = pattern[:match.start()] + match.group(1)[:-1]
+    return '.' + match.group(2), head in ('', '.*', '^.*')
+
+def glob_to_regex(glob):
+    parts = ['^']
+    for char in glob:
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    parts.append('$')
+    return ''.join(parts)
+
+def filter_to_regex(pattern):
+    """
+    Translates a 'prefix:', 'ext:' or 'glob:' filter into the equivalent
+    regex. Returns (regex, ignore_case); plain regexes are returned as is.
+    """
+    if pattern.startswith('prefix:'):
+        return '^' + re.escape(pattern[len('prefix:'):]), False
+    if pattern.startswith('ext:'):
+        ext = pattern[len('ext:'):].strip()
+        return '.*' + re.escape(ext if ext.startswith('.') else '.' + ext) + '$', True
+    if pattern.startswith('glob:'):
+        return glob_to_regex(pattern[len('glob:'):]), False
+    return pattern, False
+
+def listing_prefix(prefix='', pattern=None):
+    """
+    Returns the prefix to send with list_objects_v2: the literal text every
+    key matching the pattern starts with, when it extends the explicit
+    prefix, or the explicit prefix otherwise.
+    """
+    if not pattern:
+        return prefix
+    regex, ignore_case = filter_to_regex(pattern)
+    pattern_prefix = '' if ignore_case else regex_literal_prefix(regex)[0]
+    if pattern_prefix.startswith(prefix):
+        return pattern_prefix
+    return prefix
+
+def parse_bucket_entry(entry):
+    """
+    Splits 'bucket', 'bucket/prefix' or 's3://bucket/prefix' into
+    (bucket, prefix).
+    """
+    entry = entry.strip()
+    if entry.startswith('s3://'):
+        entry = entry[len('s3://'):]
+    bucket_name, _, prefix = entry.partition('/')
+    return bucket_name, prefix
+
+def intersect_positions(positions, other):
+    """
+    Intersects two sorted position sequences by binary searching the
+    larger one for every element of the smaller one.
+    """
+    if len(positions) > len(other):
+        positions, other = other, positions
+    result = array('I')
+    low = 0
+    for position in positions:
+        low = bisect.bisect_left(other, position, low)
+        if low == len(other):
+            break
+        if other[low] == position:
+            result.append(position)
+    return result
+
+def filter_positions(catalog, key_index, pattern, positions=None):
+    """
+    Returns the sorted catalog positions of the keys matching a filter,
+    taken from positions (the current result set) or from the whole catalog.
+
+    Besides regular expressions, 'prefix:', 'ext:' (case-insensitive) and
+    'glob:' filters are accepted. Prefixes, extensions and literal text are
+    answered from the key index, and the regex only runs over the candidates
+    the index leaves; patterns with inline (?i), (?m) or (?s) flags always
+    go through the regex. Without an index (while the listing is still
+    running) every key in the current set is scanned.
+    """
+    keys = catalog.keys
+    if positions is None:
+        positions = range(key_index.size if key_index is not None else len(catalog))
+    pattern, ignore_case = filter_to_regex(pattern)
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+    if key_index is None:
+        return array('I', (position for position in positions if regex.search(keys[position])))
+
+    candidates = None
+    prefix, exact = regex_literal_prefix(pattern)
+    ext, ext_exact = regex_extension(pattern)
+    if re.compile(pattern).flags & (re.IGNORECASE | re.MULTILINE | re.DOTALL):
+        # Inline flags such as (?i) change what the literal text matches,
+        # which the case-sensitive, single-line index shortcuts can not tell.
+        pass
+    elif prefix:
+        low, high = key_index.prefix_range(prefix)
+        candidates = range(low, high)
+    elif ext:
+        candidates = key_index.extension_positions(ext, ignore_case)
+        exact = ext_exact
+    elif pattern and not any(char in REGEX_METACHARACTERS for char in pattern):
+        candidates = key_index.literal_positions(pattern)
+        exact = True
+    if candidates is None:
+        candidates = positions
+        exact = False
+    elif isinstance(positions, range) and isinstance(candidates, range):
+        candidates = range(max(positions.start, candidates.start), min(positions.stop, candidates.stop))
+    elif not (isinstance(positions, range) and positions.start == 0 and positions.stop >= key_index.size):
+        candidates = intersect_positions(candidates, positions)
+    if exact:
+        return array('I', candidates)
+    return array('I', (position for position in candidates if regex.search(keys[position])))
+
+def filter_chain_positions(catalog, key_index, patterns, positions=None):
+    """
+    Applies filters one after the other, each narrowing the result of the
+    previous one, as they were entered.
+    """
+    for pattern in patterns:
+        positions = filter_positions(catalog, key_index, pattern, positions)
+    return positions
+
+class ListingCache:
+    """
+    On-disk cache of bucket listings, stored in SQLite and keyed by account,
+    bucket and prefix. Listings older than the TTL are refreshed, and only the
+    least recently used max_listings listings are kept.
+
+    Each listing is saved column by column in compressed chunks rather than
+    one row per object, so a multi-million key listing loads in seconds.
+    """
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL, max_listings=DEFAULT_CACHE_MAX_LISTINGS):
+        self.path = path
+        self.ttl = ttl
+        self.max_listings = max_listings
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS listings ('
+                'id INTEGER PRIMARY KEY, account TEXT NOT NULL, bucket TEXT NOT NULL, '
+                'prefix TEXT NOT NULL, listed_at REAL NOT NULL, last_used REAL NOT NULL, '
+                'object_count INTEGER NOT NULL, UNIQUE (account, bucket, prefix))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS listing_chunks ('
+                'listing_id INTEGER NOT NULL, chunk INTEGER NOT NULL, keys BLOB NOT NULL, '
+                'sizes BLOB NOT NULL, etags BLOB NOT NULL, last_modified BLOB NOT NULL, '
+                'storage_classes BLOB NOT NULL, storage_class_names TEXT NOT NULL, '
+                'PRIMARY KEY (listing_id, chunk))'
+            )
+
+    def _connect(self):
+        # A short-lived connection per call keeps the cache usable from the
+        # background refresh thread.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def is_stale(self, listed_at):
+        return time.time() - listed_at > self.ttl
+
+    @staticmethod
+    def _encode_chunk(catalog, start, end):
+        return (
+            zlib.compress('\0'.join(catalog.keys[start:end]).encode('utf-8'), 1),
+            catalog.sizes[start:end].tobytes(),
+            zlib.compress('\0'.join(catalog.etags[start:end]).encode('utf-8'), 1),
+            catalog.last_modified[start:end].tobytes(),
+            catalog.storage_classes[start:end].tobytes(),
+            '\0'.join(catalog.storage_class_names),
+        )
+
+    @staticmethod
+    def _decode_chunk(keys, sizes, etags, last_modified, storage_classes, storage_class_names):
+        chunk = ObjectCatalog()
+        chunk.keys = zlib.decompress(keys).decode('utf-8').split('\0')
+        chunk.sizes.frombytes(sizes)
+        chunk.etags = zlib.decompress(etags).decode('utf-8').split('\0')
+        chunk.last_modified.frombytes(last_modified)
+        chunk.storage_classes.frombytes(storage_classes)
+        for name in storage_class_names.split('\0'):
+            chunk._storage_class_id(name)
+        return chunk
+
+    def load(self, account, bucket_name, prefix=''):
+        """
+        Returns (catalog, listed_at) for a cached listing, or None. When the
+        prefix itself is not cached, the keys under it are taken from the
+        cached listing of the longest enclosing prefix, if any.
+        """
+        with self._connect() as conn:
+            listing = conn.execute(
+                'SELECT id, listed_at, prefix FROM listings WHERE account = ? AND bucket = ? '
+                'AND substr(?, 1, length(prefix)) = prefix ORDER BY length(prefix) DESC LIMIT 1',
+                (account, bucket_name, prefix)
+            ).fetchone()
+            if listing is None:
+                return None
+            listing_id, listed_at, cached_prefix = listing
+            conn.execute('UPDATE listings SET last_used = ? WHERE id = ?', (time.time(), listing_id))
+            chunks = conn.execute(
+                'SELECT keys, sizes, etags, last_modified, storage_classes, storage_class_names '
+                'FROM listing_chunks WHERE listing_id = ? ORDER BY chunk',
+                (listing_id,)
+            ).fetchall()
+        catalog = ObjectCatalog()
+        for chunk in chunks:
+            catalog.extend(self._decode_chunk(*chunk))
+        if cached_prefix != prefix:
+            catalog = catalog.slice(*KeyIndex(catalog).prefix_range(prefix))
+        return catalog, listed_at
+
+    def store(self, account, bucket_name, prefix, catalog):
+        now = time.time()
+        with self._connect() as conn:
+            listing = conn.execute(
+                'SELECT id FROM listings WHERE account = ? AND bucket = ? AND prefix = ?',
+                (account, bucket_name, prefix)
+            ).fetchone()
+            if listing is None:
+                listing_id = conn.execute(
+                    'INSERT INTO listings (account, bucket, prefix, listed_at, last_used, object_count) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (account, bucket_name, prefix, now, now, len(catalog))
+                ).lastrowid
+            else:
+                listing_id = listing[0]
+                conn.execute(
+                    'UPDATE listings SET listed_at = ?, last_used = ?, object_count = ? WHERE id = ?',
+                    (now, now, len(catalog), listing_id)
+                )
+                conn.execute('DELETE FROM listing_chunks WHERE listing_id = ?', (listing_id,))
+            for chunk, start in enumerate(range(0, len(catalog), CACHE_CHUNK_SIZE)):
+                conn.execute(
+                    'INSERT INTO listing_chunks (listing_id, chunk, keys, sizes, etags, last_modified, '
+                    'storage_classes, storage_class_names) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (listing_id, chunk) + self._encode_chunk(catalog, start, start + CACHE_CHUNK_SIZE)
+                )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        evicted = [
+            row[0] for row in conn.execute(
+                'SELECT id FROM listings ORDER BY last_used DESC LIMIT -1 OFFSET ?', (self.max_listings,)
+            )
+        ]
+        for listing_id in evicted:
+            conn.execute('DELETE FROM listing_chunks WHERE listing_id = ?', (listing_id,))
+            conn.execute('DELETE FROM listings WHERE id = ?', (listing_id,))
+
+class SyncState:
+    """
+    Records, per local file, the object version it was last synced from
+    (bucket, key, ETag, size) and the file's size and mtime at that point,
+    so unchanged files are recognised without contacting S3 again.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS synced_files ('
+                'local_path TEXT PRIMARY KEY, bucket TEXT NOT NULL, key TEXT NOT NULL, '
+                'etag TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, download_dir):
+        """
+        Returns {local_path: (bucket, key, etag, size, mtime_ns)} for every
+        file recorded under download_dir, read in a single range query.
+        """
+        low = os.path.join(download_dir, '')
+        high = low[:-1] + chr(ord(low[-1]) + 1)
+        with self._connect() as conn:
+            return {
+                row[0]: row[1:] for row in conn.execute(
+                    'SELECT local_path, bucket, key, etag, size, mtime_ns FROM synced_files '
+                    'WHERE local_path >= ? AND local_path < ?',
+                    (low, high)
+                )
+            }
+
+    def record(self, rows):
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO synced_files (local_path, bucket, key, etag, size, mtime_ns) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+class IdentityCache:
+    """
+    Remembers the AWS identity verified for a credential fingerprint for a
+    short TTL, so a relaunch with unchanged credentials skips the STS call
+    (and importing boto3 before the first prompt). Only the fingerprint, a
+    hash, is stored, never the credentials themselves.
+    """
+    def __init__(self, path, ttl=DEFAULT_IDENTITY_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _read(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, fingerprint):
+        entry = self._read().get(fingerprint)
+        if entry is None or time.time() - entry.get('verified_at', 0) > self.ttl:
+            return None
+        return entry.get('identity')
+
+    def put(self, fingerprint, identity):
+        now = time.time()
+        entries = {
+            key: entry for key, entry in self._read().items()
+            if now - entry.get('verified_at', 0) <= self.ttl
+        }
+        entries[fingerprint] = {
+            'verified_at': now,
+            'identity': {field: identity.get(field) for field in ('Account', 'Arn', 'UserId')},
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(temp_path, self.path)
+
+def credential_fingerprint():
+    """
+    Hashes everything that decides which AWS credentials are used: the
+    credential environment variables and the shared credentials and config
+    files. Reading them is much cheaper than resolving credentials through
+    botocore.
+    """
+    digest = hashlib.sha256()
+    for name in CREDENTIAL_ENV_VARS:
+        digest.update(f"{name}={os.environ.get(name, '')}\0".encode('utf-8'))
+    for path in (
+        os.environ.get('AWS_SHARED_CREDENTIALS_FILE', '~/.aws/credentials'),
+        os.environ.get('AWS_CONFIG_FILE', '~/.aws/config'),
+    ):
+        try:
+            with open(os.path.expanduser(path), 'rb') as aws_file:
+                digest.update(aws_file.read())
+        except OSError:
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 's3fetch')
+
+class TransferCallback:
+    """
+    Byte callback of one file. Calls only append to the shared event queue
+    (deque.append is thread-safe), so transfer threads never wait on a lock
+    or on terminal output.
+    """
+    __slots__ = ('key', 'size', '_events')
+
+    def __init__(self, key, size, events):
+        self.key = key
+        self.size = size
+        self._events = events
+
+    def __call__(self, bytes_amount):
+        self._events.append((self, bytes_amount))
+
+    def finished(self):
+        self._events.append((self, None))
+
+class TransferProgress:
+    """
+    One aggregate progress bar for a batch of downloads: total bytes, files
+    done, rate and ETA, plus the progress of the largest active transfers.
+    A reporter thread drains the callback events and redraws at most every
+    PROGRESS_REFRESH_INTERVAL seconds.
+    """
+    def __init__(self, total_bytes, total_files, interval=PROGRESS_REFRESH_INTERVAL):
+        self._events = collections.deque()
+        self._interval = interval
+        self._total_files = total_files
+        self._files_done = 0
+        self._active = {}
+        self._stopped = threading.Event()
+        self._bar = tqdm.tqdm(
+            total=total_bytes,
+            unit='B',
+            unit_scale=True,
+            unit_divisor=1024,
+            desc='Downloading',
+            # No bar when stderr is not a terminal (batch runs from cron).
+            disable=None
+        )
+        self._bar.set_postfix_str(self._postfix(), refresh=False)
+        self._reporter = threading.Thread(target=self._report, daemon=True)
+        self._reporter.start()
+
+    def file_callback(self, key, size, initial=0):
+        callback = TransferCallback(key, size, self._events)
+        if initial:
+            callback(initial)
+        return callback
+
+    def _postfix(self):
+        parts = [f'{self._files_done}/{self._total_files} files']
+        largest = sorted(self._active.items(), key=lambda item: item[0].size, reverse=True)
+        for callback, done in largest[:PROGRESS_ACTIVE_FILES]:
+            parts.append(f'{os.path.basename(callback.key)} {done * 100 // max(1, callback.size)}%')
+        return ', '.join(parts)
+
+    def _drain(self):
+        events = self._events
+        transferred = 0
+        while True:
+            try:
+                callback, bytes_amount = events.popleft()
+            except IndexError:
+                break
+            if bytes_amount is None:
+                self._files_done += 1
+                self._active.pop(callback, None)
+            else:
+                transferred += bytes_amount
+                if callback.size >= PROGRESS_LARGE_FILE_SIZE:
+                    self._active[callback] = self._active.get(callback, 0) + bytes_amount
+        self._bar.set_postfix_str(self._postfix(), refresh=False)
+        self._bar.update(transferred)
+
+    def _report(self):
+        while not self._stopped.wait(self._interval):
+            self._drain()
+
+    def close(self):
+        self._stopped.set()
+        self._reporter.join()
+        self._drain()
+        self._bar.close()
+
+class TransferSettings:
+    """
+    Download concurrency, multipart and connection settings of a client.
+    workers files are downloaded at once, each with up to max_concurrency
+    part requests, and the connection pool is sized so that all of them
+    keep reused connections unless pool_connections is set.
+    """
+    def __init__(self, workers=DEFAULT_DOWNLOAD_WORKERS, max_concurrency=TRANSFER_MAX_CONCURRENCY,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+                 multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+                 pool_connections=None, tcp_keepalive=False,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.pool_connections = pool_connections
+        self.tcp_keepalive = tcp_keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @classmethod
+    def from_args(cls, args):
+        settings = cls()
+        if args.workers is not None:
+            settings.workers = args.workers
+        if args.max_concurrency is not None:
+            settings.max_concurrency = args.max_concurrency
+        if args.multipart_threshold is not None:
+            settings.multipart_threshold = args.multipart_threshold * 1024 * 1024
+        if args.multipart_chunksize is not None:
+            settings.multipart_chunksize = args.multipart_chunksize * 1024 * 1024
+        settings.pool_connections = args.max_pool_connections
+        settings.tcp_keepalive = args.tcp_keepalive
+        settings.connect_timeout = args.connect_timeout
+        settings.read_timeout = args.read_timeout
+        return settings
+
+    def copy(self):
+        duplicate = TransferSettings()
+        duplicate.__dict__.update(self.__dict__)
+        return duplicate
+
+    def pool_size(self, list_workers=DEFAULT_LIST_WORKERS):
+        if self.pool_connections is not None:
+            return self.pool_connections
+        return max(10, list_workers, self.workers * self.max_concurrency)
+
+    def client_config(self, list_workers=DEFAULT_LIST_WORKERS):
+        return botocore_config.Config(
+            max_pool_connections=self.pool_size(list_workers),
+            tcp_keepalive=self.tcp_keepalive,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout
+        )
+
+    def transfer_config(self):
+        return boto3_transfer.TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=self.max_concurrency
+        )
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def describe(self):
+        return (
+            f"{self.workers} files x {self.max_concurrency} parts of {format_size(self.multipart_chunksize)}, "
+            f"multipart above {format_size(self.multipart_threshold)}, {self.pool_size()} connections"
+        )
+
+class PrefixLimit:
+    """
+    Concurrency limit and throttling statistics of one S3 prefix.
+    """
+    __slots__ = ('limit', 'in_flight', 'streak', 'last_decrease', 'fastest', 'requests', 'throttled', 'retried')
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.streak = 0
+        self.last_decrease = 0.0
+        self.fastest = None
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+
+class ThrottleController:
+    """
+    Adaptive (AIMD) limit on the S3 requests in flight per prefix, hooked
+    into botocore's events so it covers listings, get_object calls and
+    s3transfer's part requests alike. Every request attempt takes a slot of
+    its prefix (bucket and first key segment) in before-send and gives it
+    back in needs-retry. Successes raise the limit by 1/limit, about one
+    slot per round of requests; throttling (SlowDown, 503, 429) halves it,
+    and very slow responses cut it by 10%, at most once per
+    THROTTLE_DECREASE_INTERVAL. Throttled and transient failures are
+    retried with full-jitter backoff whose exponent grows with the prefix's
+    run of throttled responses, so a hot prefix backs off as a whole.
+    """
+    def __init__(self, max_limit, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.max_limit = max(1, max_limit)
+        self.max_attempts = max_attempts
+        self._condition = threading.Condition()
+        self._prefixes = {}
+        self._local = threading.local()
+
+    def install(self, s3, pool_size, raise_limit=True):
+        # Prefixes can use every connection of the largest client; the
+        # --auto-tune probe's client does not raise the limit.
+        if raise_limit:
+            self.max_limit = max(self.max_limit, pool_size)
+        events = s3.meta.events
+        events.register('before-parameter-build.s3', self._on_parameter_build)
+        events.register('before-send.s3', self._on_before_send)
+        events.register_first('needs-retry.s3', self._on_needs_retry)
+
+    @staticmethod
+    def client_config():
+        # The controller makes every retry decision itself.
+        return botocore_config.Config(retries={'mode': 'standard', 'total_max_attempts': 1})
+
+    def _on_parameter_build(self, params, **kwargs):
+        # A request is sent from the thread that built it, so the prefix is
+        # handed to the send and retry hooks through a thread local.
+        key = params.get('Key', params.get('Prefix', '')) or ''
+        self._local.prefix = f"{params.get('Bucket', '')}/{key.split('/', 1)[0]}"
+
+    def _on_before_send(self, **kwargs):
+        prefix = getattr(self._local, 'prefix', '')
+        with self._condition:
+            state = self._prefixes.get(prefix)
+            if state is None:
+                state = self._prefixes[prefix] = PrefixLimit(self.max_limit)
+            while state.in_flight >= int(state.limit):
+                self._condition.wait()
+            state.in_flight += 1
+            state.requests += 1
+        self._local.slot = (state, time.monotonic())
+
+    def _on_needs_retry(self, response=None, caught_exception=None, attempts=1, **kwargs):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            return None
+        self._local.slot = None
+        state, started = slot
+        outcome = self.classify(response, caught_exception)
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            state.in_flight -= 1
+            if outcome == 'throttled':
+                state.throttled += 1
+                state.streak += 1
+                self._decrease(state, 0.5, now)
+            elif outcome == 'ok':
+                state.streak = 0
+                if state.fastest is None or latency < state.fastest:
+                    state.fastest = latency
+                if latency > THROTTLE_SLOW_RESPONSE and latency > state.fastest * THROTTLE_LATENCY_FACTOR:
+                    self._decrease(state, 0.9, now)
+                else:
+                    state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+            self._condition.notify_all()
+            if outcome in ('throttled', 'transient') and attempts < self.max_attempts:
+                state.retried += 1
+                exponent = max(attempts - 1, state.streak)
+                return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** exponent))
+        return None
+
+    @staticmethod
+    def _decrease(state, factor, now):
+        if now - state.last_decrease >= THROTTLE_DECREASE_INTERVAL:
+            state.limit = max(1.0, state.limit * factor)
+            state.last_decrease = now
+
+    @staticmethod
+    def classify(response, caught_exception):
+        """
+        Returns 'ok', 'throttled', 'transient' or 'error' for one attempt.
+        """
+        if caught_exception is not None:
+            if isinstance(caught_exception, (BotocoreConnectionError, HTTPClientError)):
+                return 'transient'
+            return 'error'
+        if response is None:
+            return 'ok'
+        http_response, parsed = response
+        status = http_response.status_code
+        code = parsed.get('Error', {}).get('Code', '') if isinstance(parsed, dict) else ''
+        if code in THROTTLE_ERROR_CODES or status in (429, 503):
+            return 'throttled'
+        if code in TRANSIENT_ERROR_CODES or status >= 500:
+            return 'transient'
+        return 'ok' if status < 400 else 'error'
+
+    def stats(self):
+        with self._condition:
+            states = list(self._prefixes.items())
+        return {
+            'requests': sum(state.requests for _, state in states),
+            'throttled': sum(state.throttled for _, state in states),
+            'retried': sum(state.retried for _, state in states),
+            'throttled_prefixes': {
+                prefix: {'throttled': state.throttled, 'limit': int(state.limit)}
+                for prefix, state in states if state.throttled
+            },
+        }
+
+class LatencyHistogram:
+    """
+    Cumulative latency histogram with the LATENCY_BUCKETS upper bounds, in
+    the shape Prometheus expects.
+    """
+    __slots__ = ('counts', 'total', 'count', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.maximum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def cumulative(self):
+        return list(itertools.accumulate(self.counts))
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile by linear interpolation inside its bucket,
+        like Prometheus' histogram_quantile.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        lower = 0.0
+        seen = 0
+        for upper, count in zip(LATENCY_BUCKETS + (self.maximum,), self.counts):
+            if count and seen + count >= rank:
+                return min(self.maximum, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+            lower = upper
+        return self.maximum
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'mean': round(self.total / self.count, 6) if self.count else 0.0,
+            'p50': round(self.quantile(0.5), 6),
+            'p90': round(self.quantile(0.9), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'max': round(self.maximum, 6),
+            'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], self.cumulative())),
+        }
+
+class OperationMetrics:
+    """
+    Counters of one S3 operation (ListObjectsV2, HeadObject, GetObject...).
+    """
+    __slots__ = ('calls', 'errors', 'attempts', 'throttled', 'bytes', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.attempts = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'attempts': self.attempts,
+            'retries': max(0, self.attempts - self.calls),
+            'throttled': self.throttled,
+            'bytes': self.bytes,
+            'latency_seconds': self.latency.as_dict(),
+        }
+
+class PhaseProfiler:
+    """
+    cProfile over every run of one phase. Worker threads started during the
+    phase (download pools, listing shards) get a profiler of their own, and
+    all of them are merged into one pstats file.
+    """
+    def __init__(self, path):
+        import cProfile
+        self._profile_class = cProfile.Profile
+        self.path = path
+        self._main = cProfile.Profile()
+        self._profiles = [self._main]
+        self._lock = threading.Lock()
+
+    def _start_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = self._profile_class()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler, which already sees every thread.
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._main.enable()
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+    def dump(self):
+        import pstats
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is None:
+            return False
+        stats.dump_stats(self.path)
+        return True
+
+class SessionMetrics:
+    """
+    Per-session instrumentation: latency histograms, attempts, throttled
+    responses and bytes of every S3 operation, collected from botocore's
+    before-call / after-call / needs-retry events so paginator pages,
+    head_bucket, head_object and each GET (s3transfer's parts included)
+    are all covered, plus the wall time of each phase of the session.
+    Requests are counted with one dictionary lookup and a short lock, so
+    the hooks stay on even when nothing is exported.
+    """
+    def __init__(self, profile_phase=None, profile_path=None):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._phases = {}
+        self.profiler = None
+        self.profile_phase = profile_phase
+        if profile_phase:
+            self.profiler = PhaseProfiler(profile_path or f's3fetch-{profile_phase}.prof')
+
+    def install(self, s3):
+        events = s3.meta.events
+        events.register('before-call.s3', self._on_before_call)
+        events.register('after-call.s3', self._on_after_call)
+        events.register('after-call-error.s3', self._on_after_call_error)
+        events.register_last('needs-retry.s3', self._on_needs_retry)
+
+    def _operation(self, name):
+        operation = self._operations.get(name)
+        if operation is None:
+            operation = self._operations.setdefault(name, OperationMetrics())
+        return operation
+
+    def _on_before_call(self, model, context, **kwargs):
+        context['s3fetch_operation'] = model.name
+        context['s3fetch_started'] = time.perf_counter()
+
+    def _finish_call(self, context, failed, content_length=0):
+        started = context.get('s3fetch_started')
+        if started is None:
+            return
+        latency = time.perf_counter() - started
+        with self._lock:
+            operation = self._operation(context['s3fetch_operation'])
+            operation.calls += 1
+            operation.bytes += content_length
+            if failed:
+                operation.errors += 1
+            operation.latency.observe(latency)
+
+    def _on_after_call(self, http_response, parsed, context, **kwargs):
+        content_length = 0
+        if context.get('s3fetch_operation') == 'GetObject' and isinstance(parsed, dict):
+            content_length = parsed.get('ContentLength') or 0
+        self._finish_call(context, http_response.status_code >= 300, content_length)
+
+    def _on_after_call_error(self, context, **kwargs):
+        self._finish_call(context, True)
+
+    def _on_needs_retry(self, operation, response=None, caught_exception=None, **kwargs):
+        throttled = ThrottleController.classify(response, caught_exception) == 'throttled'
+        with self._lock:
+            counters = self._operation(operation.name)
+            counters.attempts += 1
+            if throttled:
+                counters.throttled += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times one run of a phase, under cProfile when it is the phase
+        selected with --profile.
+        """
+        profiling = self.profiler is not None and name == self.profile_phase
+        if profiling:
+            self.profiler.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiling:
+                self.profiler.stop()
+            with self._lock:
+                runs, seconds = self._phases.get(name, (0, 0.0))
+                self._phases[name] = (runs + 1, seconds + elapsed)
+
+    def as_dict(self):
+        with self._lock:
+            operations = {name: operation.as_dict() for name, operation in sorted(self._operations.items())}
+            phases = {
+                name: {'runs': runs, 'seconds': round(seconds, 6)}
+                for name, (runs, seconds) in self._phases.items()
+            }
+        return {
+            'session_seconds': round(time.perf_counter() - self.started, 6),
+            'operations': operations,
+            'phases': phases,
+        }
+
+    def as_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        data = self.as_dict()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        operations = data['operations']
+        family('s3fetch_request_duration_seconds', 'histogram', 'Latency of S3 calls, retries included.')
+        for name, operation in operations.items():
+            latency = operation['latency_seconds']
+            for bound, count in latency['buckets'].items():
+                lines.append(f's3fetch_request_duration_seconds_bucket{{operation="{name}",le="{bound}"}} {count}')
+            lines.append(f's3fetch_request_duration_seconds_sum{{operation="{name}"}} {latency["sum"]}')
+            lines.append(f's3fetch_request_duration_seconds_count{{operation="{name}"}} {latency["count"]}')
+        counters = (
+            ('s3fetch_requests_total', 'calls', 'S3 calls made.'),
+            ('s3fetch_request_errors_total', 'errors', 'S3 calls that failed after their last attempt.'),
+            ('s3fetch_request_attempts_total', 'attempts', 'HTTP attempts of S3 calls, retries included.'),
+            ('s3fetch_request_retries_total', 'retries', 'Retried attempts of S3 calls.'),
+            ('s3fetch_throttled_responses_total', 'throttled', 'Attempts S3 answered with a throttling error.'),
+            ('s3fetch_response_bytes_total', 'bytes', 'Object bytes returned by GetObject calls.'),
+        )
+        for metric, field, help_text in counters:
+            family(metric, 'counter', help_text)
+            for name, operation in operations.items():
+                lines.append(f'{metric}{{operation="{name}"}} {operation[field]}')
+        family('s3fetch_phase_duration_seconds', 'counter', 'Wall time spent in each phase of the session.')
+        for name, phase in data['phases'].items():
+            lines.append(f's3fetch_phase_duration_seconds{{phase="{name}"}} {phase["seconds"]}')
+        family('s3fetch_phase_runs_total', 'counter', 'Runs of each phase of the session.')
+        for name, phase in data['phases'].items():
+            lines.append(f's3fetch_phase_runs_total{{phase="{name}"}} {phase["runs"]}')
+        family('s3fetch_session_duration_seconds', 'gauge', 'Wall time of the session.')
+        lines.append(f's3fetch_session_duration_seconds {data["session_seconds"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, metrics_format='json'):
+        """
+        Writes the metrics to path ('-' for stderr) and the profile of the
+        selected phase to its pstats file. Runs at session end from atexit,
+        so errors are reported instead of raised.
+        """
+        if self.profiler is not None:
+            try:
+                if self.profiler.dump():
+                    console.print(
+                        f"[cyan]Profile of the {self.profile_phase} phase written to {self.profiler.path} "
+                        f"(python -m pstats {self.profiler.path}).[/cyan]"
+                    )
+            except OSError as e:
+                console.print(f"[red]The profile could not be written: {e}[/red]")
+        if not path:
+            return
+        if metrics_format == 'prometheus':
+            text = self.as_prometheus()
+        else:
+            text = json.dumps(self.as_dict(), indent=2) + '\n'
+        if path == '-':
+            sys.stderr.write(text)
+            return
+        try:
+            with open(path, 'w') as metrics_file:
+                metrics_file.write(text)
+        except OSError as e:
+            console.print(f"[red]The metrics could not be written to {path}: {e}[/red]")
+
+def create_session_metrics(args):
+    metrics = SessionMetrics(args.profile)
+    if args.metrics or args.profile:
+        atexit.register(metrics.export, args.metrics, args.metrics_format)
+    return metrics
+
+def create_s3_client(settings=None, list_workers=DEFAULT_LIST_WORKERS, controller=None, metrics=None, region=None,
+                     raise_limit=True):
+    # Every worker may run max_concurrency part requests at once, so the
+    # shared pool is sized to keep all of them on reused connections.
+    settings = settings or TransferSettings()
+    config = settings.client_config(list_workers)
+    if controller is not None:
+        config = config.merge(controller.client_config())
+    s3 = boto3.client('s3', region_name=region, config=config)
+    if controller is not None:
+        controller.install(s3, settings.pool_size(list_workers), raise_limit)
+    if metrics is not None:
+        metrics.install(s3)
+    return s3
+
+def bucket_region(response):
+    """
+    Returns the bucket region S3 reports in a response or error response.
+    """
+    return response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+
+class S3ClientCache:
+    """
+    S3 clients per region, reused across bucket switches, and the region of
+    every bucket seen, learned from the x-amz-bucket-region header of its
+    head_bucket response. A bucket is only looked up through the default
+    region once; after that its requests go straight to a client of its
+    own region, without redirects or a new client. Both maps are bounded
+    and evict the least recently used entry.
+    """
+    def __init__(self, settings, list_workers=DEFAULT_LIST_WORKERS, controller=None, metrics=None,
+                 max_clients=DEFAULT_MAX_REGION_CLIENTS, max_buckets=DEFAULT_MAX_BUCKET_REGIONS):
+        self._settings = settings
+        self._list_workers = list_workers
+        self._controller = controller
+        self._metrics = metrics
+        self._max_clients = max_clients
+        self._max_buckets = max_buckets
+        self._default_region = None
+        self._clients = collections.OrderedDict()
+        self._tuned_clients = collections.OrderedDict()
+        self._regions = collections.OrderedDict()
+
+    def client(self, region=None):
+        region = region or self._default_region
+        s3 = self._clients.get(region)
+        if s3 is not None:
+            self._clients.move_to_end(region)
+            return s3
+        s3 = create_s3_client(self._settings, self._list_workers, self._controller, self._metrics, region)
+        region = s3.meta.region_name
+        if self._default_region is None:
+            self._default_region = region
+        self._clients[region] = s3
+        if len(self._clients) > self._max_clients:
+            self._clients.popitem(last=False)
+        return s3
+
+    def region_of(self, bucket_name):
+        return self._regions.get(bucket_name)
+
+    def _remember(self, bucket_name, region):
+        if not region:
+            return
+        self._regions[bucket_name] = region
+        self._regions.move_to_end(bucket_name)
+        if len(self._regions) > self._max_buckets:
+            self._regions.popitem(last=False)
+
+    def head_bucket(self, bucket_name):
+        """
+        Checks access to the bucket and returns the client of its region.
+        Raises ClientError like head_bucket; the region is remembered even
+        then, since S3 reports it on access errors too.
+        """
+        s3 = self.client(self._regions.get(bucket_name))
+        try:
+            response = s3.head_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            self._remember(bucket_name, bucket_region(e.response))
+            raise
+        region = bucket_region(response) or s3.meta.region_name
+        self._remember(bucket_name, region)
+        return self.client(region)
+
+    def client_for(self, settings, region=None, probe=False):
+        """
+        Returns a client of the region for other transfer settings
+        (--auto-tune), with the session's throttle controller and metrics,
+        reused per region and connection settings. A probe client leaves
+        the controller's per-prefix limit as it is, so the throughput probe
+        runs under the limits of the downloads.
+        """
+        region = region or self._default_region
+        key = (
+            region, probe, settings.pool_size(self._list_workers), settings.tcp_keepalive,
+            settings.connect_timeout, settings.read_timeout
+        )
+        s3 = self._tuned_clients.get(key)
+        if s3 is not None:
+            self._tuned_clients.move_to_end(key)
+            return s3
+        s3 = create_s3_client(
+            settings, self._list_workers, self._controller, self._metrics, region, raise_limit=not probe
+        )
+        self._tuned_clients[key] = s3
+        if len(self._tuned_clients) > self._max_clients:
+            self._tuned_clients.popitem(last=False)
+        return s3
+
+def probe_requests(probes, concurrency):
+    return [probes[i % len(probes)] for i in range(concurrency * 2)]
+
+def measure_throughput(s3, bucket_name, probes, concurrency):
+    """
+    Runs 2 * concurrency ranged GETs of at most AUTO_TUNE_PROBE_BYTES over
+    the probe objects with that many requests in flight. Returns
+    (bytes per second, requests per second, bytes read).
+    """
+    requests = probe_requests(probes, concurrency)
+
+    def fetch(probe):
+        file_key, file_size = probe
+        if file_size == 0:
+            return 0
+        end = min(file_size, AUTO_TUNE_PROBE_BYTES) - 1
+        body = s3.get_object(Bucket=bucket_name, Key=file_key, Range=f'bytes=0-{end}')['Body']
+        return len(body.read())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        transferred = sum(executor.map(fetch, requests))
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    return transferred / elapsed, len(requests) / elapsed, transferred
+
+# Requests in flight picked by the throughput probe, per (region, rate
+# unit), so a session probes each region once.
+_probed_levels = {}
+
+def probe_level(s3, bucket_name, probes, total_requests, by_bytes, budget):
+    """
+    Doubles the requests in flight from AUTO_TUNE_LEVELS[0] while throughput
+    improves by at least AUTO_TUNE_MIN_GAIN, stopping before a level would
+    read more than budget bytes in all or after AUTO_TUNE_PROBE_SECONDS.
+    Returns (level, {level: rate}).
+    """
+    best_level, best_rate, rates = None, 0, {}
+    spent = 0
+    started = time.perf_counter()
+    for level in AUTO_TUNE_LEVELS:
+        if best_level is not None and level > total_requests:
+            break
+        cost = sum(min(size, AUTO_TUNE_PROBE_BYTES) for _, size in probe_requests(probes, level))
+        if best_level is not None and (
+            spent + cost > budget or time.perf_counter() - started > AUTO_TUNE_PROBE_SECONDS
+        ):
+            break
+        bytes_rate, request_rate, transferred = measure_throughput(s3, bucket_name, probes, level)
+        spent += transferred
+        rate = bytes_rate if by_bytes else request_rate
+        rates[level] = round(rate, 1)
+        if best_level is not None and rate < best_rate * AUTO_TUNE_MIN_GAIN:
+            break
+        best_level, best_rate = level, rate
+    return best_level, rates
+
+def auto_tune_settings(bucket_name, file_keys, catalog, settings, explicit=(), region=None, clients=None):
+    """
+    Picks transfer settings for a download from the size distribution of
+    the selected objects and the measured throughput. Part size and
+    threshold follow the large objects so each one splits into enough parts
+    to keep its connections busy; the number of requests in flight comes
+    from probe_level, which reads at most a tenth of the selection and is
+    run once per region and session. A selection too small to probe gets
+    the level its request count calls for. The probe client comes from
+    clients, so it goes through the throttle controller and the metrics.
+    Settings named in explicit are kept as given. Returns (settings, report).
+    """
+    tuned = settings.copy()
+    sizes = sorted((catalog.size_of(file_key), file_key) for file_key in file_keys)
+    if not sizes:
+        return tuned, {}
+    large = [size for size, _ in sizes if size >= tuned.multipart_threshold]
+    if 'multipart_chunksize' not in explicit and large:
+        median_large = large[len(large) // 2]
+        chunk = median_large // AUTO_TUNE_LEVELS[0]
+        chunk = max(DEFAULT_MULTIPART_CHUNKSIZE_MB * 1024 * 1024, min(AUTO_TUNE_MAX_CHUNKSIZE, chunk))
+        tuned.multipart_chunksize = -(-chunk // (1024 * 1024)) * 1024 * 1024
+    if 'multipart_threshold' not in explicit:
+        tuned.multipart_threshold = tuned.multipart_chunksize
+
+    # Probe the largest objects (they are the ones the transfer waits on)
+    # through a client with room for the highest level.
+    probes = [(file_key, size) for size, file_key in sizes[-AUTO_TUNE_LEVELS[-1]:]]
+    selected_bytes = sum(size for size, _ in sizes)
+    by_bytes = sum(large) * 2 >= selected_bytes
+    total_requests = sum(max(1, -(-size // tuned.multipart_chunksize)) for size, _ in sizes)
+    budget = min(AUTO_TUNE_PROBE_MAX_BYTES, selected_bytes // AUTO_TUNE_PROBE_SHARE)
+    first_cost = sum(min(size, AUTO_TUNE_PROBE_BYTES) for _, size in probe_requests(probes, AUTO_TUNE_LEVELS[0]))
+    cache_key = (region, by_bytes)
+    if cache_key in _probed_levels:
+        best_level, rates = _probed_levels[cache_key]
+        probe = 'cached'
+    elif first_cost > budget:
+        best_level = max([AUTO_TUNE_LEVELS[0]] + [level for level in AUTO_TUNE_LEVELS if level <= total_requests])
+        rates = {}
+        probe = 'skipped'
+    else:
+        probe_settings = tuned.copy()
+        probe_settings.pool_connections = AUTO_TUNE_LEVELS[-1]
+        if clients is not None:
+            s3 = clients.client_for(probe_settings, region, probe=True)
+        else:
+            s3 = create_s3_client(probe_settings, region=region)
+        best_level, rates = probe_level(s3, bucket_name, probes, total_requests, by_bytes, budget)
+        _probed_levels[cache_key] = best_level, rates
+        probe = 'measured'
+
+    largest = sizes[-1][0]
+    if 'max_concurrency' not in explicit:
+        tuned.max_concurrency = max(1, min(best_level, -(-largest // tuned.multipart_chunksize)))
+    if 'workers' not in explicit:
+        tuned.workers = max(1, best_level // tuned.max_concurrency)
+    if 'tcp_keepalive' not in explicit:
+        tuned.tcp_keepalive = True
+    report = {
+        'requests_in_flight': best_level,
+        'probe': probe,
+        'measured_rates': rates,
+        'rate_unit': 'bytes/s' if by_bytes else 'requests/s',
+    }
+    return tuned, report
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping or adjacent [start, end) byte ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(done, size, part_size=RESUME_PART_SIZE):
+    """
+    Returns the [start, end) ranges of at most part_size bytes that are not
+    covered by the merged ranges in done.
+    """
+    missing = []
+    position = 0
+    for start, end in done + [[size, size]]:
+        for part_start in range(position, start, part_size):
+            missing.append((part_start, min(part_start + part_size, start)))
+        position = max(position, end)
+    return missing
+
+class VerificationError(IOError):
+    """
+    The downloaded bytes do not match the object's ETag or checksum.
+    """
+    def __init__(self, record):
+        mismatched = ', '.join(name for name, check in record['checks'].items() if check == 'mismatch')
+        super().__init__(f"{record['key']}: downloaded bytes do not match the object's {mismatched}")
+        self.record = record
+
+class RunningChecksum:
+    """
+    Incremental S3 additional checksum. CRC32C and CRC64NVME need awscrt,
+    like in botocore; without it they raise ValueError.
+    """
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self._hash = None
+        self._crc = 0
+        if algorithm in ('SHA1', 'SHA256'):
+            self._hash = hashlib.new(algorithm.lower())
+        elif algorithm == 'CRC32':
+            self._crc_function = zlib.crc32
+            self._width = 4
+        elif algorithm in ('CRC32C', 'CRC64NVME'):
+            try:
+                from awscrt import checksums
+            except ImportError:
+                raise ValueError(f"{algorithm} checksums need the awscrt package")
+            self._crc_function = getattr(checksums, algorithm.lower(), None)
+            if self._crc_function is None:
+                raise ValueError(f"{algorithm} checksums need a newer awscrt package")
+            self._width = 4 if algorithm == 'CRC32C' else 8
+        else:
+            raise ValueError(f"unknown checksum algorithm {algorithm}")
+
+    def update(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            self._crc = self._crc_function(data, self._crc)
+
+    def digest(self):
+        if self._hash is not None:
+            return self._hash.digest()
+        return self._crc.to_bytes(self._width, 'big')
+
+class ObjectVerifier:
+    """
+    Verifies an object from the bytes being written, without reading the
+    file again. Bytes are hashed in object order: the MD5 of each upload
+    part (one part for single-part objects) to rebuild the ETag, and the
+    additional checksum, per part for COMPOSITE checksums, when the object
+    has one. Bytes that arrive ahead of the cursor, from ranges fetched in
+    parallel, wait in memory up to VERIFY_BUFFER_BYTES; past that, and for
+    ranges written by an earlier run, only their offsets are kept and the
+    bytes are read back through read_back(start, end) when needed.
+    """
+    def __init__(self, key, size, etag, part_size=None, checksum=None, checksum_algorithm=None,
+                 composite=False, etag_is_md5=True, read_back=None):
+        self.key = key
+        self.size = size
+        self.etag = etag.strip('"')
+        self._read_back = read_back
+        self._lock = threading.Lock()
+        self._position = 0
+        self._pending = {}
+        self._buffered = 0
+        self.checks = {}
+        multipart = '-' in self.etag
+        if not etag_is_md5:
+            self.checks['etag'] = 'skipped: encrypted with KMS or a customer key'
+        elif not self.etag:
+            self.checks['etag'] = 'skipped: no ETag'
+        elif multipart and not part_size:
+            self.checks['etag'] = 'skipped: parts of different sizes'
+        self._part_size = part_size if multipart and part_size else max(size, 1)
+        self._part_end = min(size, self._part_size)
+        self._part_md5 = hashlib.md5()
+        self._part_digests = []
+        self._checksum = checksum
+        self._part_checksum = None
+        self._part_checksums = []
+        self._object_checksum = None
+        self._algorithm = checksum_algorithm
+        if checksum:
+            try:
+                if composite:
+                    self._part_checksum = RunningChecksum(checksum_algorithm)
+                else:
+                    self._object_checksum = RunningChecksum(checksum_algorithm)
+            except ValueError as e:
+                self.checks[f'checksum_{checksum_algorithm.lower()}'] = f'skipped: {e}'
+                self._checksum = None
+
+    def _close_part(self):
+        self._part_digests.append(self._part_md5.digest())
+        self._part_md5 = hashlib.md5()
+        if self._part_checksum is not None:
+            self._part_checksums.append(self._part_checksum.digest())
+            self._part_checksum = RunningChecksum(self._algorithm)
+        self._part_end = min(self.size, self._part_end + self._part_size)
+
+    def _consume(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self._position == self._part_end:
+                if self._position >= self.size:
+                    raise IOError(f"{self.key}: more bytes than the listed size {self.size}")
+                self._close_part()
+            piece = view[:self._part_end - self._position]
+            self._part_md5.update(piece)
+            if self._part_checksum is not None:
+                self._part_checksum.update(piece)
+            if self._object_checksum is not None:
+                self._object_checksum.update(piece)
+            self._position += len(piece)
+            view = view[len(piece):]
+
+    def _drain(self):
+        while self._position in self._pending:
+            start = self._position
+            item = self._pending.pop(start)
+            if isinstance(item, int):
+                for chunk_start in range(start, start + item, SMALL_OBJECT_BUFFER_SIZE):
+                    self._consume(self._read_back(chunk_start, min(start + item, chunk_start + SMALL_OBJECT_BUFFER_SIZE)))
+            else:
+                self._buffered -= len(item)
+                self._consume(item)
+
+    def update(self, offset, data):
+        """
+        Feeds bytes written at offset; safe to call from several threads.
+        """
+        with self._lock:
+            if offset == self._position:
+                self._consume(data)
+                self._drain()
+            elif self._read_back is None or self._buffered + len(data) <= VERIFY_BUFFER_BYTES:
+                self._pending[offset] = bytes(data)
+                self._buffered += len(data)
+            else:
+                self._pending[offset] = len(data)
+
+    def skip(self, start, end):
+        """
+        Marks [start, end) as already in the file, from an earlier run.
+        """
+        with self._lock:
+            self._pending[start] = end - start
+            self._drain()
+
+    def finish(self):
+        """
+        Returns the verification record of the object: its checks and a
+        status of 'verified', 'unverified' (nothing could be checked) or
+        'mismatch'.
+        """
+        with self._lock:
+            self._drain()
+            if self._position != self.size:
+                raise IOError(f"{self.key}: only {self._position} of {self.size} bytes were verified")
+            self._close_part()
+        if 'etag' not in self.checks:
+            if '-' in self.etag:
+                digests = self._part_digests
+                computed = f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+            else:
+                computed = self._part_digests[0].hex()
+            self.checks['etag'] = 'ok' if computed == self.etag else 'mismatch'
+        if self._checksum:
+            if self._part_checksum is not None:
+                combined = RunningChecksum(self._algorithm)
+                combined.update(b''.join(self._part_checksums))
+                computed = f"{base64.b64encode(combined.digest()).decode()}-{len(self._part_checksums)}"
+            else:
+                computed = base64.b64encode(self._object_checksum.digest()).decode()
+            self.checks[f'checksum_{self._algorithm.lower()}'] = 'ok' if computed == self._checksum else 'mismatch'
+        results = set(self.checks.values())
+        if 'mismatch' in results:
+            status = 'mismatch'
+        elif 'ok' in results:
+            status = 'verified'
+        else:
+            status = 'unverified'
+        return {'key': self.key, 'size': self.size, 'etag': self.etag, 'status': status, 'checks': self.checks}
+
+def object_verifier(s3, bucket_name, file_key, file_size, etag, response, read_back=None):
+    """
+    Builds the verifier of an object from its GET or HEAD response, made
+    with ChecksumMode='ENABLED'. For a multipart ETag the part size comes
+    from one head_object of part 1; if the object's parts do not all have
+    that size, the ETag can not be rebuilt and is skipped.
+    """
+    etag = (etag or response.get('ETag', '')).strip('"')
+    encryption = response.get('ServerSideEncryption', '')
+    etag_is_md5 = not (encryption.startswith('aws:kms') or response.get('SSECustomerAlgorithm'))
+    checksum = None
+    algorithm = None
+    for candidate in CHECKSUM_ALGORITHMS:
+        if response.get(f'Checksum{candidate}'):
+            checksum = response[f'Checksum{candidate}']
+            algorithm = candidate
+            break
+    composite = response.get('ChecksumType') == 'COMPOSITE' or bool(checksum and '-' in checksum)
+    part_size = None
+    if '-' in etag and (etag_is_md5 or composite):
+        part = s3.head_object(Bucket=bucket_name, Key=file_key, PartNumber=1, IfMatch=f'"{etag}"')
+        parts_count = int(etag.rsplit('-', 1)[1])
+        candidate = part['ContentLength']
+        if candidate and -(-file_size // candidate) == parts_count:
+            part_size = candidate
+        elif composite:
+            checksum = None
+    return ObjectVerifier(
+        file_key, file_size, etag, part_size, checksum, algorithm, composite, etag_is_md5, read_back
+    )
+
+class VerificationManifest:
+    """
+    Verification results of one download, written as JSON: every object's
+    checks and status, plus the objects that failed.
+    """
+    def __init__(self, path, bucket_name):
+        self.path = path
+        self.bucket_name = bucket_name
+        self._lock = threading.Lock()
+        self.records = []
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def add_failure(self, file_key, error):
+        record = getattr(error, 'record', None) or {'key': file_key, 'checks': {}}
+        self.add(dict(record, status='failed', error=str(error)))
+
+    def counts(self):
+        counts = collections.Counter(record['status'] for record in self.records)
+        return {status: counts.get(status, 0) for status in ('verified', 'unverified', 'failed')}
+
+    def write(self):
+        manifest = {
+            'bucket': self.bucket_name,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'counts': self.counts(),
+            'objects': sorted(self.records, key=lambda record: record['key']),
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        os.replace(temp_path, self.path)
+
+def create_verification_manifest(args, bucket_name, download_dir):
+    """
+    Returns the VerificationManifest of a download with --verify, or None.
+    """
+    if not args.verify:
+        return None
+    return VerificationManifest(
+        os.path.abspath(args.verify_manifest or os.path.join(download_dir, VERIFY_MANIFEST_NAME)), bucket_name
+    )
+
+def describe_verification(manifest):
+    counts = manifest.counts()
+    return (
+        f"{counts['verified']} files verified, {counts['unverified']} without a usable ETag or checksum, "
+        f"{counts['failed']} failed; see {manifest.path}"
+    )
+
+class ResumableDownload:
+    """
+    Downloads one object in byte ranges into a partial file next to its
+    destination, recording every completed range in a small JSON manifest.
+    An interrupted download resumes with only the missing ranges. Every GET
+    is conditional on the ETag from the listing, so a partial file is never
+    completed with the data of a newer object, and the finished file is
+    renamed into place atomically. With verify, the ranges are hashed as
+    they are written and a mismatching file is discarded before the rename;
+    the result is kept in verification.
+    """
+    def __init__(self, s3, bucket_name, file_key, file_size, etag, local_path, cancel_event=None,
+                 progress=None, verify=False):
+        self._s3 = s3
+        self._bucket_name = bucket_name
+        self._key = file_key
+        self._size = file_size
+        self._etag = etag
+        self._local_path = local_path
+        self._partial_path = local_path + PARTIAL_SUFFIX
+        self._manifest_path = self._partial_path + '.json'
+        self._cancel_event = cancel_event
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._done = []
+        self._verify = verify
+        self._verifier = None
+        self._partial_file = None
+        self.verification = None
+
+    def _read_back(self, start, end):
+        with self._lock:
+            if self._partial_file is not None:
+                self._partial_file.flush()
+        with open(self._partial_path, 'rb') as partial_file:
+            partial_file.seek(start)
+            return partial_file.read(end - start)
+
+    def _create_verifier(self):
+        request = {'Bucket': self._bucket_name, 'Key': self._key, 'ChecksumMode': 'ENABLED'}
+        if self._etag:
+            request['IfMatch'] = '"' + self._etag.strip('"') + '"'
+        response = self._s3.head_object(**request)
+        self._verifier = object_verifier(
+            self._s3, self._bucket_name, self._key, self._size, self._etag, response, self._read_back
+        )
+        for start, end in self._done:
+            self._verifier.skip(start, end)
+
+    def _load_manifest(self):
+        """
+        Returns the completed ranges of a previous attempt at the same
+        object version, or an empty list when there is nothing to resume.
+        """
+        if not os.path.exists(self._partial_path):
+            return []
+        try:
+            with open(self._manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return []
+        if (manifest.get('bucket'), manifest.get('key'), manifest.get('etag'), manifest.get('size')) != \
+                (self._bucket_name, self._key, self._etag, self._size):
+            return []
+        if os.path.getsize(self._partial_path) != self._size:
+            return []
+        return merge_ranges(manifest.get('ranges', []))
+
+    def _save_manifest(self):
+        # Written to a temporary file and renamed, so a crash leaves either
+        # the previous manifest or the new one.
+        manifest = {
+            'bucket': self._bucket_name,
+            'key': self._key,
+            'etag': self._etag,
+            'size': self._size,
+            'ranges': self._done,
+        }
+        temp_path = self._manifest_path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_path, self._manifest_path)
+
+    def _discard(self):
+        for path in (self._partial_path, self._manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fetch_range(self, partial_file, start, end, progress):
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            return
+        request = {'Bucket': self._bucket_name, 'Key': self._key, 'Range': f'bytes={start}-{end - 1}'}
+        if self._etag:
+            request['IfMatch'] = self._etag
+        body = self._s3.get_object(**request)['Body']
+        position = start
+        for chunk in iter(lambda: body.read(1024 * 1024), b''):
+            with self._lock:
+                partial_file.seek(position)
+                partial_file.write(chunk)
+            if self._verifier is not None:
+                self._verifier.update(position, chunk)
+            position += len(chunk)
+            progress(len(chunk))
+        if position != end:
+            raise IOError(f"short read for {self._key} bytes {start}-{end - 1}")
+        with self._lock:
+            # The data must be on disk before the manifest claims it.
+            partial_file.flush()
+            os.fsync(partial_file.fileno())
+            self._done = merge_ranges(self._done + [[start, end]])
+            self._save_manifest()
+
+    def run(self, max_concurrency=TRANSFER_MAX_CONCURRENCY, part_size=RESUME_PART_SIZE):
+        self._done = self._load_manifest()
+        if not self._done:
+            self._discard()
+            with open(self._partial_path, 'wb') as partial_file:
+                partial_file.truncate(self._size)
+            self._save_manifest()
+        missing = missing_ranges(self._done, self._size, part_size)
+        initial = self._size - sum(end - start for start, end in missing)
+        if self._progress is not None:
+            progress = self._progress.file_callback(self._key, self._size, initial)
+        else:
+            progress = lambda bytes_amount: None
+        try:
+            if self._verify:
+                self._create_verifier()
+            with open(self._partial_path, 'r+b') as partial_file, \
+                    ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                self._partial_file = partial_file
+                futures = [
+                    executor.submit(self._fetch_range, partial_file, start, end, progress)
+                    for start, end in missing
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                # The object changed after it was listed; its ranges can not
+                # be combined with the ones already downloaded.
+                self._discard()
+                raise IOError(f"{self._key} changed on S3 since it was listed; refresh the listing and retry") from e
+            raise
+        finally:
+            self._partial_file = None
+        if self._done != [[0, self._size]]:
+            # Cancelled before every range arrived; keep the partial file.
+            return False
+        if self._verifier is not None:
+            self.verification = self._verifier.finish()
+            if self.verification['status'] == 'mismatch':
+                self._discard()
+                raise VerificationError(self.verification)
+        os.replace(self._partial_path, self._local_path)
+        os.remove(self._manifest_path)
+        if self._progress is not None:
+            progress.finished()
+        return True
+
+_transfer_buffers = threading.local()
+
+def transfer_buffer():
+    """
+    Returns this thread's reusable read buffer for small objects.
+    """
+    buffer = getattr(_transfer_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _transfer_buffers.buffer = memoryview(bytearray(SMALL_OBJECT_BUFFER_SIZE))
+    return buffer
+
+def download_small_object(s3, bucket_name, file_key, local_path, callback=None, verify=False):
+    """
+    Streams an object with one get_object through the thread's reusable
+    buffer into a temporary file next to local_path, without s3transfer's
+    futures and threads, and renames it into place. A failed download
+    removes only the temporary file, so an existing copy is kept; the
+    rename replaces the path rather than writing through it, so a hardlinked
+    duplicate keeps its bytes. With verify, the bytes are hashed on their
+    way to the file and checked against the response's ETag and checksum;
+    returns the verification record, and a mismatching file is not renamed
+    into place.
+    """
+    request = {'Bucket': bucket_name, 'Key': file_key}
+    if verify:
+        request['ChecksumMode'] = 'ENABLED'
+    response = s3.get_object(**request)
+    body = response['Body']
+    buffer = transfer_buffer()
+    verifier = None
+    record = None
+    temp_path = local_path + SMALL_OBJECT_SUFFIX
+    try:
+        if verify:
+            verifier = object_verifier(
+                s3, bucket_name, file_key, response['ContentLength'], response.get('ETag', ''), response
+            )
+        position = 0
+        with open(temp_path, 'wb', buffering=0) as local_file:
+            if hasattr(body, 'readinto'):
+                while True:
+                    count = body.readinto(buffer)
+                    if not count:
+                        break
+                    local_file.write(buffer[:count])
+                    if verifier is not None:
+                        verifier.update(position, buffer[:count])
+                    position += count
+                    if callback is not None:
+                        callback(count)
+            else:
+                # Older botocore versions can only read into new bytes.
+                for chunk in iter(lambda: body.read(len(buffer)), b''):
+                    local_file.write(chunk)
+                    if verifier is not None:
+                        verifier.update(position, chunk)
+                    position += len(chunk)
+                    if callback is not None:
+                        callback(len(chunk))
+        if verifier is not None:
+            record = verifier.finish()
+            if record['status'] == 'mismatch':
+                raise VerificationError(record)
+        os.replace(temp_path, local_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    finally:
+        body.close()
+    return record
+
+def download_file(s3, bucket_name, file_key, file_size, download_dir, transfer_config,
+                  etag='', resume_threshold=None, cancel_event=None, progress=None, small_object_size=None,
+                  verify=False):
+    """
+    Downloads one object by the path its size calls for. With verify, every
+    object that is not a small one goes through ResumableDownload, whose
+    ranges can be hashed as they are written, unlike s3transfer's; returns
+    the verification record.
+    """
+    # The directories were created by download_files.
+    local_path = local_file_path(download_dir, file_key)
+    if small_object_size is not None and file_size < small_object_size:
+        callback = progress.file_callback(file_key, file_size) if progress is not None else None
+        record = download_small_object(s3, bucket_name, file_key, local_path, callback, verify)
+        if callback is not None:
+            callback.finished()
+        return record
+    if verify or (resume_threshold is not None and file_size >= resume_threshold):
+        download = ResumableDownload(
+            s3, bucket_name, file_key, file_size, etag, local_path, cancel_event, progress, verify
+        )
+        download.run(transfer_config.max_concurrency, transfer_config.multipart_chunksize)
+        return download.verification
+    callback = progress.file_callback(file_key, file_size) if progress is not None else None
+    s3.download_file(
+        bucket_name,
+        file_key,
+        local_path,
+        Callback=callback,
+        Config=transfer_config
+    )
+    if callback is not None:
+        callback.finished()
+    return None
+
+def download_file_verified(*args, attempts=VERIFY_ATTEMPTS, **kwargs):
+    """
+    download_file with verification, retried while the downloaded bytes do
+    not match the object.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            record = download_file(*args, verify=True, **kwargs)
+        except (VerificationError, FlexibleChecksumError) as e:
+            if attempt == attempts:
+                raise
+            console.print(f"\n[yellow]{e}; downloading it again ({attempt}/{attempts - 1}).[/yellow]")
+            continue
+        if record is not None:
+            record['attempts'] = attempt
+        return record
+
+def download_rows(file_keys, catalog):
+    """
+    Returns the (size, key, etag) rows of the keys from the listing catalog,
+    largest first.
+    """
+    rows = []
+    for file_key in file_keys:
+        position = catalog.index(file_key)
+        if position >= 0:
+            rows.append((catalog.sizes[position], file_key, catalog.etags[position]))
+        else:
+            rows.append((0, file_key, ''))
+    rows.sort(reverse=True)
+    return rows
+
+def group_duplicates(rows):
+    """
+    Splits download rows into the rows to fetch and, per fetched key, the
+    keys with the same ETag and size, whose bytes are therefore the same.
+    Rows without an ETag are always fetched.
+    """
+    unique_rows = []
+    duplicates = {}
+    first_keys = {}
+    for row in rows:
+        file_size, file_key, etag = row
+        if not etag:
+            unique_rows.append(row)
+            continue
+        first_key = first_keys.setdefault((etag, file_size), file_key)
+        if first_key == file_key:
+            unique_rows.append(row)
+        else:
+            duplicates.setdefault(first_key, []).append(file_key)
+    return unique_rows, duplicates
+
+def reflink_file(source_path, target_path):
+    import fcntl
+    with open(source_path, 'rb') as source_file, open(target_path, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+def copy_duplicate(source_path, target_path, mode=DEFAULT_DEDUP_MODE, allow_hardlink=True):
+    """
+    Creates target_path with the bytes of the downloaded source_path: as a
+    hardlink or reflink when the mode and the file system allow it,
+    otherwise as a plain copy. The file is created next to the target and
+    renamed into place. Returns the method used.
+    """
+    import shutil
+    methods = {
+        'auto': ('reflink', 'copy'),
+        'reflink': ('reflink', 'copy'),
+        'hardlink': ('hardlink', 'copy') if allow_hardlink else ('copy',),
+        'copy': ('copy',),
+    }[mode]
+    temp_path = target_path + DUPLICATE_SUFFIX
+    try:
+        for method in methods:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            try:
+                if method == 'hardlink':
+                    os.link(source_path, temp_path)
+                elif method == 'reflink':
+                    reflink_file(source_path, temp_path)
+                else:
+                    shutil.copyfile(source_path, temp_path)
+            except (ImportError, OSError):
+                if method == methods[-1]:
+                    raise
+                continue
+            os.replace(temp_path, target_path)
+            return method
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+
+def download_files(s3, bucket_name, file_keys, download_dir, catalog, settings=None, resume_threshold=None,
+                   manifest=None, dedup=DEFAULT_DEDUP_MODE):
+    """
+    Downloads the given keys concurrently through one shared client, largest
+    objects first so they do not end up as stragglers. Sizes and ETags come
+    from the listing catalog, so no extra request is made per file. Objects
+    of at least resume_threshold bytes are downloaded resumably. Objects
+    below the multipart threshold take the get_object fast path on their
+    own pool of threads: each of them holds a single connection instead of
+    the max_concurrency a large file can use, so as many of them run at
+    once as the connection pool allows. Progress is shown as one
+    aggregate bar. Keys with the same ETag and size are fetched once, and
+    the other copies created locally as the dedup mode says. With a
+    VerificationManifest, every file is verified as it is written and its
+    result added to the manifest. Returns the list of (key, error) pairs
+    for the files that could not be downloaded.
+    """
+    all_rows = download_rows(file_keys, catalog)
+    if dedup == 'off':
+        rows, duplicates = all_rows, {}
+    else:
+        rows, duplicates = group_duplicates(all_rows)
+    settings = settings or TransferSettings()
+    transfer_config = settings.transfer_config()
+    small_object_size = settings.multipart_threshold
+    cancel_event = threading.Event()
+    failures = []
+    futures = {}
+    copy_futures = {}
+    progress = TransferProgress(sum(row[0] for row in rows), len(rows))
+    for local_dir in {os.path.dirname(local_file_path(download_dir, row[1])) for row in all_rows}:
+        os.makedirs(local_dir, exist_ok=True)
+    executor = ThreadPoolExecutor(max_workers=max(1, settings.workers))
+    small_executor = ThreadPoolExecutor(max_workers=max(1, settings.workers * settings.max_concurrency))
+    download = download_file if manifest is None else download_file_verified
+    try:
+        for file_size, file_key, etag in rows:
+            is_small = file_size < small_object_size
+            future = (small_executor if is_small else executor).submit(
+                download, s3, bucket_name, file_key, file_size, download_dir, transfer_config,
+                etag, resume_threshold, cancel_event, progress, small_object_size
+            )
+            futures[future] = file_key
+        for future in as_completed(futures):
+            file_key = futures[future]
+            try:
+                record = future.result()
+                if manifest is not None and record is not None:
+                    manifest.add(dict(record, path=local_file_path(download_dir, file_key)))
+            except Exception as e:
+                failures.append((file_key, e))
+                if manifest is not None:
+                    manifest.add_failure(file_key, e)
+                console.print(
+                    f"\n[red]Error downloading {file_key}: {e}[/red]"
+                )
+                for duplicate_key in duplicates.get(file_key, ()):
+                    failures.append((duplicate_key, IOError(f"{file_key}, which has the same content, failed: {e}")))
+                continue
+            source_path = local_file_path(download_dir, file_key)
+            last_modified = catalog.last_modified[catalog.index(file_key)]
+            for duplicate_key in duplicates.get(file_key, ()):
+                # Hardlinks share one mtime, so only keys with the same
+                # LastModified are linked; the sync state needs both.
+                allow_hardlink = catalog.last_modified[catalog.index(duplicate_key)] == last_modified
+                copy_future = small_executor.submit(
+                    copy_duplicate, source_path, local_file_path(download_dir, duplicate_key), dedup, allow_hardlink
+                )
+                copy_futures[copy_future] = (duplicate_key, file_key, record)
+        for future in as_completed(copy_futures):
+            duplicate_key, file_key, record = copy_futures[future]
+            try:
+                future.result()
+                if manifest is not None and record is not None:
+                    manifest.add(dict(
+                        record, key=duplicate_key, path=local_file_path(download_dir, duplicate_key), copy_of=file_key
+                    ))
+            except OSError as e:
+                failures.append((duplicate_key, e))
+                if manifest is not None:
+                    manifest.add_failure(duplicate_key, e)
+                console.print(f"\n[red]Error copying {file_key} to {duplicate_key}: {e}[/red]")
+        if copy_futures:
+            console.print(
+                f"\n[green]{len(copy_futures)} files had the same content as another selected file "
+                f"and were created locally instead of downloaded.[/green]"
+            )
+    except KeyboardInterrupt:
+        # Stop queued files and let resumable downloads finish the range they
+        # are writing, so their manifests stay accurate for the next run.
+        cancel_event.set()
+        for future in itertools.chain(futures, copy_futures):
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        small_executor.shutdown(wait=True)
+        progress.close()
+    return failures
+
+def archive_format_for(path, archive_format=None):
+    """
+    Returns the archive format given, or the one of the path's extension
+    (plain tar for stdout and unknown extensions).
+    """
+    if archive_format:
+        return archive_format
+    lowered = path.lower()
+    for extension, extension_format in ARCHIVE_EXTENSIONS:
+        if lowered.endswith(extension):
+            return extension_format
+    return 'tar'
+
+class ChunkReader:
+    """
+    Read-only file over an iterator of byte chunks, for tarfile.addfile.
+    Reads slice the current chunk through a memoryview, so tarfile's small
+    reads do not copy the rest of a large chunk each time.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+        self._offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._chunk = memoryview(chunk)
+                self._offset = 0
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            parts.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+class ArchiveWriter:
+    """
+    Writes entries to a tar (optionally compressed) or zip archive in
+    stream mode, so the output can be a pipe and is written sequentially.
+    """
+    def __init__(self, fileobj, archive_format='tar'):
+        self.archive_format = archive_format
+        self._tar = None
+        self._zip = None
+        if archive_format == 'zip':
+            import zipfile
+            self._zipfile = zipfile
+            self._zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            import tarfile
+            self._tarfile = tarfile
+            self._tar = tarfile.open(fileobj=fileobj, mode=ARCHIVE_FORMATS[archive_format])
+
+    def add(self, name, size, mtime, chunks):
+        """
+        Adds one entry of size bytes from an iterator of chunks.
+        """
+        name = name.lstrip('/')
+        if self._zip is not None:
+            # Zip timestamps start in 1980.
+            info = self._zipfile.ZipInfo(name, date_time=time.localtime(max(mtime, 315532800))[:6])
+            info.compress_type = self._zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            info.file_size = size
+            with self._zip.open(info, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+        else:
+            info = self._tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            self._tar.addfile(info, ChunkReader(chunks))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+
+def open_archive_output(path):
+    """
+    Opens the archive destination with a large write buffer; '-' is stdout.
+    """
+    if path == '-':
+        return open(sys.stdout.fileno(), 'wb', buffering=ARCHIVE_WRITE_BUFFER, closefd=False)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    return open(path, 'wb', buffering=ARCHIVE_WRITE_BUFFER)
+
+def fetch_object(s3, bucket_name, file_key, etag='', byte_range=None):
+    """
+    Returns the bytes of an object, or of the [start, end) byte range of it,
+    checked against the listed ETag.
+    """
+    request = {'Bucket': bucket_name, 'Key': file_key}
+    if etag:
+        request['IfMatch'] = etag
+    if byte_range is not None:
+        request['Range'] = f'bytes={byte_range[0]}-{byte_range[1] - 1}'
+    body = s3.get_object(**request)['Body']
+    try:
+        data = body.read()
+    finally:
+        body.close()
+    if byte_range is not None and len(data) != byte_range[1] - byte_range[0]:
+        raise IOError(f"{file_key}: expected {byte_range[1] - byte_range[0]} bytes, got {len(data)}")
+    return data
+
+def iter_object_chunks(s3, bucket_name, file_key, file_size, etag, executor, part_size, max_parts):
+    """
+    Yields the bytes of a large object in order, fetched as ranged GETs with
+    at most max_parts of them in flight or waiting to be written.
+    """
+    ranges = ((start, min(file_size, start + part_size)) for start in range(0, file_size, part_size))
+    pending = collections.deque(
+        executor.submit(fetch_object, s3, bucket_name, file_key, etag, byte_range)
+        for byte_range in itertools.islice(ranges, max_parts)
+    )
+    try:
+        while pending:
+            data = pending.popleft().result()
+            byte_range = next(ranges, None)
+            if byte_range is not None:
+                pending.append(executor.submit(fetch_object, s3, bucket_name, file_key, etag, byte_range))
+            yield data
+    finally:
+        for future in pending:
+            future.cancel()
+
+def iter_with_progress(chunks, callback):
+    for chunk in chunks:
+        callback(len(chunk))
+        yield chunk
+
+def stream_archive(s3, bucket_name, file_keys, catalog, output, archive_format='tar', settings=None):
+    """
+    Streams the given keys into one archive written to output, without
+    staging anything on disk. Objects below the multipart threshold are
+    fetched in parallel and added in the order they arrive, with at most
+    ARCHIVE_BUFFER_BYTES of them held in memory; larger objects follow, one
+    at a time, fetched as max_concurrency ranged parts in flight. Returns
+    the (key, error) pairs of the small objects that could not be fetched;
+    a large object that fails part-way aborts the archive with its error,
+    since its entry header is already written.
+    """
+    settings = settings or TransferSettings()
+    rows = []
+    for file_key in file_keys:
+        position = catalog.index(file_key)
+        if position >= 0:
+            rows.append((catalog.sizes[position], file_key, catalog.etags[position], catalog.last_modified[position]))
+        else:
+            rows.append((0, file_key, '', 0.0))
+    small = [row for row in rows if row[0] < settings.multipart_threshold]
+    large = [row for row in rows if row[0] >= settings.multipart_threshold]
+    failures = []
+    progress = TransferProgress(sum(row[0] for row in rows), len(rows))
+    executor = ThreadPoolExecutor(max_workers=max(1, settings.workers * settings.max_concurrency))
+    archive = ArchiveWriter(output, archive_format)
+    pending = {}
+    try:
+        queued = iter(small)
+        buffered = 0
+        while True:
+            while not pending or buffered < ARCHIVE_BUFFER_BYTES:
+                row = next(queued, None)
+                if row is None:
+                    break
+                future = executor.submit(fetch_object, s3, bucket_name, row[1], row[2])
+                pending[future] = row
+                buffered += row[0]
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_size, file_key, _, mtime = pending.pop(future)
+                buffered -= file_size
+                try:
+                    data = future.result()
+                except Exception as e:
+                    failures.append((file_key, e))
+                    console.print(f"\n[red]Error downloading {file_key}: {e}[/red]")
+                    continue
+                archive.add(file_key, len(data), mtime, (data,))
+                callback = progress.file_callback(file_key, file_size)
+                callback(len(data))
+                callback.finished()
+        for file_size, file_key, etag, mtime in large:
+            callback = progress.file_callback(file_key, file_size)
+            chunks = iter_object_chunks(
+                s3, bucket_name, file_key, file_size, etag, executor,
+                settings.multipart_chunksize, settings.max_concurrency
+            )
+            archive.add(file_key, file_size, mtime, iter_with_progress(chunks, callback))
+            callback.finished()
+        archive.close()
+        output.flush()
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        progress.close()
+    return failures
+
+def write_archive(s3, bucket_name, file_keys, catalog, path, archive_format=None, settings=None):
+    """
+    Streams the keys into the archive at path ('-' for stdout). A partial
+    archive file is removed when the archive can not be completed.
+    """
+    archive_format = archive_format_for(path, archive_format)
+    output = open_archive_output(path)
+    try:
+        return stream_archive(s3, bucket_name, file_keys, catalog, output, archive_format, settings)
+    except BaseException:
+        if path != '-':
+            output.close()
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        if not output.closed:
+            output.close()
+
+def local_file_path(download_dir, file_key):
+    return os.path.normpath(os.path.join(download_dir, file_key))
+
+def scan_local_files(local_paths):
+    """
+    Returns {path: (size, mtime_ns)} for the given paths that exist, reading
+    each directory once with os.scandir instead of checking every path.
+    """
+    wanted = {}
+    for path in local_paths:
+        directory, name = os.path.split(path)
+        wanted.setdefault(directory, set()).add(name)
+    found = {}
+    for directory, names in wanted.items():
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in names and entry.is_file():
+                        stat = entry.stat()
+                        found[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return found
+
+def plan_sync(bucket_name, file_keys, download_dir, catalog, sync_state):
+    """
+    Splits the keys into (to_download, up_to_date). A local file is up to
+    date when its size and mtime are the ones recorded in the sync state
+    for the same object version, or, for files the state does not know,
+    when its size and mtime match the object's size and LastModified.
+    """
+    local_paths = {file_key: local_file_path(download_dir, file_key) for file_key in file_keys}
+    local_files = scan_local_files(local_paths.values())
+    recorded = sync_state.load(download_dir) if sync_state is not None else {}
+    to_download = []
+    up_to_date = []
+    for file_key, local_path in local_paths.items():
+        position = catalog.index(file_key)
+        local_file = local_files.get(local_path)
+        if position < 0 or local_file is None or local_file[0] != catalog.sizes[position]:
+            to_download.append(file_key)
+            continue
+        state = recorded.get(local_path)
+        if state is not None:
+            current = (bucket_name, file_key, catalog.etags[position], catalog.sizes[position], local_file[1])
+            unchanged = state == current
+        else:
+            unchanged = abs(local_file[1] / 1e9 - catalog.last_modified[position]) < 1
+        (up_to_date if unchanged else to_download).append(file_key)
+    return to_download, up_to_date
+
+def record_sync(bucket_name, file_keys, download_dir, catalog, sync_state):
+    """
+    Sets the mtime of freshly downloaded files to their LastModified time
+    and records them in the sync state in one transaction.
+    """
+    rows = []
+    for file_key in file_keys:
+        position = catalog.index(file_key)
+        local_path = local_file_path(download_dir, file_key)
+        if position < 0 or not os.path.exists(local_path):
+            continue
+        last_modified = catalog.last_modified[position]
+        os.utime(local_path, (last_modified, last_modified))
+        rows.append((
+            local_path, bucket_name, file_key, catalog.etags[position],
+            catalog.sizes[position], os.stat(local_path).st_mtime_ns
+        ))
+    if sync_state is not None:
+        sync_state.record(rows)
+
+def iter_listing_pages(s3, bucket_name, prefix='', start_after='', delimiter=None):
+    paginator = s3.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'StartAfter': start_after}
+    if delimiter:
+        params['Delimiter'] = delimiter
+    return iter(paginator.paginate(**params))
+
+def iter_page_catalogs(pages):
+    for page in pages:
+        catalog = ObjectCatalog()
+        catalog.add_listing_page(page)
+        yield catalog
+
+def iter_serial_listing(s3, bucket_name, prefix='', start_after='', show_progress=True):
+    """
+    Yields one catalog per listing page, in key order.
+    """
+    with alive_progress.alive_bar(bar='bubbles', disable=not show_progress) as bar:
+        for catalog in iter_page_catalogs(iter_listing_pages(s3, bucket_name, prefix, start_after)):
+            yield catalog
+            bar()
+
+def list_objects_serial(s3, bucket_name, prefix='', start_after='', show_progress=True):
+    return concat_catalogs(iter_serial_listing(s3, bucket_name, prefix, start_after, show_progress))
+
+def concat_catalogs(segments):
+    catalog = ObjectCatalog()
+    for segment in segments:
+        catalog.extend(segment)
+    return catalog
+
+def list_delimited_level(s3, bucket_name, prefix):
+    """
+    Lists one level below the prefix with Delimiter='/'. Returns the objects
+    stored directly at that level and the sub-prefixes found there.
+    """
+    catalog = ObjectCatalog()
+    sub_prefixes = []
+    for page in iter_listing_pages(s3, bucket_name, prefix, delimiter='/'):
+        catalog.add_listing_page(page)
+        sub_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', ()))
+    return catalog, sub_prefixes
+
+def iter_sharded_listing(s3, bucket_name, prefix='', max_workers=DEFAULT_LIST_WORKERS, shard_depth=1, show_progress=True):
+    """
+    Splits the listing into shards at the '/' prefixes found up to
+    shard_depth levels below the prefix and lists the shards concurrently.
+
+    Yields catalogs that, concatenated, hold the same keys in the same order
+    as a serial listing. Every key of a shard starts with its prefix and no
+    loose object found during discovery does, so each loose object sorts
+    entirely before or after a shard and can be slotted in between shards.
+    """
+    loose_objects = ObjectCatalog()
+    shard_prefixes = [prefix]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for _ in range(max(1, shard_depth)):
+            next_prefixes = []
+            for level_objects, sub_prefixes in executor.map(
+                lambda p: list_delimited_level(s3, bucket_name, p), shard_prefixes
+            ):
+                loose_objects.extend(level_objects)
+                next_prefixes.extend(sub_prefixes)
+            shard_prefixes = next_prefixes
+            if not shard_prefixes:
+                break
+        loose_objects.sort()
+
+        progress_lock = threading.Lock()
+        active_shards = {}
+
+        with alive_progress.alive_bar(len(shard_prefixes), bar='bubbles', title='Shards', disable=not show_progress) as bar:
+            def list_shard(shard_prefix):
+                catalog = ObjectCatalog()
+                for page in iter_listing_pages(s3, bucket_name, shard_prefix):
+                    catalog.add_listing_page(page)
+                    with progress_lock:
+                        active_shards[shard_prefix] = active_shards.get(shard_prefix, 0) + 1
+                        bar.text(
+                            ', '.join(f"{p} ({pages} pages)" for p, pages in list(active_shards.items())[-3:])
+                        )
+                with progress_lock:
+                    active_shards.pop(shard_prefix, None)
+                    bar()
+                return catalog
+
+            # Shard prefixes are discovered in key order and map() returns
+            # results in submission order, so shards come back sorted.
+            loose_position = 0
+            for shard in executor.map(list_shard, shard_prefixes):
+                if not len(shard):
+                    continue
+                next_position = bisect.bisect_left(loose_objects.keys, shard.keys[0], loose_position)
+                if next_position > loose_position:
+                    yield loose_objects.slice(loose_position, next_position)
+                yield shard
+                loose_position = next_position
+            if loose_position < len(loose_objects):
+                yield loose_objects.slice(loose_position, len(loose_objects))
+
+def list_objects_sharded(s3, bucket_name, prefix='', max_workers=DEFAULT_LIST_WORKERS, shard_depth=1, show_progress=True):
+    return concat_catalogs(
+        iter_sharded_listing(s3, bucket_name, prefix, max_workers, shard_depth, show_progress)
+    )
+
+def iter_bucket_listing(s3, bucket_name, args, prefix='', show_progress=True, clients=None):
+    """
+    Yields the listing of a bucket as a sequence of catalogs in key order,
+    using the listing mode selected on the command line. clients, the
+    session's S3ClientCache, gives an S3 Inventory the client of its
+    destination bucket's region.
+    """
+    if args.inventory:
+        return iter_inventory_listing(s3, bucket_name, args, prefix, show_progress, clients)
+    if args.parallel_listing:
+        return iter_sharded_listing(
+            s3, bucket_name, prefix, args.list_workers, args.shard_depth, show_progress
+        )
+    return iter_serial_listing(s3, bucket_name, prefix, show_progress=show_progress)
+
+def list_bucket(s3, bucket_name, args, prefix='', show_progress=True, clients=None):
+    catalog = concat_catalogs(iter_bucket_listing(s3, bucket_name, args, prefix, show_progress, clients))
+    catalog.sort()
+    return catalog
+
+def list_new_objects(s3, bucket_name, catalog, prefix='', show_progress=True):
+    """
+    Quick refresh for append-only buckets: lists only the keys that sort
+    after the last cached key and appends them to a copy of the catalog.
+    """
+    start_after = catalog.keys[-1] if len(catalog) else ''
+    new_objects = list_objects_serial(s3, bucket_name, prefix, start_after, show_progress)
+    refreshed = catalog.copy()
+    refreshed.extend(new_objects)
+    refreshed.sort()
+    return refreshed
+
+class InventoryError(ValueError):
+    """
+    An S3 Inventory manifest or data file that can not be used.
+    """
+
+_inventory_minutes = {}
+
+def inventory_timestamp(value):
+    """
+    Returns the epoch seconds of an inventory LastModifiedDate such as
+    2024-10-01T12:34:56.000Z. The start of each minute is computed once.
+    """
+    if not value:
+        return 0.0
+    minute = _inventory_minutes.get(value[:16])
+    if minute is None:
+        import calendar
+        if len(_inventory_minutes) > 1000000:
+            _inventory_minutes.clear()
+        minute = _inventory_minutes[value[:16]] = calendar.timegm(time.strptime(value[:16], '%Y-%m-%dT%H:%M'))
+    return minute + float(value[17:].rstrip('Z') or 0)
+
+class InventoryManifest:
+    """
+    An S3 Inventory delivery: its manifest.json and the data files it lists,
+    read from the inventory's destination bucket or from a local copy of it.
+    The location is the manifest itself or its configuration folder, where
+    the latest dated manifest is used. Data files are CSV (gzip), or ORC and
+    Parquet when pyarrow is installed; each is read into a catalog. With
+    clients, the session's S3ClientCache, the manifest and data files are
+    read through a client of the region of the bucket holding them, which
+    need not be the source bucket's.
+    """
+    def __init__(self, s3, location, clients=None):
+        self._s3 = s3
+        self._clients = clients
+        self._local_dir = None
+        self._data_s3 = None
+        if location.startswith('s3://'):
+            bucket, _, key = location[len('s3://'):].partition('/')
+            s3 = self._client_of(bucket)
+            if not key.endswith('manifest.json'):
+                key = self._latest_s3_manifest(s3, bucket, key)
+            manifest = json.load(s3.get_object(Bucket=bucket, Key=key)['Body'])
+            self.location = f"s3://{bucket}/{key}"
+        else:
+            path = os.path.abspath(os.path.expanduser(location))
+            if os.path.isdir(path):
+                path = self._latest_local_manifest(path)
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.location = path
+            self._local_dir = os.path.dirname(path)
+            bucket = ''
+        if 'files' not in manifest:
+            raise InventoryError(f"{self.location} is not an S3 Inventory manifest")
+        self.source_bucket = manifest.get('sourceBucket', '')
+        self.file_format = manifest.get('fileFormat', 'CSV')
+        self.schema = manifest.get('fileSchema', '')
+        self.files = [entry['key'] for entry in manifest['files']]
+        self.created = int(manifest.get('creationTimestamp', 0)) / 1000
+        # The destination is a bucket ARN (arn:aws:s3:::bucket).
+        self._data_bucket = manifest.get('destinationBucket', '').rsplit(':', 1)[-1] or bucket
+        if self._local_dir is None:
+            self._data_s3 = s3 if self._data_bucket == bucket else self._client_of(self._data_bucket)
+
+    def _client_of(self, bucket):
+        if self._clients is None:
+            return self._s3
+        try:
+            return self._clients.head_bucket(bucket)
+        except ClientError:
+            # Reading an inventory needs GetObject only; S3 reports the
+            # bucket's region on a denied head_bucket too.
+            return self._clients.client(self._clients.region_of(bucket))
+
+    @staticmethod
+    def _latest_s3_manifest(s3, bucket, prefix):
+        prefix = prefix.rstrip('/') + '/' if prefix else ''
+        _, sub_prefixes = list_delimited_level(s3, bucket, prefix)
+        dated = [p for p in sub_prefixes if INVENTORY_DATE_PATTERN.match(p[len(prefix):].rstrip('/'))]
+        if not dated:
+            raise InventoryError(f"no dated inventory manifest under s3://{bucket}/{prefix}")
+        return max(dated) + 'manifest.json'
+
+    @staticmethod
+    def _latest_local_manifest(path):
+        dated = [
+            name for name in os.listdir(path)
+            if INVENTORY_DATE_PATTERN.match(name) and os.path.exists(os.path.join(path, name, 'manifest.json'))
+        ]
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            return os.path.join(path, 'manifest.json')
+        if not dated:
+            raise InventoryError(f"no inventory manifest in {path}")
+        return os.path.join(path, max(dated), 'manifest.json')
+
+    def _local_file(self, key):
+        # A local copy keeps the tail of the destination keys
+        # (config/data/....csv.gz) next to or above the dated folders.
+        parts = key.split('/')
+        directory = self._local_dir
+        while True:
+            for start in range(len(parts)):
+                candidate = os.path.join(directory, *parts[start:])
+                if os.path.exists(candidate):
+                    return candidate
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                raise InventoryError(f"inventory data file {key} not found near {self.location}")
+            directory = parent
+
+    def open(self, key):
+        if self._local_dir is not None:
+            return open(self._local_file(key), 'rb')
+        return self._data_s3.get_object(Bucket=self._data_bucket, Key=key)['Body']
+
+    def read(self, key, prefix=''):
+        """
+        Returns the catalog of the current, non-deleted objects under the
+        prefix in one data file.
+        """
+        data_file = self.open(key)
+        try:
+            if self.file_format == 'CSV':
+                return self._read_csv(data_file, prefix)
+            if self.file_format in ('ORC', 'Parquet'):
+                return self._read_columnar(data_file, prefix)
+            raise InventoryError(f"unsupported inventory format {self.file_format}")
+        finally:
+            data_file.close()
+
+    def _read_csv(self, data_file, prefix):
+        import csv
+        import gzip
+        import io
+        from urllib.parse import unquote_plus
+        fields = [field.strip() for field in self.schema.split(',')]
+        if 'Key' not in fields:
+            raise InventoryError(f"the inventory schema has no Key field: {self.schema}")
+        at = {field: fields.index(field) for field in INVENTORY_FIELDS if field in fields}
+        key_at = at['Key']
+        size_at = at.get('Size')
+        etag_at = at.get('ETag')
+        modified_at = at.get('LastModifiedDate')
+        class_at = at.get('StorageClass')
+        latest_at = at.get('IsLatest')
+        deleted_at = at.get('IsDeleteMarker')
+        # The columns are built directly, as add() per row costs more than
+        # parsing the row.
+        catalog = ObjectCatalog()
+        keys = []
+        sizes = array('q')
+        etags = []
+        last_modified = array('d')
+        storage_classes = array('B')
+        storage_class_id = catalog._storage_class_id
+        rows = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=data_file), encoding='utf-8', newline=''))
+        for row in rows:
+            # Keys are URL-encoded in CSV inventories.
+            key = row[key_at]
+            if '%' in key or '+' in key:
+                key = unquote_plus(key)
+            if not key.startswith(prefix) or key.endswith('/'):
+                continue
+            if latest_at is not None and row[latest_at] == 'false':
+                continue
+            if deleted_at is not None and row[deleted_at] == 'true':
+                continue
+            keys.append(key)
+            sizes.append(int(row[size_at] or 0) if size_at is not None else 0)
+            etags.append(row[etag_at] if etag_at is not None else '')
+            last_modified.append(inventory_timestamp(row[modified_at]) if modified_at is not None else 0.0)
+            storage_classes.append(storage_class_id((row[class_at] if class_at is not None else '') or 'STANDARD'))
+        catalog.keys = keys
+        catalog.sizes = sizes
+        catalog.etags = etags
+        catalog.last_modified = last_modified
+        catalog.storage_classes = storage_classes
+        catalog._sorted = all(previous <= key for previous, key in zip(keys, itertools.islice(keys, 1, None)))
+        return catalog
+
+    def _read_columnar(self, data_file, prefix):
+        try:
+            import pyarrow
+            if self.file_format == 'Parquet':
+                import pyarrow.parquet as pyarrow_parquet
+            else:
+                import pyarrow.orc as pyarrow_orc
+        except ImportError:
+            raise InventoryError(f"{self.file_format} inventories need the pyarrow package (pip install pyarrow)")
+        # ORC and Parquet footers are read first, so the file is buffered.
+        source = pyarrow.BufferReader(data_file.read())
+        if self.file_format == 'Parquet':
+            reader = pyarrow_parquet.ParquetFile(source)
+            names = reader.schema_arrow.names
+        else:
+            reader = pyarrow_orc.ORCFile(source)
+            names = reader.schema.names
+        columns = [name for name in INVENTORY_FIELDS.values() if name in names]
+        if 'key' not in columns:
+            raise InventoryError(f"the inventory has no key column: {', '.join(names)}")
+        table = reader.read(columns=columns)
+        rows = table.num_rows
+
+        def column(name, default):
+            if name not in columns:
+                return itertools.repeat(default, rows)
+            return table.column(name).to_pylist()
+
+        last_modified = itertools.repeat(0.0, rows)
+        if 'last_modified_date' in columns:
+            values = table.column('last_modified_date')
+            scale = {'s': 1, 'ms': 1e3, 'us': 1e6, 'ns': 1e9}[values.type.unit]
+            last_modified = ((value or 0) / scale for value in values.cast(pyarrow.int64()).to_pylist())
+        catalog = ObjectCatalog()
+        for key, size, etag, modified, storage_class, is_latest, is_deleted in zip(
+            column('key', ''), column('size', 0), column('e_tag', ''), last_modified,
+            column('storage_class', 'STANDARD'), column('is_latest', True), column('is_delete_marker', False)
+        ):
+            if not key.startswith(prefix) or key.endswith('/') or is_latest is False or is_deleted:
+                continue
+            catalog.add(key, size or 0, etag or '', modified, storage_class or 'STANDARD')
+        return catalog
+
+def live_overlay_prefixes(live_prefixes, prefix=''):
+    """
+    Returns the prefixes listed live on top of an inventory listing of the
+    prefix: narrowed to it, sorted, and without nested ones.
+    """
+    overlay = []
+    for live_prefix in sorted(set(live_prefixes or ())):
+        if prefix.startswith(live_prefix):
+            live_prefix = prefix
+        elif not live_prefix.startswith(prefix):
+            continue
+        if overlay and live_prefix.startswith(overlay[-1]):
+            continue
+        overlay.append(live_prefix)
+    return overlay
 
-import site
-site_user_site = site.getusersitepackages()
-if site_user_site not in sys.path:
-    sys.path.append(site_user_site)
+def iter_inventory_listing(s3, bucket_name, args, prefix='', show_progress=True, clients=None):
+    """
+    Yields the listing of a bucket from its S3 Inventory instead of
+    list_objects_v2. The data files are read concurrently, narrowed to the
+    prefix, and merged into one sorted catalog. Keys under the
+    --inventory-live-prefix prefixes are listed live instead, so changes
+    made there since the inventory are seen; the segments still come out in
+    key order. A manifest of another bucket falls back to a live listing.
+    """
+    inventory = InventoryManifest(s3, args.inventory, clients)
+    if inventory.source_bucket != bucket_name:
+        console.print(
+            f"[yellow]{inventory.location} is the inventory of '{inventory.source_bucket}'; "
+            f"listing '{bucket_name}' live.[/yellow]"
+        )
+        if args.parallel_listing:
+            yield from iter_sharded_listing(s3, bucket_name, prefix, args.list_workers, args.shard_depth, show_progress)
+        else:
+            yield from iter_serial_listing(s3, bucket_name, prefix, show_progress=show_progress)
+        return
+    created = time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(inventory.created))
+    console.print(
+        f"[green]Reading the S3 Inventory of {created} ({len(inventory.files)} data files).[/green]"
+    )
+    parts = []
+    with ThreadPoolExecutor(max_workers=max(1, args.list_workers)) as executor, \
+            alive_progress.alive_bar(len(inventory.files), bar='bubbles', title='Inventory',
+                                     disable=not show_progress) as bar:
+        for part in executor.map(lambda key: inventory.read(key, prefix), inventory.files):
+            parts.append(part)
+            bar()
+    catalog = concat_catalogs(parts)
+    catalog.sort()
+    key_index = KeyIndex(catalog)
+    position = 0
+    for live_prefix in live_overlay_prefixes(args.inventory_live_prefix, prefix):
+        start, end = key_index.prefix_range(live_prefix)
+        if start > position:
+            yield catalog.slice(position, start)
+        yield from iter_serial_listing(s3, bucket_name, live_prefix, show_progress=show_progress)
+        position = end
+    if position == 0:
+        yield catalog
+    elif position < len(catalog):
+        yield catalog.slice(position, len(catalog))
 
-package_to_module = {
-    'boto3': 'boto3',
-    'questionary': 'questionary',
-    'colorama': 'colorama',
-    'tqdm': 'tqdm',
-    'rich': 'rich',
-    'alive-progress': 'alive_progress',
-    'prompt_toolkit': 'prompt_toolkit',
-}
+class ListingRefresh(threading.Thread):
+    """
+    Re-lists a bucket in the background while the cached listing is in use.
+    """
+    def __init__(self, s3, bucket_name, args, prefix, cache, account, clients=None):
+        super().__init__(daemon=True)
+        self._s3 = s3
+        self._clients = clients
+        self._bucket_name = bucket_name
+        self._args = args
+        self._prefix = prefix
+        self._cache = cache
+        self._account = account
+        self.catalog = None
+        self.error = None
 
-def check_and_install_dependencies():
-    import subprocess
-    missing_packages = []
-    for package_name, module_name in package_to_module.items():
+    def run(self):
         try:
-            __import__(module_name)
-        except ImportError:
-            missing_packages.append(package_name)
-    if missing_packages:
-        print("The following packages are required to run the script:")
-        for pkg in missing_packages:
-            print(f"- {pkg}")
-        install = input("Do you want to install the missing dependencies? [y/N]: ").strip().lower()
-        if install == 'y':
-            in_virtualenv = (
-                hasattr(sys, 'real_prefix') or
-                (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)
+            catalog = list_bucket(
+                self._s3, self._bucket_name, self._args, self._prefix, show_progress=False, clients=self._clients
             )
-            for pkg in missing_packages:
-                print(f"Installing {pkg}...")
-                try:
-                    if in_virtualenv:
-                        subprocess.check_call([sys.executable, "-m", "pip", "install", pkg])
-                    else:
-                        subprocess.check_call([sys.executable, "-m", "pip", "install", pkg, "--user"])
-                except subprocess.CalledProcessError as e:
-                    print(f"Error installing {pkg}: {e}")
-                    print("Could not install the dependency. The script cannot continue.")
-                    sys.exit(1)
-            for pkg in missing_packages:
-                module_name = package_to_module[pkg]
-                try:
-                    globals()[module_name] = __import__(module_name)
-                except ImportError as e:
-                    print(f"Error importing {module_name} after installation: {e}")
-                    print("The script cannot continue.")
-                    sys.exit(1)
-            print("Dependencies installed successfully. Continuing with the script...")
+            self._cache.store(self._account, self._bucket_name, self._prefix, catalog)
+            self.catalog = catalog
+        except Exception as e:
+            self.error = e
+
+class ListingStream(threading.Thread):
+    """
+    Consumes a listing in the background and appends every page to a live
+    catalog as it arrives, so files can be filtered and selected before the
+    listing is complete. With max_keys only that many objects are kept in
+    memory; the file count and extension statistics still cover every page.
+    """
+    def __init__(self, segments, max_keys=None, on_complete=None):
+        super().__init__(daemon=True)
+        self._segments = segments
+        self._max_keys = max_keys
+        self._on_complete = on_complete
+        self._lock = threading.Lock()
+        self._extension_stats = {}
+        self._stopped = threading.Event()
+        self.catalog = ObjectCatalog()
+        self.total_objects = 0
+        self.total_bytes = 0
+        self.truncated = False
+        self.error = None
+        self.first_results = threading.Event()
+
+    def run(self):
+        try:
+            for segment in self._segments:
+                if self._stopped.is_set():
+                    return
+                with self._lock:
+                    segment.extension_stats(self._extension_stats)
+                    self.total_objects += len(segment)
+                    self.total_bytes += segment.total_size()
+                keep = len(segment)
+                if self._max_keys is not None:
+                    keep = min(keep, max(0, self._max_keys - len(self.catalog)))
+                    if keep < len(segment):
+                        self.truncated = True
+                self.catalog.extend(segment, 0, keep)
+                if len(self.catalog):
+                    self.first_results.set()
+            if self._on_complete is not None and not self.truncated:
+                self._on_complete(self.catalog)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.first_results.set()
+
+    def stop(self):
+        self._stopped.set()
+
+    def extension_stats(self):
+        with self._lock:
+            return {ext: list(entry) for ext, entry in self._extension_stats.items()}
+
+def load_listing(s3, bucket_name, args, cache, account, prefix='', clients=None):
+    """
+    Returns (catalog, refresh, stream) for a bucket. A fresh cached listing
+    is used as is; a stale one is returned right away together with the
+    background ListingRefresh that replaces it. Without a cached listing the
+    bucket is listed by a ListingStream that fills the returned catalog as
+    pages arrive and caches it once complete.
+    """
+    if args.inventory:
+        # The inventory is a snapshot of its own date; caching it would
+        # pass it off as a fresh listing.
+        cache = None
+    if cache is not None:
+        cached = cache.load(account, bucket_name, prefix)
+        if cached is not None:
+            catalog, listed_at = cached
+            age = int(time.time() - listed_at)
+            console.print(f"[green]Loaded {len(catalog)} files from the listing cache ({age}s old).[/green]")
+            refresh = None
+            if cache.is_stale(listed_at):
+                console.print("[yellow]The cached listing is stale; refreshing it in the background.[/yellow]")
+                refresh = ListingRefresh(s3, bucket_name, args, prefix, cache, account, clients)
+                refresh.start()
+            return catalog, refresh, None
+    on_complete = None
+    if cache is not None:
+        on_complete = lambda catalog: cache.store(account, bucket_name, prefix, catalog)
+    stream = ListingStream(
+        iter_bucket_listing(s3, bucket_name, args, prefix, show_progress=False, clients=clients),
+        args.max_keys,
+        on_complete
+    )
+    stream.start()
+    return stream.catalog, None, stream
+
+class FilePicker:
+    """
+    Full-screen multi-select over any number of keys. Only the rows in the
+    visible window are rendered, the selection is a bytearray with one flag
+    per key, and typing narrows the list with an incremental,
+    case-insensitive substring search. 'Select all matching' and friends
+    act on the whole search result without creating a widget per key.
+    """
+    HEADER_LINES = 3
+    FOOTER_LINES = 2
+
+    def __init__(self, keys, catalog=None):
+        self.keys = keys
+        self.catalog = catalog
+        self.selected = bytearray(len(keys))
+        self.query = ''
+        self.matches = range(len(keys))
+        self.cursor = 0
+        self.top = 0
+        self._lower_keys = None
+
+    def search(self, query):
+        """
+        Narrows the matches to the keys containing query. When the query
+        extends the previous one only the previous matches are scanned.
+        """
+        if not query:
+            self.matches = range(len(self.keys))
         else:
-            print("Dependencies not installed. The script cannot continue.")
-            sys.exit(1)
+            if self._lower_keys is None:
+                self._lower_keys = [key.lower() for key in self.keys]
+            lower_keys = self._lower_keys
+            needle = query.lower()
+            if self.query and needle.startswith(self.query.lower()):
+                candidates = self.matches
+            else:
+                candidates = range(len(self.keys))
+            self.matches = array('I', (i for i in candidates if needle in lower_keys[i]))
+        self.query = query
+        self.cursor = 0
+        self.top = 0
 
-check_and_install_dependencies()
+    def set_matching(self, value):
+        if isinstance(self.matches, range) and len(self.matches) == len(self.keys):
+            self.selected = bytearray([value]) * len(self.keys)
+            return
+        selected = self.selected
+        for i in self.matches:
+            selected[i] = value
 
-import boto3
-import questionary
-from questionary import Choice
-import colorama
-from colorama import init
-from tqdm import tqdm
-from prompt_toolkit.history import InMemoryHistory
-from prompt_toolkit.styles import Style
-from rich.console import Console
-from rich.table import Table
-from rich import box
-from alive_progress import alive_bar
+    def invert_matching(self):
+        selected = self.selected
+        for i in self.matches:
+            selected[i] ^= 1
 
-import configparser
-from botocore.exceptions import ClientError
+    def toggle(self):
+        if len(self.matches):
+            self.selected[self.matches[self.cursor]] ^= 1
 
-init(autoreset=True)
-console = Console()
+    def move(self, offset):
+        if len(self.matches):
+            self.cursor = max(0, min(len(self.matches) - 1, self.cursor + offset))
 
-custom_style = Style([
-    ('qmark', 'fg:#E91E63 bold'),
-    ('answer', 'fg:#2196f3 bold'),
-    ('instruction', ''),
-    ('pointer', 'fg:#673ab7 bold'),
-    ('highlighted', 'fg:#03a9f4 bold'),
-    ('selected', 'fg:#f44336 bold'),
-    ('separator', 'fg:#cc5454'),
-    ('text', ''),
-])
+    def selected_keys(self):
+        return list(itertools.compress(self.keys, self.selected))
 
-def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
-
-class ProgressPercentage:
-    def __init__(self, client, bucket, key):
-        self._client = client
-        self._bucket = bucket
-        self._key = key
-        self._size = self._get_size()
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
-        self._tqdm = tqdm(
-            total=self._size,
-            unit='B',
-            unit_scale=True,
-            unit_divisor=1024,
-            desc=key,
-            leave=True
+    def _visible_rows(self, terminal_rows):
+        return max(1, terminal_rows - self.HEADER_LINES - self.FOOTER_LINES)
+
+    def render(self, terminal_rows):
+        rows = self._visible_rows(terminal_rows)
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + rows:
+            self.top = self.cursor - rows + 1
+        fragments = [
+            ('class:qmark', '? '),
+            ('class:question', 'Select the files to download '),
+            ('class:answer', f'{self.selected.count(1)} selected of {len(self.keys)}\n'),
+            ('', 'Search: '),
+            ('class:highlighted', self.query),
+            ('', f'  ({len(self.matches)} matching)\n\n'),
+        ]
+        for row in range(self.top, min(self.top + rows, len(self.matches))):
+            position = self.matches[row]
+            key = self.keys[position]
+            mark = '◉ ' if self.selected[position] else '○ '
+            size = f'  ({format_size(self.catalog.size_of(key))})' if self.catalog is not None else ''
+            if row == self.cursor:
+                fragments.append(('class:pointer', '» '))
+                fragments.append(('class:highlighted', mark + key))
+            else:
+                fragments.append(('', '  '))
+                fragments.append(('class:selected' if self.selected[position] else '', mark + key))
+            fragments.append(('', size + '\n'))
+        return fragments
+
+    def footer(self):
+        return [(
+            'class:instruction',
+            '↑/↓ PgUp/PgDn Home/End move, <space> toggle, type to search, '
+            '<esc> clear search\n<ctrl-a> select all matching, <ctrl-d> deselect all matching, '
+            '<ctrl-x> invert matching, <enter> confirm, <ctrl-c> cancel'
+        )]
+
+    def run(self):
+        """
+        Shows the picker and returns the selected keys in listing order.
+        Ctrl+C raises KeyboardInterrupt, like the questionary prompts.
+        """
+        from prompt_toolkit.application import Application, get_app
+        from prompt_toolkit.key_binding import KeyBindings
+        from prompt_toolkit.layout import FormattedTextControl, HSplit, Layout, Window
+
+        bindings = KeyBindings()
+
+        def page():
+            return self._visible_rows(get_app().output.get_size().rows)
+
+        @bindings.add('up')
+        def _(event):
+            self.move(-1)
+
+        @bindings.add('down')
+        def _(event):
+            self.move(1)
+
+        @bindings.add('pageup')
+        def _(event):
+            self.move(-page())
+
+        @bindings.add('pagedown')
+        def _(event):
+            self.move(page())
+
+        @bindings.add('home')
+        def _(event):
+            self.move(-len(self.matches))
+
+        @bindings.add('end')
+        def _(event):
+            self.move(len(self.matches))
+
+        @bindings.add(' ')
+        def _(event):
+            self.toggle()
+
+        @bindings.add('c-a')
+        def _(event):
+            self.set_matching(1)
+
+        @bindings.add('c-d')
+        def _(event):
+            self.set_matching(0)
+
+        @bindings.add('c-x')
+        def _(event):
+            self.invert_matching()
+
+        @bindings.add('backspace')
+        def _(event):
+            self.search(self.query[:-1])
+
+        @bindings.add('escape', eager=True)
+        def _(event):
+            self.search('')
+
+        @bindings.add('enter')
+        def _(event):
+            event.app.exit(result=self.selected_keys())
+
+        @bindings.add('c-c')
+        def _(event):
+            event.app.exit(exception=KeyboardInterrupt())
+
+        @bindings.add('<any>')
+        def _(event):
+            if event.data.isprintable():
+                self.search(self.query + event.data)
+
+        layout = Layout(HSplit([
+            Window(FormattedTextControl(lambda: self.render(get_app().output.get_size().rows))),
+            Window(FormattedTextControl(self.footer), height=self.FOOTER_LINES),
+        ]))
+        application = Application(
+            layout=layout, key_bindings=bindings, style=prompt_style(), full_screen=True
         )
+        return application.run()
 
-    def _get_size(self):
-        response = self._client.head_object(Bucket=self._bucket, Key=self._key)
-        return response['ContentLength']
+def build_extension_table(ext_stats):
+    sorted_ext_stats = sorted(
+        ext_stats.items(), key=lambda x: x[1][0], reverse=True
+    )
+    table = Table(box=box.SIMPLE_HEAVY)
+    table.add_column("Extension", justify="left", style="cyan", no_wrap=True)
+    table.add_column("Count", justify="right", style="magenta")
+    table.add_column("Size", justify="right", style="green")
+    for ext, (count, total_bytes) in sorted_ext_stats:
+        table.add_row(ext, str(count), format_size(total_bytes))
+    return table
 
-    def __call__(self, bytes_amount):
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            self._tqdm.update(bytes_amount)
-            if self._seen_so_far >= self._size:
-                self._tqdm.close()
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
+def explicit_transfer_settings(args):
+    """
+    Returns the names of the transfer settings given on the command line,
+    which --auto-tune leaves as they are.
+    """
+    explicit = {
+        name for name in ('workers', 'max_concurrency', 'multipart_threshold', 'multipart_chunksize')
+        if getattr(args, name) is not None
+    }
+    if args.tcp_keepalive:
+        explicit.add('tcp_keepalive')
+    return explicit
+
+def create_throttle_controller(args, settings):
+    if args.no_throttle_control:
+        return None
+    return ThrottleController(settings.pool_size(args.list_workers), args.max_attempts)
+
+def describe_throttling(controller):
+    """
+    Returns a line about the throttled requests seen by the controller, or
+    None when S3 did not throttle.
+    """
+    if controller is None:
+        return None
+    stats = controller.stats()
+    if not stats['throttled']:
+        return None
+    lowest = min(entry['limit'] for entry in stats['throttled_prefixes'].values())
+    return (
+        f"S3 throttled {stats['throttled']} of {stats['requests']} requests on "
+        f"{len(stats['throttled_prefixes'])} prefixes; {stats['retried']} retries, "
+        f"concurrency adapted down to {lowest} requests per prefix."
+    )
+
+def tune_download(bucket_name, file_keys, catalog, args, settings, s3, clients):
+    """
+    Returns the (client, settings, report) to download file_keys with: the
+    session client and settings, or with --auto-tune a client of the
+    session's S3ClientCache built for the tuned settings.
+    """
+    if not args.auto_tune or not file_keys:
+        return s3, settings, {}
+    try:
+        console.print("[green]Tuning transfer settings...[/green]")
+        tuned, report = auto_tune_settings(
+            bucket_name, file_keys, catalog, settings, explicit_transfer_settings(args), s3.meta.region_name,
+            clients
+        )
+    except (ClientError, BotoCoreError) as e:
+        console.print(f"[yellow]Auto-tune failed, using the configured settings: {e}[/yellow]")
+        return s3, settings, {}
+    console.print(f"[green]Auto-tuned: {tuned.describe()}.[/green]")
+    return clients.client_for(tuned, s3.meta.region_name), tuned, report
+
+def filter_pattern(value):
+    try:
+        regex, ignore_case = filter_to_regex(value)
+        re.compile(regex, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid pattern {value!r}: {e}")
+    return value
+
+def parse_args(argv=None):
+    # -h is handled by main() so the tool keeps its own help text.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-w', '--workers', type=positive_int, default=None)
+    parser.add_argument('--parallel-listing', action='store_true')
+    parser.add_argument('--list-workers', type=positive_int, default=DEFAULT_LIST_WORKERS)
+    parser.add_argument('--shard-depth', type=positive_int, default=1)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--cache-dir', default=default_cache_dir())
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL)
+    parser.add_argument('--cache-max-listings', type=positive_int, default=DEFAULT_CACHE_MAX_LISTINGS)
+    parser.add_argument('--max-keys', type=positive_int, default=None)
+    parser.add_argument('--resume-threshold', type=positive_int, default=DEFAULT_RESUME_THRESHOLD_MB)
+    parser.add_argument('--sync', action='store_true')
+    parser.add_argument('--max-concurrency', type=positive_int, default=None)
+    parser.add_argument('--multipart-threshold', type=positive_int, default=None)
+    parser.add_argument('--multipart-chunksize', type=positive_int, default=None)
+    parser.add_argument('--max-pool-connections', type=positive_int, default=None)
+    parser.add_argument('--tcp-keepalive', action='store_true')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT)
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT)
+    parser.add_argument('--auto-tune', action='store_true')
+    parser.add_argument('--no-throttle-control', action='store_true')
+    parser.add_argument('--max-attempts', type=positive_int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--metrics', default=None)
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'), default='json')
+    parser.add_argument('--profile', choices=METRICS_PHASES, default=None)
+    parser.add_argument('--archive', default=None)
+    parser.add_argument('--archive-format', choices=tuple(ARCHIVE_FORMATS), default=None)
+    parser.add_argument('--verify', action='store_true')
+    parser.add_argument('--verify-manifest', default=None)
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=DEFAULT_DEDUP_MODE)
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--bucket', default=None)
+    parser.add_argument('--dest', default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--identity-ttl', type=int, default=DEFAULT_IDENTITY_TTL)
+    parser.add_argument('--startup-check', action='store_true')
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET)
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--inventory', default=None)
+    parser.add_argument('--inventory-live-prefix', action='append', default=None)
+    parser.add_argument('--pattern', type=filter_pattern, default=None)
+    return parser.parse_args(argv)
 
 def configure_aws_credentials():
     access_key = questionary.text(
         "Enter your AWS Access Key ID:",
-        style=custom_style
+        style=prompt_style()
     ).ask().strip()
     secret_key = questionary.password(
         "Enter your AWS Secret Access Key:",
-        style=custom_style
+        style=prompt_style()
     ).ask().strip()
     profile_name = 'default'
     aws_credentials_dir = os.path.expanduser('~/.aws')
@@ -166,16 +3738,27 @@ def validate_bucket_name(bucket_name):
         return False
     return True
 
-def check_aws_credentials():
+def check_aws_credentials(identity_cache=None):
     try:
+        fingerprint = None
+        if identity_cache is not None:
+            fingerprint = credential_fingerprint()
+            identity = identity_cache.get(fingerprint)
+            if identity is not None:
+                return identity
         session = boto3.Session()
         credentials = session.get_credentials()
         if not credentials or not credentials.access_key or not credentials.secret_key:
             console.print("[red]AWS credentials are not configured.[/red]")
             return False
         sts = session.client('sts')
-        sts.get_caller_identity()
-        return True
+        identity = sts.get_caller_identity()
+        if identity_cache is not None:
+            try:
+                identity_cache.put(fingerprint, identity)
+            except OSError:
+                pass
+        return identity
     except ClientError as e:
         error_code = e.response['Error']['Code']
         if error_code in ['InvalidClientTokenId', 'SignatureDoesNotMatch', 'AccessDenied']:
@@ -188,31 +3771,406 @@ def check_aws_credentials():
         console.print(f"[red]An error occurred while checking AWS credentials: {e}[/red]")
         return False
 
+def create_identity_cache(args):
+    if args.identity_ttl <= 0:
+        return None
+    return IdentityCache(os.path.join(args.cache_dir, 'identity.json'), args.identity_ttl)
+
+def report_startup(budget, identity_seconds):
+    """
+    Prints the time from the start of the script to the first prompt as
+    JSON and returns 1 when it is over budget, so CI can catch startup
+    regressions.
+    """
+    # Load what the first prompt needs, as showing it would.
+    prompt_style()
+    importlib.import_module('questionary')
+    first_prompt_seconds = time.perf_counter() - STARTED_AT
+    print(json.dumps({
+        'first_prompt_seconds': round(first_prompt_seconds, 3),
+        'identity_check_seconds': round(identity_seconds, 3),
+        'budget_seconds': budget,
+        'within_budget': first_prompt_seconds <= budget,
+    }, indent=2))
+    return 0 if first_prompt_seconds <= budget else 1
+
+def open_listing(s3, bucket_name, args, cache, account, prefix='', clients=None):
+    """
+    load_listing for the interactive menus: waits for the first page of a
+    streamed listing and raises its error when nothing could be listed.
+    """
+    catalog, refresh, stream = load_listing(s3, bucket_name, args, cache, account, prefix, clients)
+    if stream is not None:
+        with console.status("[green]Waiting for the first listing page...[/green]"):
+            stream.first_results.wait()
+        if stream.error is not None and not len(catalog):
+            raise stream.error
+    return catalog, refresh, stream
+
+def batch_listing(s3, bucket_name, args, cache, account, prefix='', clients=None):
+    """
+    Returns the complete listing for a batch run: a fresh cached listing
+    when there is one, a new listing (stored in the cache) otherwise.
+    """
+    if args.inventory:
+        cache = None
+    if cache is not None:
+        cached = cache.load(account, bucket_name, prefix)
+        if cached is not None and not cache.is_stale(cached[1]):
+            return cached[0]
+    catalog = list_bucket(s3, bucket_name, args, prefix, show_progress=False, clients=clients)
+    if cache is not None:
+        cache.store(account, bucket_name, prefix, catalog)
+    return catalog
+
+def run_batch(args):
+    """
+    Non-interactive run for cron and CI: lists --bucket (narrowed by
+    --prefix and --pattern), downloads the matching files to --dest without
+    any prompt or screen redraw, and prints a JSON summary on stdout. Status
+    messages and progress bars go to stderr. Returns the exit status: 0 on
+    success, 1 when some files failed, 2 when nothing could be attempted.
+    """
+    console.file = sys.stderr
+    started = time.time()
+    metrics = create_session_metrics(args)
+    summary = {
+        'bucket': None,
+        'prefix': None,
+        'pattern': args.pattern,
+        'dry_run': args.dry_run,
+        'listed_objects': 0,
+        'selected_objects': 0,
+        'selected_bytes': 0,
+        'up_to_date_objects': 0,
+        'would_download_objects': 0,
+        'would_download_bytes': 0,
+        'downloaded_objects': 0,
+        'downloaded_bytes': 0,
+        'failed_objects': 0,
+        'failures': [],
+        'listing_seconds': 0.0,
+        'download_seconds': 0.0,
+        'elapsed_seconds': 0.0,
+        'throughput_bytes_per_second': 0.0,
+        'transfer_settings': None,
+        'auto_tune': {},
+        'archive': args.archive,
+        'error': None,
+    }
+
+    controller = None
+
+    def finish(status):
+        summary['elapsed_seconds'] = round(time.time() - started, 3)
+        if controller is not None:
+            summary['throttling'] = controller.stats()
+        # With --archive - stdout carries the archive.
+        print(json.dumps(summary, indent=2), file=sys.stderr if args.archive == '-' else sys.stdout)
+        return status
+
+    def run():
+        nonlocal controller
+        if not args.bucket:
+            summary['error'] = 'no bucket given (--bucket BUCKET[/PREFIX])'
+            return finish(2)
+        bucket_name, bucket_prefix = parse_bucket_entry(args.bucket)
+        bucket_prefix = listing_prefix(bucket_prefix or args.prefix, args.pattern)
+        summary['bucket'] = bucket_name
+        summary['prefix'] = bucket_prefix
+        if not validate_bucket_name(bucket_name):
+            summary['error'] = f"invalid bucket name '{bucket_name}'"
+            return finish(2)
+        with metrics.phase('identity'):
+            identity = check_aws_credentials(create_identity_cache(args))
+        if not identity:
+            summary['error'] = 'AWS credentials are not configured or invalid'
+            return finish(2)
+
+        cache = None
+        if not args.no_cache:
+            try:
+                cache = ListingCache(
+                    os.path.join(args.cache_dir, 'listings.sqlite3'), args.cache_ttl, args.cache_max_listings
+                )
+            except (OSError, sqlite3.Error) as e:
+                console.print(f"[yellow]The listing cache is not available: {e}[/yellow]")
+
+        settings = TransferSettings.from_args(args)
+        controller = create_throttle_controller(args, settings)
+        clients = S3ClientCache(settings, args.list_workers, controller, metrics)
+        try:
+            with metrics.phase('listing'):
+                s3 = clients.head_bucket(bucket_name)
+                listing_started = time.time()
+                catalog = batch_listing(
+                    s3, bucket_name, args, cache, identity.get('Account', ''), bucket_prefix, clients
+                )
+                summary['listing_seconds'] = round(time.time() - listing_started, 3)
+        except (ClientError, BotoCoreError, InventoryError, OSError) as e:
+            summary['error'] = f"could not list bucket '{bucket_name}': {e}"
+            return finish(2)
+        summary['listed_objects'] = len(catalog)
+
+        with metrics.phase('filter'):
+            if args.pattern:
+                positions = filter_positions(catalog, KeyIndex(catalog), args.pattern)
+            else:
+                positions = range(len(catalog))
+        selected_files = [catalog.keys[p] for p in positions]
+        summary['selected_objects'] = len(selected_files)
+        summary['selected_bytes'] = sum(catalog.sizes[p] for p in positions)
+
+        download_dir = os.path.abspath(args.dest or bucket_name)
+        files_to_download = selected_files
+        sync_state = None
+        if args.sync and args.archive:
+            console.print("[yellow]--sync compares local files and is ignored with --archive.[/yellow]")
+        elif args.sync:
+            try:
+                sync_state = SyncState(os.path.join(args.cache_dir, 'sync.sqlite3'))
+            except (OSError, sqlite3.Error) as e:
+                console.print(f"[yellow]The sync state is not available; comparing files by size and date only: {e}[/yellow]")
+            with metrics.phase('sync'):
+                files_to_download, up_to_date = plan_sync(bucket_name, selected_files, download_dir, catalog, sync_state)
+            summary['up_to_date_objects'] = len(up_to_date)
+
+        if args.dedup != 'off' and not args.archive:
+            _, duplicates = group_duplicates(download_rows(files_to_download, catalog))
+            duplicate_keys = [file_key for file_keys in duplicates.values() for file_key in file_keys]
+            summary['duplicate_objects'] = len(duplicate_keys)
+            summary['duplicate_bytes'] = sum(catalog.size_of(file_key) for file_key in duplicate_keys)
+
+        if args.dry_run:
+            summary['would_download_objects'] = len(files_to_download)
+            summary['would_download_bytes'] = sum(catalog.size_of(file_key) for file_key in files_to_download)
+            return finish(0)
+
+        if args.verify and args.archive:
+            console.print("[yellow]--verify checks downloaded files and is ignored with --archive.[/yellow]")
+        if not args.archive:
+            os.makedirs(download_dir, exist_ok=True)
+        with metrics.phase('download'):
+            download_s3, settings, summary['auto_tune'] = tune_download(
+                bucket_name, files_to_download, catalog, args, settings, s3, clients
+            )
+            summary['transfer_settings'] = settings.as_dict()
+            download_started = time.time()
+            if args.archive:
+                try:
+                    failures = write_archive(
+                        download_s3, bucket_name, files_to_download, catalog, args.archive,
+                        args.archive_format, settings
+                    )
+                except (ClientError, OSError) as e:
+                    summary['error'] = f"the archive could not be written: {e}"
+                    summary['failed_objects'] = len(files_to_download)
+                    return finish(1)
+            else:
+                manifest = create_verification_manifest(args, bucket_name, download_dir)
+                failures = download_files(
+                    download_s3, bucket_name, files_to_download, download_dir, catalog, settings,
+                    args.resume_threshold * 1024 * 1024, manifest, args.dedup
+                )
+                if manifest is not None:
+                    summary['verification'] = dict(manifest.counts(), manifest=manifest.path)
+                    try:
+                        manifest.write()
+                    except OSError as e:
+                        console.print(f"[red]The verification manifest could not be written: {e}[/red]")
+            download_seconds = time.time() - download_started
+        failed_keys = {file_key for file_key, _ in failures}
+        downloaded = [file_key for file_key in files_to_download if file_key not in failed_keys]
+        if args.sync and not args.archive:
+            try:
+                with metrics.phase('sync'):
+                    record_sync(bucket_name, downloaded, download_dir, catalog, sync_state)
+            except (OSError, sqlite3.Error) as e:
+                console.print(f"[red]The sync state could not be updated: {e}[/red]")
+        summary['downloaded_objects'] = len(downloaded)
+        summary['downloaded_bytes'] = sum(catalog.size_of(file_key) for file_key in downloaded)
+        summary['failed_objects'] = len(failures)
+        summary['failures'] = [{'key': file_key, 'error': str(e)} for file_key, e in failures]
+        summary['download_seconds'] = round(download_seconds, 3)
+        if download_seconds > 0:
+            summary['throughput_bytes_per_second'] = round(summary['downloaded_bytes'] / download_seconds, 1)
+        return finish(1 if failures else 0)
+
+    try:
+        return run()
+    except Exception as e:
+        # Cron and CI jobs read the summary, so an unexpected error ends in
+        # one too.
+        summary['error'] = f"unexpected error: {type(e).__name__}: {e}"
+        return finish(1 if summary['transfer_settings'] is not None else 2)
+
 def main():
     help_message = """
 Usage:
-    s3Fetch.py [-h]
+    s3Fetch.py [-h] [-w N] [--parallel-listing] [--list-workers N] [--shard-depth N]
+               [--no-cache] [--cache-dir DIR] [--cache-ttl SECONDS] [--cache-max-listings N]
+               [--max-keys N] [--resume-threshold MB] [--sync]
+               [--max-concurrency N] [--multipart-threshold MB] [--multipart-chunksize MB]
+               [--max-pool-connections N] [--tcp-keepalive] [--connect-timeout SECONDS]
+               [--read-timeout SECONDS] [--auto-tune] [--no-throttle-control] [--max-attempts N]
+               [--metrics FILE] [--metrics-format {json,prometheus}] [--profile PHASE]
+               [--archive PATH] [--archive-format FORMAT] [--verify] [--verify-manifest FILE]
+               [--dedup MODE]
+               [--identity-ttl SECONDS] [--startup-check] [--startup-budget SECONDS]
+               [--prefix PREFIX] [--pattern PATTERN]
+               [--inventory MANIFEST] [--inventory-live-prefix PREFIX]
+    s3Fetch.py --batch --bucket BUCKET[/PREFIX] [--dest DIR] [--dry-run] [options]
 
 Description:
     A tool to explore and download files from S3 buckets in a simplified way.
 
 Features:
-    - Connect to a user-specified S3 bucket.
-    - List files within the bucket.
-    - Filter files by pattern (regex) for precise selection.
+    - Connect to a user-specified S3 bucket, or to a prefix of it
+      ('bucket/prefix').
+    - List files within the bucket, with menus usable while the listing runs.
+    - Filter files by pattern (regex, prefix, extension or glob); filters
+      chain onto the current result and are answered from an index.
     - Display file count by extension.
-    - Interactive selection of files for download.
-    - Download selected files to a specified directory.
+    - Cache bucket listings on disk and refresh them incrementally.
+    - Interactive selection of files for download, paged over the whole
+      result with incremental search and select-all-matching.
+    - Download selected files to a specified directory, several at a time;
+      large downloads resume where they stopped.
     - Interactive menu to change buckets or exit the tool.
+    - Batch mode for cron and CI with a JSON summary of the run.
 
 Options:
     -h, --help      Show this help message.
+    -w, --workers N Number of files downloaded concurrently (default: 10).
+    --parallel-listing
+                    List the bucket in shards, one per top-level prefix,
+                    at the same time instead of page after page.
+    --list-workers N
+                    Number of shards listed concurrently (default: 16).
+    --shard-depth N Prefix levels to split into shards (default: 1).
+    --no-cache      Do not read or write the on-disk listing cache.
+    --cache-dir DIR Directory of the listing cache (default: ~/.cache/s3fetch).
+    --cache-ttl SECONDS
+                    Age after which a cached listing is refreshed in the
+                    background (default: 3600).
+    --cache-max-listings N
+                    Number of bucket listings kept in the cache (default: 20).
+    --max-keys N    Keep at most N listed files in memory. Counts and the
+                    extension table still cover the whole bucket.
+    --resume-threshold MB
+                    Download objects of at least MB MiB in byte ranges that
+                    survive interruptions; rerunning the download fetches
+                    only the missing ranges (default: 64).
+    --max-concurrency N
+                    Part requests per file in multipart downloads (default: 10).
+    --multipart-threshold MB
+                    Objects of at least MB MiB are downloaded in parts;
+                    smaller ones with a single request (default: 8).
+    --multipart-chunksize MB
+                    Part size of multipart downloads (default: 8).
+    --max-pool-connections N
+                    HTTP connections kept to S3 (default: workers x
+                    max-concurrency).
+    --tcp-keepalive Enable TCP keepalive on S3 connections.
+    --connect-timeout SECONDS, --read-timeout SECONDS
+                    Socket timeouts of S3 requests (default: 60).
+    --auto-tune     Pick the part size, files and parts in flight and pool
+                    size for each download from the object sizes and the
+                    measured throughput. Options given explicitly are kept.
+    --no-throttle-control
+                    Use botocore's own retries instead of the adaptive
+                    per-prefix concurrency limit.
+    --max-attempts N
+                    Attempts per throttled or failed S3 request (default: 8).
+    --metrics FILE  At the end of the session, write request latency
+                    histograms, bytes, retries, throttled responses and the
+                    time of each phase to FILE ('-' for stderr).
+    --metrics-format {json,prometheus}
+                    Format of --metrics (default: json).
+    --profile PHASE Run one phase (identity, listing, filter, sync or
+                    download) under cProfile and write the statistics to
+                    s3fetch-PHASE.prof.
+    --sync          Only download files that are new or changed since the
+                    local copy was made (compared by size, date and ETag).
+    --identity-ttl SECONDS
+                    Seconds a verified AWS identity is reused while the
+                    credentials are unchanged; 0 always checks (default: 900).
+    --startup-check Measure the time to the first prompt, print it as JSON
+                    and exit with status 1 if it is over --startup-budget.
+    --startup-budget SECONDS
+                    Startup budget for --startup-check (default: 0.5).
+    --prefix PREFIX List and cache only the keys under PREFIX.
+    --inventory MANIFEST
+                    List the bucket from its S3 Inventory instead of
+                    list_objects_v2: a manifest.json, or the folder of the
+                    inventory configuration for its latest manifest, on S3
+                    (s3://bucket/path) or on disk. CSV inventories are
+                    read as is; ORC and Parquet ones need pyarrow.
+    --inventory-live-prefix PREFIX
+                    With --inventory, list the keys under PREFIX live, so
+                    changes made since the inventory are seen (repeatable).
+    --pattern PATTERN
+                    Filter applied to every listing (same syntax as the
+                    filter prompt). A literal prefix in the pattern, as in
+                    '^logs/2024/10/.*\\.gz$', is listed on its own.
+    --batch         Run without prompts: download the files of --bucket
+                    matching --prefix and --pattern, then print a JSON
+                    summary (exit status 1 if any file failed).
+    --bucket BUCKET[/PREFIX]
+                    Bucket, and optionally prefix, of a batch run.
+    --dest DIR      Download directory of a batch run (default: ./BUCKET).
+    --dry-run       With --batch, list and compare but do not download.
+    --archive PATH  Stream the selected files into one archive at PATH
+                    instead of separate files; '-' writes it to stdout
+                    (with --batch). Nothing is staged on disk.
+    --archive-format FORMAT
+                    tar, tar.gz, tar.bz2, tar.xz or zip (default: from the
+                    extension of PATH, tar for stdout).
+    --verify        Check every downloaded file against its ETag and S3
+                    checksum while it is written; mismatching files are
+                    downloaded again (up to 3 attempts).
+    --verify-manifest FILE
+                    Where --verify writes its results (default:
+                    DIR/.s3fetch-verify.json).
+    --dedup MODE    How selected files with the same ETag and size are
+                    created from the one downloaded: auto (reflink, else
+                    copy), reflink, hardlink, copy, or off to download
+                    each of them (default: auto).
     """
 
-    if '-h' in sys.argv or '--help' in sys.argv:
+    args = parse_args()
+    if args.help:
         print(help_message)
         sys.exit(0)
+    if args.batch:
+        sys.exit(run_batch(args))
+    if args.archive == '-':
+        console.print("[red]--archive - writes to stdout and needs --batch.[/red]")
+        sys.exit(2)
+    if args.verify and args.archive:
+        console.print("[yellow]--verify checks downloaded files and is ignored with --archive.[/yellow]")
+    if args.startup_check:
+        console.file = sys.stderr
+
+    # Created once, so a session restarted after Ctrl+C keeps counting into
+    # the same metrics and they are exported once at exit.
+    metrics = create_session_metrics(args)
+    while True:
+        try:
+            explore_buckets(args, metrics)
+            return
+        except KeyboardInterrupt:
+            console.print()
+            exit_choice = questionary.confirm("Do you want to exit the tool?").ask()
+            if exit_choice:
+                console.print("\n[cyan]Exiting the tool. Goodbye![/cyan]")
+                sys.exit(0)
 
+def explore_buckets(args, metrics):
+    """
+    Runs an interactive session from the banner and the credentials check
+    on; main starts it again when the user interrupts it and stays.
+    """
     ascii_art = r"""
  __ _____   ___    _       _
 / _\___ /  / __\__| |_ ___| |__
@@ -230,16 +4188,19 @@ https://github.com/david-valen
     console.print(f"[cyan bold]{title}[/cyan bold]")
     console.print(f"[cyan bold]{decor}[/cyan bold]")
 
+    identity_cache = create_identity_cache(args)
+    identity_started = time.perf_counter()
     while True:
-        credentials_valid = check_aws_credentials()
-        if not credentials_valid:
+        with metrics.phase('identity'):
+            identity = check_aws_credentials(identity_cache)
+        if not identity:
             configure_choice = questionary.select(
                 "AWS credentials are not configured or invalid. What would you like to do?",
                 choices=[
-                    Choice('Configure AWS credentials', value='configure'),
-                    Choice('Exit', value='exit')
+                    questionary.Choice('Configure AWS credentials', value='configure'),
+                    questionary.Choice('Exit', value='exit')
                 ],
-                style=custom_style
+                style=prompt_style()
             ).ask()
             if configure_choice == 'configure':
                 configure_aws_credentials()
@@ -248,10 +4209,41 @@ https://github.com/david-valen
                 sys.exit(0)
         else:
             break
+    account_id = identity.get('Account', '')
+    identity_seconds = time.perf_counter() - identity_started
+
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = ListingCache(
+                os.path.join(args.cache_dir, 'listings.sqlite3'), args.cache_ttl, args.cache_max_listings
+            )
+        except (OSError, sqlite3.Error) as e:
+            console.print(f"[yellow]The listing cache is not available: {e}[/yellow]")
+
+    sync_state = None
+    if args.sync:
+        try:
+            sync_state = SyncState(os.path.join(args.cache_dir, 'sync.sqlite3'))
+        except (OSError, sqlite3.Error) as e:
+            console.print(f"[yellow]The sync state is not available; comparing files by size and date only: {e}[/yellow]")
+    transfer_settings = TransferSettings.from_args(args)
+    controller = create_throttle_controller(args, transfer_settings)
+    clients = S3ClientCache(transfer_settings, args.list_workers, controller, metrics)
 
-    files = []
+    catalog = ObjectCatalog()
+    files = catalog.keys
+    key_index = None
+    refresh = None
+    stream = None
     bucket_name = None
-    bucket_history = InMemoryHistory()
+    bucket_prefix = ''
+    bucket_history = prompt_toolkit_history.InMemoryHistory()
+    if args.startup_check:
+        sys.exit(report_startup(args.startup_budget, identity_seconds))
+    # With a cached identity boto3 is not loaded yet; import it while the
+    # user types the bucket name.
+    preload_modules('boto3', 'botocore.config', 'boto3.s3.transfer')
     try:
         while True:
             if not bucket_name:
@@ -261,19 +4253,22 @@ https://github.com/david-valen
                 console.print(f"[cyan bold]{title}[/cyan bold]")
                 console.print(f"[cyan bold]{decor}[/cyan bold]")
                 try:
-                    bucket_name = questionary.text(
-                        "Enter the bucket name:",
+                    bucket_entry = questionary.text(
+                        "Enter the bucket name (or bucket/prefix):",
                         history=bucket_history,
-                        style=custom_style
+                        style=prompt_style()
                     ).ask()
-                    if bucket_name:
+                    bucket_name = None
+                    if bucket_entry:
+                        bucket_name, bucket_prefix = parse_bucket_entry(bucket_entry)
+                        bucket_prefix = listing_prefix(bucket_prefix or args.prefix, args.pattern)
                         if not validate_bucket_name(bucket_name):
                             console.print("[red]Invalid bucket name. Please enter a valid S3 bucket name.[/red]")
                             bucket_name = None
                             input("\nPress Enter to continue...")
                             continue
-                        if bucket_name not in bucket_history.get_strings():
-                            bucket_history.append_string(bucket_name)
+                        if bucket_entry not in bucket_history.get_strings():
+                            bucket_history.append_string(bucket_entry)
                     else:
                         console.print()
                         exit_choice = questionary.confirm("Do you want to exit the tool?").ask()
@@ -291,10 +4286,8 @@ https://github.com/david-valen
                     else:
                         continue
 
-                s3 = boto3.client('s3')
-
                 try:
-                    s3.head_bucket(Bucket=bucket_name)
+                    s3 = clients.head_bucket(bucket_name)
                 except ClientError as e:
                     error_code = e.response['Error']['Code']
                     status_code = e.response['ResponseMetadata']['HTTPStatusCode']
@@ -308,23 +4301,25 @@ https://github.com/david-valen
                     input("\nPress Enter to continue...")
                     continue
 
-                files = []
-
-                paginator = s3.get_paginator('list_objects_v2')
                 try:
-                    console.print("\n[green]Listing files in the bucket...[/green]")
-                    pages = paginator.paginate(Bucket=bucket_name)
-
-                    with alive_bar(bar='bubbles') as bar:
-                        for page in pages:
-                            if 'Contents' in page:
-                                files_in_page = [obj['Key'] for obj in page['Contents'] if not obj['Key'].endswith('/')]
-                                files.extend(files_in_page)
-                            bar()
-                    if not files:
-                        console.print(
-                            f"[red]The bucket '{bucket_name}' contains no files.[/red]"
+                    if bucket_prefix:
+                        console.print(f"\n[green]Listing files under s3://{bucket_name}/{bucket_prefix}...[/green]")
+                    else:
+                        console.print("\n[green]Listing files in the bucket...[/green]")
+                    with metrics.phase('listing'):
+                        catalog, refresh, stream = open_listing(
+                            s3, bucket_name, args, cache, account_id, bucket_prefix, clients
                         )
+                    files = catalog.keys
+                    if not files:
+                        if bucket_prefix:
+                            console.print(
+                                f"[red]The bucket '{bucket_name}' contains no files under '{bucket_prefix}'.[/red]"
+                            )
+                        else:
+                            console.print(
+                                f"[red]The bucket '{bucket_name}' contains no files.[/red]"
+                            )
                         bucket_name = None
                         input("\nPress Enter to continue...")
                         continue
@@ -341,29 +4336,95 @@ https://github.com/david-valen
                     input("\nPress Enter to continue...")
                     continue
 
-                console.print(
-                    f"\n[green]Total files found: {len(files)}[/green]"
-                )
-
-                extensions = [
-                    os.path.splitext(f)[1].lower() for f in files if os.path.splitext(f)[1]
-                ]
-
-                ext_counts = Counter(extensions)
-
-                sorted_ext_counts = sorted(
-                    ext_counts.items(), key=lambda x: x[1], reverse=True
-                )
-
-                table = Table(box=box.SIMPLE_HEAVY)
-                table.add_column("Extension", justify="left", style="cyan", no_wrap=True)
-                table.add_column("Count", justify="right", style="magenta")
-                for ext, count in sorted_ext_counts:
-                    table.add_row(ext, str(count))
+                if stream is None:
+                    console.print(
+                        f"\n[green]Total files found: {len(files)} "
+                        f"({format_size(catalog.total_size())})[/green]"
+                    )
+                    table = build_extension_table(catalog.extension_stats())
 
             current_files = files.copy()
+            current_positions = None
+            filter_applied = False
+            # The active filters (--pattern first) and the number of listed
+            # keys they have been applied to; while the listing streams in,
+            # they are applied to every key appended after that.
+            filter_chain = []
+            filtered_size = 0
+            if args.pattern:
+                with metrics.phase('filter'):
+                    if stream is None and (key_index is None or key_index.catalog is not catalog):
+                        key_index = KeyIndex(catalog)
+                    filtered_size = len(catalog)
+                    current_positions = filter_positions(
+                        catalog, key_index if stream is None else None, args.pattern, range(filtered_size)
+                    )
+                current_files = [files[p] for p in current_positions]
+                filter_applied = True
+                filter_chain = [args.pattern]
 
             while True:
+                refresh_message = None
+                if stream is not None:
+                    # The listing is still arriving: redraw the statistics
+                    # from what the stream has seen so far.
+                    table = build_extension_table(stream.extension_stats())
+                    if stream.is_alive():
+                        refresh_message = (
+                            f"[yellow]Listing in progress: {stream.total_objects} files "
+                            f"({format_size(stream.total_bytes)}) so far.[/yellow]"
+                        )
+                    else:
+                        if stream.error is not None:
+                            refresh_message = f"[red]The listing stopped early: {stream.error}[/red]"
+                        elif stream.truncated:
+                            refresh_message = (
+                                f"[yellow]The bucket holds {stream.total_objects} files; only the first "
+                                f"{len(files)} are kept in memory (--max-keys).[/yellow]"
+                            )
+                        else:
+                            refresh_message = (
+                                f"[green]Listing complete: {len(files)} files "
+                                f"({format_size(catalog.total_size())}).[/green]"
+                            )
+                        stream = None
+                    if filter_chain:
+                        listed_size = len(catalog)
+                        if listed_size > filtered_size:
+                            with metrics.phase('filter'):
+                                new_positions = filter_chain_positions(
+                                    catalog, None, filter_chain, range(filtered_size, listed_size)
+                                )
+                            current_positions.extend(new_positions)
+                            current_files.extend(files[p] for p in new_positions)
+                            filtered_size = listed_size
+                    elif not filter_applied:
+                        current_files = files.copy()
+                if refresh is not None and not refresh.is_alive():
+                    if refresh.error is not None:
+                        refresh_message = f"[red]The background listing refresh failed: {refresh.error}[/red]"
+                    else:
+                        if filter_applied:
+                            # Run the active filters on the refreshed listing,
+                            # so the keys it added are filtered in as well.
+                            with metrics.phase('filter'):
+                                key_index = KeyIndex(refresh.catalog)
+                                filtered_size = len(refresh.catalog)
+                                current_positions = filter_chain_positions(
+                                    refresh.catalog, key_index, filter_chain, range(filtered_size)
+                                )
+                            current_files = [refresh.catalog.keys[p] for p in current_positions]
+                        else:
+                            current_files = refresh.catalog.keys.copy()
+                        refresh_message = (
+                            f"[green]The listing was refreshed in the background: "
+                            f"{describe_listing_changes(catalog, refresh.catalog)}.[/green]"
+                        )
+                        catalog = refresh.catalog
+                        files = catalog.keys
+                        table = build_extension_table(catalog.extension_stats())
+                    refresh = None
+
                 clear_screen()
                 console.print(f"[bold green]{ascii_art}[/bold green]")
                 console.print(f"[cyan bold]{decor}[/cyan bold]")
@@ -371,21 +4432,29 @@ https://github.com/david-valen
                 console.print(f"[cyan bold]{decor}[/cyan bold]")
 
                 console.print(table)
+                if refresh_message:
+                    console.print(refresh_message)
 
                 console.print(
                     f"\n[green]Total current files: {len(current_files)}[/green]"
                 )
 
+                action_choices = [
+                    questionary.Choice('View all files', value='view_all'),
+                    questionary.Choice('Filter files', value='filter'),
+                    questionary.Choice('Refresh listing', value='refresh'),
+                    questionary.Choice('Change bucket', value='change'),
+                    questionary.Choice('Exit', value='exit')
+                ]
+                if filter_applied:
+                    action_choices.insert(2, questionary.Choice('Clear filters', value='clear'))
+                if stream is not None:
+                    action_choices.insert(2, questionary.Choice('Update listing progress', value='progress'))
                 try:
                     action_choice = questionary.select(
                         "What would you like to do?",
-                        choices=[
-                            Choice('View all files', value='view_all'),
-                            Choice('Filter files', value='filter'),
-                            Choice('Change bucket', value='change'),
-                            Choice('Exit', value='exit')
-                        ],
-                        style=custom_style
+                        choices=action_choices,
+                        style=prompt_style()
                     ).ask()
                 except KeyboardInterrupt:
                     console.print()
@@ -396,9 +4465,63 @@ https://github.com/david-valen
                     else:
                         continue
 
+                if action_choice == 'progress':
+                    continue
+                if action_choice == 'clear':
+                    current_files = files.copy()
+                    current_positions = None
+                    filter_applied = False
+                    filter_chain = []
+                    continue
                 if action_choice == 'change':
                     bucket_name = None
+                    refresh = None
+                    if stream is not None:
+                        stream.stop()
+                        stream = None
                     break
+                if action_choice == 'refresh':
+                    refresh_choice = questionary.select(
+                        "How do you want to refresh the listing?",
+                        choices=[
+                            questionary.Choice('New keys only (fast, for append-only buckets)', value='new'),
+                            questionary.Choice('Full re-listing', value='full'),
+                            questionary.Choice('Cancel', value='cancel')
+                        ],
+                        style=prompt_style()
+                    ).ask()
+                    if refresh_choice not in ('new', 'full'):
+                        continue
+                    if stream is not None:
+                        stream.stop()
+                        stream = None
+                    previous_catalog = catalog
+                    try:
+                        console.print("\n[green]Refreshing the listing...[/green]")
+                        with metrics.phase('listing'):
+                            if refresh_choice == 'new':
+                                catalog = list_new_objects(s3, bucket_name, previous_catalog, bucket_prefix)
+                            else:
+                                catalog = list_bucket(s3, bucket_name, args, bucket_prefix, clients=clients)
+                        if cache is not None and not args.inventory:
+                            cache.store(account_id, bucket_name, bucket_prefix, catalog)
+                    except (ClientError, InventoryError, OSError, sqlite3.Error) as e:
+                        console.print(f"[red]An error occurred while refreshing the listing: {e}[/red]")
+                        catalog = previous_catalog
+                        input("\nPress Enter to continue...")
+                        continue
+                    refresh = None
+                    console.print(
+                        f"[green]Listing refreshed: {describe_listing_changes(previous_catalog, catalog)}.[/green]"
+                    )
+                    input("\nPress Enter to continue...")
+                    files = catalog.keys
+                    table = build_extension_table(catalog.extension_stats())
+                    current_files = files.copy()
+                    current_positions = None
+                    filter_applied = False
+                    filter_chain = []
+                    continue
                 if action_choice == 'exit':
                     console.print("\n[cyan]Exiting the tool. Goodbye![/cyan]")
                     sys.exit(0)
@@ -412,17 +4535,30 @@ https://github.com/david-valen
                         console.print(f"[cyan bold]{title}[/cyan bold]")
                         console.print(f"[cyan bold]{decor}[/cyan bold]")
                         console.print(table)
+                        if filter_applied:
+                            console.print(
+                                f"[cyan]The filter narrows the current {len(current_files)} files. "
+                                f"Use 'Clear filters' to start over.[/cyan]"
+                            )
                         pattern = console.input(
                             "[yellow]Enter a search pattern "
-                            "(regex, e.g., '.*\\.txt$' for .txt files): [/yellow]"
+                            "(regex, e.g., '.*\\.txt$' for .txt files, or "
+                            "prefix:logs/, ext:txt, glob:*.txt): [/yellow]"
                         ).strip()
                         if not pattern:
                             console.print("[red]You must enter a valid pattern from the extension list.[/red]")
                             input("\nPress Enter to continue...")
                             continue
                         try:
-                            regex = re.compile(pattern)
-                            filtered_files = list(filter(regex.search, files))
+                            with metrics.phase('filter'):
+                                if stream is None and (key_index is None or key_index.catalog is not catalog):
+                                    key_index = KeyIndex(catalog)
+                                listed_size = len(catalog) if current_positions is None else filtered_size
+                                filtered_positions = filter_positions(
+                                    catalog, key_index if stream is None else None, pattern,
+                                    range(listed_size) if current_positions is None else current_positions
+                                )
+                            filtered_files = [files[p] for p in filtered_positions]
                             if not filtered_files:
                                 console.print(
                                     "[red]No files found matching the provided pattern.[/red]"
@@ -437,6 +4573,10 @@ https://github.com/david-valen
                                     break
                             else:
                                 current_files = filtered_files
+                                current_positions = filtered_positions
+                                filter_applied = True
+                                filter_chain.append(pattern)
+                                filtered_size = listed_size
                                 console.print(
                                     f"\n[green]Files found after filtering: "
                                     f"{len(current_files)}[/green]"
@@ -457,30 +4597,16 @@ https://github.com/david-valen
                         continue
 
                 while True:
-                    max_choices = 50
-                    display_files = current_files
-                    if len(display_files) > max_choices:
-                        console.print(
-                            f"[yellow]There are more than {max_choices} files to select. "
-                            f"Only the first {max_choices} files will be displayed.[/yellow]"
-                        )
-                        display_files = display_files[:max_choices]
-
                     clear_screen()
                     console.print(f"[bold green]{ascii_art}[/bold green]")
                     console.print(f"[cyan bold]{decor}[/cyan bold]")
                     console.print(f"[cyan bold]{title}[/cyan bold]")
                     console.print(f"[cyan bold]{decor}[/cyan bold]")
 
-                    console.print("\n[cyan]Select the files to download:[/cyan]")
-                    console.print("[yellow](Use arrow keys to navigate, <space> to select, enter to confirm. Press 'Ctrl+C' to exit)[/yellow]")
                     try:
-                        selected_files = questionary.checkbox(
-                            "Press space to select, enter to confirm",
-                            choices=display_files,
-                            instruction="(Use arrow keys to navigate, <space> to select, <a> to select all, <i> to invert selection)",
-                            style=custom_style
-                        ).ask()
+                        # The picker renders only the visible rows, so every
+                        # file of the current result can be selected.
+                        selected_files = FilePicker(current_files, catalog).run()
                     except KeyboardInterrupt:
                         console.print()
                         exit_choice = questionary.confirm("Do you want to exit the tool?").ask()
@@ -495,11 +4621,11 @@ https://github.com/david-valen
                         back_choice = questionary.select(
                             "No files selected. What would you like to do?",
                             choices=[
-                                Choice('Select files again', value='select'),
-                                Choice('Return to previous menu', value='menu'),
-                                Choice('Exit', value='exit')
+                                questionary.Choice('Select files again', value='select'),
+                                questionary.Choice('Return to previous menu', value='menu'),
+                                questionary.Choice('Exit', value='exit')
                             ],
-                            style=custom_style
+                            style=prompt_style()
                         ).ask()
                         if back_choice == 'select':
                             continue
@@ -512,73 +4638,132 @@ https://github.com/david-valen
                         break
 
                 if selected_files:
-                    save_choice = questionary.confirm(
-                        "Do you want to save the files to a specific directory?"
-                    ).ask()
-
-                    if save_choice:
-                        download_dir = questionary.path(
-                            "Enter the directory where you want to save the files:",
-                            only_directories=True,
-                            style=custom_style
+                    if args.archive:
+                        archive_path = questionary.path(
+                            "Enter the archive file to write:",
+                            default=args.archive,
+                            style=prompt_style()
+                        ).ask() or args.archive
+                        archive_path = os.path.abspath(archive_path)
+                        try:
+                            with metrics.phase('download'):
+                                download_s3, download_settings, _ = tune_download(
+                                    bucket_name, selected_files, catalog, args, transfer_settings, s3, clients
+                                )
+                                console.print(f"\n[green]Streaming the selected files into {archive_path}...[/green]")
+                                failures = write_archive(
+                                    download_s3, bucket_name, selected_files, catalog, archive_path,
+                                    args.archive_format, download_settings
+                                )
+                            if failures:
+                                console.print(
+                                    f"\n[red]{len(failures)} of {len(selected_files)} files could not be added "
+                                    f"to the archive.[/red]"
+                                )
+                            else:
+                                console.print(f"\n[green]Archive written: {archive_path}[/green]")
+                        except (ClientError, OSError) as e:
+                            console.print(f"\n[red]The archive could not be written: {e}[/red]")
+                        throttling_message = describe_throttling(controller)
+                        if throttling_message:
+                            console.print(f"[yellow]{throttling_message}[/yellow]")
+                    else:
+                        save_choice = questionary.confirm(
+                            "Do you want to save the files to a specific directory?"
                         ).ask()
-                        if not download_dir:
-                            console.print("[red]Invalid directory. Using default directory.[/red]")
-                            download_dir = os.path.abspath(bucket_name)
+
+                        if save_choice:
+                            download_dir = questionary.path(
+                                "Enter the directory where you want to save the files:",
+                                only_directories=True,
+                                style=prompt_style()
+                            ).ask()
+                            if not download_dir:
+                                console.print("[red]Invalid directory. Using default directory.[/red]")
+                                download_dir = os.path.abspath(bucket_name)
+                            else:
+                                download_dir = os.path.abspath(download_dir)
                         else:
-                            download_dir = os.path.abspath(download_dir)
-                    else:
-                        download_dir = os.path.abspath(bucket_name)
+                            download_dir = os.path.abspath(bucket_name)
 
-                    if not os.path.exists(download_dir):
-                        os.makedirs(download_dir, exist_ok=True)
+                        if not os.path.exists(download_dir):
+                            os.makedirs(download_dir, exist_ok=True)
 
-                    console.print("\n[green]Starting download of selected files...[/green]")
-                    for file_key in selected_files:
-                        local_path = os.path.normpath(os.path.join(download_dir, file_key))
-                        local_dir = os.path.dirname(local_path)
-                        if not os.path.exists(local_dir):
-                            os.makedirs(local_dir, exist_ok=True)
-                        try:
-                            s3.download_file(
-                                bucket_name,
-                                file_key,
-                                local_path,
-                                Callback=ProgressPercentage(s3, bucket_name, file_key)
+                        files_to_download = selected_files
+                        if args.sync:
+                            with metrics.phase('sync'):
+                                files_to_download, up_to_date = plan_sync(
+                                    bucket_name, selected_files, download_dir, catalog, sync_state
+                                )
+                            console.print(
+                                f"\n[green]{len(up_to_date)} of {len(selected_files)} files are already up to date; "
+                                f"{len(files_to_download)} to download.[/green]"
+                            )
+
+                        with metrics.phase('download'):
+                            download_s3, download_settings, _ = tune_download(
+                                bucket_name, files_to_download, catalog, args, transfer_settings, s3, clients
+                            )
+                            console.print("\n[green]Starting download of selected files...[/green]")
+                            manifest = create_verification_manifest(args, bucket_name, download_dir)
+                            failures = download_files(
+                                download_s3, bucket_name, files_to_download, download_dir, catalog, download_settings,
+                                args.resume_threshold * 1024 * 1024, manifest, args.dedup
                             )
-                        except Exception as e:
+                        if failures:
                             console.print(
-                                f"\n[red]Error downloading {file_key}: {e}[/red]"
+                                f"\n[red]{len(failures)} of {len(files_to_download)} files could not be downloaded.[/red]"
                             )
+                        if manifest is not None:
+                            try:
+                                manifest.write()
+                                console.print(f"[green]{describe_verification(manifest)}[/green]")
+                            except OSError as e:
+                                console.print(f"[red]The verification manifest could not be written: {e}[/red]")
+                        throttling_message = describe_throttling(controller)
+                        if throttling_message:
+                            console.print(f"[yellow]{throttling_message}[/yellow]")
+                        if args.sync:
+                            failed_keys = {file_key for file_key, _ in failures}
+                            try:
+                                with metrics.phase('sync'):
+                                    record_sync(
+                                        bucket_name, [k for k in files_to_download if k not in failed_keys],
+                                        download_dir, catalog, sync_state
+                                    )
+                            except (OSError, sqlite3.Error) as e:
+                                console.print(f"[red]The sync state could not be updated: {e}[/red]")
 
                     console.print()
                     repeat = questionary.select(
                         "What would you like to do now?",
                         choices=[
-                            Choice('Download more files', value='continue'),
-                            Choice('Change bucket', value='change'),
-                            Choice('Exit', value='exit')
+                            questionary.Choice('Download more files', value='continue'),
+                            questionary.Choice('Change bucket', value='change'),
+                            questionary.Choice('Exit', value='exit')
                         ],
-                        style=custom_style
+                        style=prompt_style()
                     ).ask()
 
                     if repeat == 'continue':
                         current_files = files.copy()
+                        current_positions = None
+                        filter_applied = False
+                        filter_chain = []
                         continue
                     elif repeat == 'change':
                         bucket_name = None
+                        refresh = None
+                        if stream is not None:
+                            stream.stop()
+                            stream = None
                         break
                     else:
                         console.print("\n[cyan]Exiting the tool. Goodbye![/cyan]")
                         sys.exit(0)
-    except KeyboardInterrupt:
-        console.print()
-        exit_choice = questionary.confirm("Do you want to exit the tool?").ask()
-        if exit_choice:
-            console.print("\n[cyan]Exiting the tool. Goodbye![/cyan]")
-            sys.exit(0)
-        else:
-            main()
+    finally:
+        if stream is not None:
+            stream.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,89 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+
+class FakeCatalog:
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def size_of(self, file_key):
+        return self.sizes[file_key]
+
+
+class FakeS3:
+    def __init__(self):
+        self.bytes_read = 0
+        self.get_calls = 0
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = Range[len('bytes='):].split('-')
+        data = b'x' * (int(end) - int(start) + 1)
+        self.get_calls += 1
+        self.bytes_read += len(data)
+        return {'Body': io.BytesIO(data)}
+
+
+class FakeClients:
+    def __init__(self):
+        self.s3 = FakeS3()
+        self.built = 0
+
+    def client_for(self, settings, region=None, probe=False):
+        self.built += 1
+        return self.s3
+
+
+def tune(sizes, clients):
+    return s3Fetch.auto_tune_settings(
+        'bucket', list(sizes), FakeCatalog(sizes), s3Fetch.TransferSettings(), region='us-east-1', clients=clients
+    )
+
+
+def test_small_selection_is_not_probed(monkeypatch):
+    monkeypatch.setattr(s3Fetch, '_probed_levels', {})
+    clients = FakeClients()
+    _, report = tune({f'k{i}': 1024 for i in range(100)}, clients)
+    assert report['probe'] == 'skipped'
+    assert report['requests_in_flight'] == 64
+    assert clients.built == 0
+
+
+def test_probe_is_capped_and_cached_per_region(monkeypatch):
+    monkeypatch.setattr(s3Fetch, '_probed_levels', {})
+    clients = FakeClients()
+    sizes = {f'k{i}': 100 * 1024 * 1024 for i in range(300)}
+    _, report = tune(sizes, clients)
+    assert report['probe'] == 'measured'
+    assert clients.s3.bytes_read <= s3Fetch.AUTO_TUNE_PROBE_MAX_BYTES
+    requests = clients.s3.get_calls
+
+    _, cached = tune(sizes, clients)
+    assert cached['probe'] == 'cached'
+    assert cached['requests_in_flight'] == report['requests_in_flight']
+    assert clients.s3.get_calls == requests
+    assert clients.built == 1
+
+
+def test_tuned_clients_are_reused_and_probes_keep_the_prefix_limit():
+    settings = s3Fetch.TransferSettings()
+    controller = s3Fetch.ThrottleController(settings.pool_size(4))
+    clients = s3Fetch.S3ClientCache(settings, 4, controller)
+    limit = controller.max_limit
+
+    probe_settings = settings.copy()
+    probe_settings.pool_connections = s3Fetch.AUTO_TUNE_LEVELS[-1]
+    probe = clients.client_for(probe_settings, 'us-east-1', probe=True)
+    assert clients.client_for(probe_settings, 'us-east-1', probe=True) is probe
+    assert controller.max_limit == limit
+
+    tuned_settings = settings.copy()
+    tuned_settings.pool_connections = limit + 10
+    tuned = clients.client_for(tuned_settings, 'us-east-1')
+    assert tuned is not probe
+    assert clients.client_for(tuned_settings, 'us-east-1') is tuned
+    assert controller.max_limit == limit + 10
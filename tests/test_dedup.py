@@ -0,0 +1,111 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+
+    def get_object(self, Bucket, Key):
+        self.gets.append(Key)
+        data = self.objects[Key]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+
+def make_catalog(objects, etags):
+    catalog = s3Fetch.ObjectCatalog()
+    for key in sorted(objects):
+        catalog.add(key, len(objects[key]), etags[key], 1727740800.0, 'STANDARD')
+    return catalog
+
+
+def test_group_duplicates():
+    rows = [
+        (10, 't2/a.json', 'e1'),
+        (10, 't1/a.json', 'e1'),
+        (10, 't3/a.json', 'e2'),
+        (9, 't4/a.json', 'e1'),
+        (5, 'x', ''),
+        (5, 'y', ''),
+        (1, 't5/a.json', 'e1'),
+        (1, 't6/a.json', 'e1'),
+    ]
+    unique_rows, duplicates = s3Fetch.group_duplicates(rows)
+    assert unique_rows == [
+        (10, 't2/a.json', 'e1'), (10, 't3/a.json', 'e2'), (9, 't4/a.json', 'e1'),
+        (5, 'x', ''), (5, 'y', ''), (1, 't5/a.json', 'e1'),
+    ]
+    assert duplicates == {'t2/a.json': ['t1/a.json'], 't5/a.json': ['t6/a.json']}
+
+
+def test_download_rows_are_largest_first():
+    objects = {'a': b'1', 'b': b'333', 'c': b'22'}
+    catalog = make_catalog(objects, {'a': 'e1', 'b': 'e2', 'c': 'e3'})
+    assert s3Fetch.download_rows(['a', 'b', 'c', 'gone'], catalog) == [
+        (3, 'b', 'e2'), (2, 'c', 'e3'), (1, 'a', 'e1'), (0, 'gone', ''),
+    ]
+
+
+@pytest.mark.parametrize('mode, allow_hardlink, methods', [
+    ('copy', True, {'copy'}),
+    ('hardlink', True, {'hardlink'}),
+    ('hardlink', False, {'copy'}),
+    # Reflinks fall back to a copy on file systems without them.
+    ('auto', True, {'reflink', 'copy'}),
+    ('reflink', True, {'reflink', 'copy'}),
+])
+def test_copy_duplicate(tmp_path, mode, allow_hardlink, methods):
+    source_path = str(tmp_path / 'source')
+    target_path = str(tmp_path / 'target')
+    with open(source_path, 'wb') as source_file:
+        source_file.write(b'same bytes')
+    with open(target_path, 'wb') as target_file:
+        target_file.write(b'old')
+    method = s3Fetch.copy_duplicate(source_path, target_path, mode, allow_hardlink)
+    assert open(target_path, 'rb').read() == b'same bytes'
+    assert method in methods
+    assert os.path.samefile(source_path, target_path) == (method == 'hardlink')
+    assert sorted(os.listdir(tmp_path)) == ['source', 'target']
+
+
+@pytest.mark.parametrize('dedup', ['auto', 'hardlink', 'copy'])
+def test_duplicates_are_fetched_once(tmp_path, dedup):
+    objects = {'t1/a.json': b'same!!!!', 't2/a.json': b'same!!!!', 't3/a.json': b'other!!!'}
+    catalog = make_catalog(objects, {'t1/a.json': 'e1', 't2/a.json': 'e1', 't3/a.json': 'e2'})
+    s3 = FakeS3(objects)
+    failures = s3Fetch.download_files(s3, 'bucket', list(objects), str(tmp_path), catalog, dedup=dedup)
+    assert failures == []
+    assert sorted(s3.gets) == ['t2/a.json', 't3/a.json']
+    for key, data in objects.items():
+        assert open(os.path.join(tmp_path, key), 'rb').read() == data
+
+
+def test_downloading_a_hardlinked_duplicate_again_keeps_the_other(tmp_path):
+    objects = {'t1/a.json': b'same!!!!', 't2/a.json': b'same!!!!'}
+    catalog = make_catalog(objects, {'t1/a.json': 'e1', 't2/a.json': 'e1'})
+    s3Fetch.download_files(FakeS3(objects), 'bucket', list(objects), str(tmp_path), catalog, dedup='hardlink')
+    first_path = os.path.join(tmp_path, 't1', 'a.json')
+    second_path = os.path.join(tmp_path, 't2', 'a.json')
+    assert os.path.samefile(first_path, second_path)
+
+    changed = {'t1/a.json': b'CHANGED!'}
+    catalog = make_catalog(changed, {'t1/a.json': 'e2'})
+    s3Fetch.download_files(FakeS3(changed), 'bucket', ['t1/a.json'], str(tmp_path), catalog, dedup='hardlink')
+    assert open(first_path, 'rb').read() == b'CHANGED!'
+    assert open(second_path, 'rb').read() == b'same!!!!'
+
+
+def test_dedup_off_fetches_every_key(tmp_path):
+    objects = {'t1/a.json': b'same!!!!', 't2/a.json': b'same!!!!'}
+    catalog = make_catalog(objects, {'t1/a.json': 'e1', 't2/a.json': 'e1'})
+    s3 = FakeS3(objects)
+    s3Fetch.download_files(s3, 'bucket', list(objects), str(tmp_path), catalog, dedup='off')
+    assert sorted(s3.gets) == ['t1/a.json', 't2/a.json']
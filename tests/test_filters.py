@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+KEYS = [
+    'Logs/2024/10/upper.GZ',
+    'a+b/c(d).txt',
+    'archive.tar.gz',
+    'data/0001.json',
+    'data/00012.json',
+    'data/0042/000005.json',
+    'data/x.y.json',
+    'data/xjson',
+    'line1\nline2.txt',
+    'logs/2024/10/a.gz',
+    'logs/2024/10/b.GZ',
+    'logs/2024/11/c.gz',
+    'logs/2024/110/d.gz',
+    'logs/20241/e.gz',
+    'logs/a.gz.bak',
+    'notes.TXT',
+    'readme',
+    'tmp/logs/2024/10/f.gz',
+]
+
+PATTERNS = [
+    # Anchored prefixes, with and without a trailing regex.
+    '^logs/2024/10/',
+    '^logs/2024/10/.*',
+    '^logs/2024/1[01]/',
+    '^logs/2024/10/.*\\.gz$',
+    '^data/0001\\.json$',
+    # Quantifiers after the literal prefix.
+    '^logs/2024/10?/',
+    '^logs/2024/1*',
+    '^data/0{3}1',
+    '^data/0{2,3}12',
+    '^data/\\d{4}\\.json$',
+    # Escapes.
+    '^a\\+b/c\\(d\\)',
+    '^data/x\\.y',
+    '^data/x.json$',
+    '\\.gz$',
+    '.*\\.gz$',
+    '^.*\\.gz$',
+    '\\\\.gz$',
+    '\\.GZ$',
+    # Alternation.
+    '^logs/|^data/',
+    '\\.gz$|\\.json$',
+    '^(logs|data)/',
+    # Inline flags.
+    '(?i)^logs/',
+    '(?i)\\.gz$',
+    '(?i)upper',
+    '(?m)^line2',
+    '(?s)line1.line2',
+    '(?i:LOGS)/2024',
+    # Literal text.
+    '2024',
+    'upper',
+    'line2',
+    # Filter forms.
+    'prefix:logs/2024/10/',
+    'prefix:a+b/',
+    'ext:gz',
+    'ext:.txt',
+    'ext:json',
+    'glob:logs/*/10/*.gz',
+    'glob:data/000?.json',
+    'glob:*.GZ',
+]
+
+
+def reference(pattern, positions):
+    regex, ignore_case = s3Fetch.filter_to_regex(pattern)
+    compiled = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+    return [position for position in positions if compiled.search(KEYS[position])]
+
+
+@pytest.fixture(scope='module')
+def index():
+    catalog = s3Fetch.ObjectCatalog()
+    for key in KEYS:
+        catalog.add(key, 1, '', 0.0, 'STANDARD')
+    key_index = s3Fetch.KeyIndex(catalog)
+    assert list(catalog) == sorted(KEYS)
+    return catalog, key_index
+
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_indexed_filter_matches_a_regex_scan(index, pattern):
+    catalog, key_index = index
+    expected = reference(pattern, range(len(KEYS)))
+    assert list(s3Fetch.filter_positions(catalog, key_index, pattern)) == expected
+    assert list(s3Fetch.filter_positions(catalog, None, pattern)) == expected
+
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_indexed_filter_of_a_result_set_matches_a_regex_scan(index, pattern):
+    catalog, key_index = index
+    positions = s3Fetch.array('I', range(1, len(KEYS), 2))
+    expected = reference(pattern, positions)
+    assert list(s3Fetch.filter_positions(catalog, key_index, pattern, positions)) == expected
+    assert list(s3Fetch.filter_positions(catalog, key_index, pattern, range(3, 12))) == reference(pattern, range(3, 12))
+
+
+@pytest.mark.parametrize('patterns', [
+    ['prefix:logs/', 'ext:gz'],
+    ['^logs/2024/', '10', '\\.gz$'],
+    ['(?i)\\.gz$', '^logs/2024/1[01]/'],
+    ['glob:data/*', '^data/0{2,3}', 'json'],
+    ['^logs/|^data/', 'prefix:data/', '(?s).*json$'],
+])
+def test_chained_filters_match_a_regex_scan(index, patterns):
+    catalog, key_index = index
+    expected = range(len(KEYS))
+    for pattern in patterns:
+        expected = reference(pattern, expected)
+    assert list(s3Fetch.filter_chain_positions(catalog, key_index, patterns)) == expected
+    assert list(s3Fetch.filter_chain_positions(catalog, None, patterns)) == expected
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('^logs/2024/', ('logs/2024/', True)),
+    ('^logs/2024/.*', ('logs/2024/', True)),
+    ('^logs/2024/.*\\.gz$', ('logs/2024/', False)),
+    ('^logs/20?', ('logs/2', False)),
+    ('^data/0{3}1', ('data/', False)),
+    ('^a\\+b/', ('a+b/', True)),
+    ('^data/\\d{4}', ('data/', False)),
+    ('^logs/|^data/', ('', False)),
+    ('logs/', ('', False)),
+])
+def test_regex_literal_prefix(pattern, expected):
+    assert s3Fetch.regex_literal_prefix(pattern) == expected
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('\\.gz$', ('.gz', True)),
+    ('.*\\.gz$', ('.gz', True)),
+    ('^.*\\.gz$', ('.gz', True)),
+    ('^logs/.*\\.gz$', ('.gz', False)),
+    ('\\\\.gz$', (None, False)),
+    ('\\.gz$|\\.json$', (None, False)),
+    ('\\.gz', (None, False)),
+])
+def test_regex_extension(pattern, expected):
+    assert s3Fetch.regex_extension(pattern) == expected
@@ -0,0 +1,153 @@
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+SCHEMA = 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag, StorageClass'
+
+
+def csv_gz(rows):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gz:
+        text = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+        csv.writer(text, quoting=csv.QUOTE_ALL).writerows(rows)
+        text.flush()
+        text.detach()
+    return buffer.getvalue()
+
+
+def manifest(files, destination='arn:aws:s3:::inventories'):
+    return json.dumps({
+        'sourceBucket': 'source',
+        'destinationBucket': destination,
+        'creationTimestamp': '1792198800000',
+        'fileFormat': 'CSV',
+        'fileSchema': SCHEMA,
+        'files': [{'key': key} for key in files],
+    }).encode()
+
+
+class FakeS3:
+    def __init__(self, region, objects=None):
+        self.region = region
+        self.objects = objects or {}
+        self.reads = []
+
+    def get_object(self, Bucket, Key):
+        self.reads.append((Bucket, Key))
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+
+class FakeClients:
+    def __init__(self, clients, bucket_regions):
+        self.clients = clients
+        self.bucket_regions = bucket_regions
+
+    def head_bucket(self, bucket_name):
+        return self.clients[self.bucket_regions[bucket_name]]
+
+
+def test_inventory_is_read_through_the_destination_bucket_region():
+    data = csv_gz([['source', 'logs/a.gz', 'v1', 'true', 'false', '10', '2024-10-01T00:00:00.000Z', 'e1', 'STANDARD']])
+    source_s3 = FakeS3('us-east-1')
+    west_s3 = FakeS3('us-west-2', {
+        ('inventories', 'source/cfg/2024-10-02T01-00Z/manifest.json'): manifest(['source/cfg/data/part0.csv.gz']),
+        ('inventories', 'source/cfg/data/part0.csv.gz'): data,
+    })
+    clients = FakeClients({'us-east-1': source_s3, 'us-west-2': west_s3}, {'inventories': 'us-west-2'})
+
+    inventory = s3Fetch.InventoryManifest(
+        source_s3, 's3://inventories/source/cfg/2024-10-02T01-00Z/manifest.json', clients
+    )
+    catalog = inventory.read(inventory.files[0])
+
+    assert list(catalog) == ['logs/a.gz']
+    assert source_s3.reads == []
+    assert len(west_s3.reads) == 2
+
+
+ROWS = [
+    ['source', 'logs/b.gz', 'v1', 'true', 'false', '20', '2024-10-01T12:34:56.500Z', 'e2', 'GLACIER'],
+    ['source', 'logs/a.gz', 'v1', 'true', 'false', '10', '2024-10-01T00:00:00.000Z', 'e1', 'STANDARD'],
+    ['source', 'odd/with+space%2Bplus%25.txt', 'v1', 'true', 'false', '7', '2024-10-01T00:00:00.000Z', 'e3', ''],
+    ['source', 'logs/old.gz', 'v0', 'false', 'false', '5', '2020-01-01T00:00:00.000Z', 'e4', 'STANDARD'],
+    ['source', 'logs/deleted.gz', 'v2', 'true', 'true', '', '2024-10-01T00:00:00.000Z', '', ''],
+    ['source', 'logs/folder/', 'v1', 'true', 'false', '0', '2024-10-01T00:00:00.000Z', 'e5', 'STANDARD'],
+]
+
+
+def read_rows(rows, prefix='', schema=SCHEMA):
+    s3 = FakeS3('us-east-1', {
+        ('inventories', 'source/cfg/2024-10-02T01-00Z/manifest.json'): manifest(['data.csv.gz']),
+        ('inventories', 'data.csv.gz'): csv_gz(rows),
+    })
+    inventory = s3Fetch.InventoryManifest(s3, 's3://inventories/source/cfg/2024-10-02T01-00Z/manifest.json')
+    inventory.schema = schema
+    return inventory.read('data.csv.gz', prefix)
+
+
+def test_csv_rows_become_catalog_rows():
+    catalog = read_rows(ROWS)
+    catalog.sort()
+    assert [catalog.row(position) for position in range(len(catalog))] == [
+        ('logs/a.gz', 10, 'e1', 1727740800.0, 'STANDARD'),
+        ('logs/b.gz', 20, 'e2', 1727786096.5, 'GLACIER'),
+        ('odd/with space+plus%.txt', 7, 'e3', 1727740800.0, 'STANDARD'),
+    ]
+
+
+def test_csv_rows_are_narrowed_to_the_prefix():
+    assert sorted(read_rows(ROWS, 'logs/')) == ['logs/a.gz', 'logs/b.gz']
+
+
+def test_csv_with_only_some_fields():
+    rows = [['source', 'a.txt', '3'], ['source', 'b.txt', '']]
+    catalog = read_rows(rows, schema='Bucket, Key, Size')
+    assert [catalog.row(position) for position in range(len(catalog))] == [
+        ('a.txt', 3, '', 0.0, 'STANDARD'),
+        ('b.txt', 0, '', 0.0, 'STANDARD'),
+    ]
+
+
+def test_csv_schema_without_a_key_is_an_error():
+    with pytest.raises(s3Fetch.InventoryError):
+        read_rows([['source', '3']], schema='Bucket, Size')
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-10-01T00:00:00.000Z', 1727740800.0),
+    ('2024-10-01T12:34:56.500Z', 1727786096.5),
+    ('2024-10-01T12:34:56Z', 1727786096.0),
+    ('', 0.0),
+])
+def test_inventory_timestamp(value, expected):
+    assert s3Fetch.inventory_timestamp(value) == expected
+
+
+def test_local_copy_uses_the_latest_dated_manifest(tmp_path):
+    config = tmp_path / 'source' / 'cfg'
+    for date, files in (('2024-10-01T01-00Z', []), ('2024-10-02T01-00Z', ['source/cfg/data/part0.csv.gz'])):
+        (config / date).mkdir(parents=True)
+        (config / date / 'manifest.json').write_bytes(manifest(files))
+    (config / 'data').mkdir()
+    (config / 'data' / 'part0.csv.gz').write_bytes(csv_gz(ROWS[:2]))
+
+    inventory = s3Fetch.InventoryManifest(None, str(config))
+    assert inventory.location == str(config / '2024-10-02T01-00Z' / 'manifest.json')
+    assert inventory.source_bucket == 'source'
+    assert sorted(inventory.read(inventory.files[0])) == ['logs/a.gz', 'logs/b.gz']
+
+
+def test_file_that_is_not_a_manifest_is_an_error(tmp_path):
+    path = tmp_path / 'manifest.json'
+    path.write_text('{"sourceBucket": "source"}')
+    with pytest.raises(s3Fetch.InventoryError):
+        s3Fetch.InventoryManifest(None, str(path))
@@ -0,0 +1,53 @@
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+
+class FakePaginator:
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket, Prefix='', StartAfter='', Delimiter=None):
+        self._client.list_calls += 1
+        keys = sorted(k for k in self._client.objects if k.startswith(Prefix) and k > StartAfter)
+        yield {'Contents': [
+            {
+                'Key': key,
+                'Size': self._client.objects[key],
+                'ETag': '"0123456789abcdef0123456789abcdef"',
+                'LastModified': datetime.datetime(2024, 10, 1, tzinfo=datetime.timezone.utc),
+                'StorageClass': 'STANDARD',
+            }
+            for key in keys
+        ]}
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.list_calls = 0
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return FakePaginator(self)
+
+
+def test_reopening_a_bucket_loads_it_from_the_cache(tmp_path):
+    args = s3Fetch.parse_args(['--cache-dir', str(tmp_path)])
+    cache = s3Fetch.ListingCache(str(tmp_path / 'listings.sqlite3'))
+    s3 = FakeS3({'logs/a.gz': 10, 'logs/b.gz': 20, 'readme.txt': 5})
+
+    catalog, refresh, stream = s3Fetch.open_listing(s3, 'bucket', args, cache, 'account')
+    assert stream is not None
+    stream.join()
+    assert stream.error is None
+
+    catalog, refresh, stream = s3Fetch.open_listing(s3, 'bucket', args, cache, 'account')
+    assert stream is None
+    assert refresh is None
+    assert list(catalog) == ['logs/a.gz', 'logs/b.gz', 'readme.txt']
+    assert s3.list_calls == 1
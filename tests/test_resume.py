@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import sys
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+DATA = bytes(range(256)) * 40
+PART_SIZE = 1024
+ETAG = '"0123456789abcdef0123456789abcdef"'
+
+
+class FakeS3:
+    def __init__(self, data=DATA, etag=ETAG, cancel_after=None, cancel_event=None):
+        self.data = data
+        self.etag = etag
+        self.ranges = []
+        self.cancel_after = cancel_after
+        self.cancel_event = cancel_event
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        if IfMatch is not None and IfMatch != self.etag:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        start, end = (int(value) for value in Range[len('bytes='):].split('-'))
+        with self.lock:
+            self.ranges.append((start, end + 1))
+            if self.cancel_after is not None and len(self.ranges) >= self.cancel_after:
+                self.cancel_event.set()
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+def download(s3, local_path, cancel_event=None, etag=ETAG):
+    return s3Fetch.ResumableDownload(
+        s3, 'bucket', 'key', len(DATA), etag, local_path, cancel_event
+    ).run(max_concurrency=1, part_size=PART_SIZE)
+
+
+@pytest.mark.parametrize('ranges, expected', [
+    ([], []),
+    ([[0, 10]], [[0, 10]]),
+    ([[10, 20], [0, 10]], [[0, 20]]),
+    ([[0, 10], [5, 15], [30, 40]], [[0, 15], [30, 40]]),
+    ([[0, 50], [10, 20]], [[0, 50]]),
+])
+def test_merge_ranges(ranges, expected):
+    assert s3Fetch.merge_ranges(ranges) == expected
+
+
+@pytest.mark.parametrize('done, size, expected', [
+    ([], 25, [(0, 10), (10, 20), (20, 25)]),
+    ([[0, 25]], 25, []),
+    ([[0, 10]], 25, [(10, 20), (20, 25)]),
+    ([[5, 12], [20, 22]], 25, [(0, 5), (12, 20), (22, 25)]),
+    ([[10, 20]], 40, [(0, 10), (20, 30), (30, 40)]),
+])
+def test_missing_ranges(done, size, expected):
+    assert s3Fetch.missing_ranges(done, size, 10) == expected
+
+
+def test_interrupted_download_resumes_with_the_missing_ranges(tmp_path):
+    local_path = str(tmp_path / 'key')
+    cancel_event = threading.Event()
+    first = FakeS3(cancel_after=3, cancel_event=cancel_event)
+    assert download(first, local_path, cancel_event) is False
+    assert not os.path.exists(local_path)
+    with open(local_path + s3Fetch.PARTIAL_SUFFIX + '.json') as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest['ranges'] == [[0, 3 * PART_SIZE]]
+
+    second = FakeS3()
+    assert download(second, local_path) is True
+    assert second.ranges == [(start, start + PART_SIZE) for start in range(3 * PART_SIZE, len(DATA), PART_SIZE)]
+    assert open(local_path, 'rb').read() == DATA
+    assert os.listdir(tmp_path) == ['key']
+
+
+def test_manifest_of_another_object_version_is_not_resumed(tmp_path):
+    local_path = str(tmp_path / 'key')
+    cancel_event = threading.Event()
+    download(FakeS3(cancel_after=2, cancel_event=cancel_event), local_path, cancel_event)
+
+    other_etag = '"fedcba9876543210fedcba9876543210"'
+    changed = bytes(reversed(DATA))
+    second = FakeS3(data=changed, etag=other_etag)
+    assert download(second, local_path, etag=other_etag) is True
+    assert len(second.ranges) == len(DATA) // PART_SIZE
+    assert open(local_path, 'rb').read() == changed
+
+
+def test_object_changed_since_the_listing_discards_the_partial_file(tmp_path):
+    local_path = str(tmp_path / 'key')
+    with pytest.raises(IOError, match='changed on S3'):
+        download(FakeS3(etag='"fedcba9876543210fedcba9876543210"'), local_path)
+    assert os.listdir(tmp_path) == []
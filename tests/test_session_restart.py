@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+
+class FakeConfirm:
+    def __init__(self, answer):
+        self.answer = answer
+
+    def ask(self):
+        return self.answer
+
+
+class FakeQuestionary:
+    def confirm(self, message):
+        return FakeConfirm(False)
+
+
+class FakeAtexit:
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, handler, *args):
+        self.handlers.append((handler, args))
+
+
+def test_restart_after_ctrl_c_keeps_the_session_metrics(monkeypatch, tmp_path):
+    metrics_path = str(tmp_path / 'metrics.json')
+    fake_atexit = FakeAtexit()
+    sessions = []
+
+    def explore_buckets(args, metrics):
+        sessions.append(metrics)
+        if len(sessions) == 1:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(sys, 'argv', ['s3Fetch.py', '--metrics', metrics_path])
+    monkeypatch.setattr(s3Fetch, 'atexit', fake_atexit)
+    monkeypatch.setattr(s3Fetch, 'questionary', FakeQuestionary())
+    monkeypatch.setattr(s3Fetch, 'explore_buckets', explore_buckets)
+    s3Fetch.main()
+
+    assert len(sessions) == 2
+    assert sessions[0] is sessions[1]
+    assert len(fake_atexit.handlers) == 1
+    assert fake_atexit.handlers[0][1][0] == metrics_path
@@ -0,0 +1,54 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+
+class BrokenBody(io.BytesIO):
+    def readinto(self, buffer):
+        if self.tell():
+            raise ConnectionResetError('connection reset')
+        return super().readinto(buffer[:4])
+
+
+class FakeS3:
+    def __init__(self, body):
+        self.body = body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': self.body, 'ContentLength': len(self.body.getvalue())}
+
+
+def test_download_replaces_the_file(tmp_path):
+    local_path = str(tmp_path / 'a.json')
+    with open(local_path, 'wb') as local_file:
+        local_file.write(b'old')
+    s3Fetch.download_small_object(FakeS3(io.BytesIO(b'new bytes')), 'bucket', 'a.json', local_path)
+    assert open(local_path, 'rb').read() == b'new bytes'
+    assert os.listdir(tmp_path) == ['a.json']
+
+
+def test_failed_download_keeps_the_existing_copy(tmp_path):
+    local_path = str(tmp_path / 'a.json')
+    with open(local_path, 'wb') as local_file:
+        local_file.write(b'good copy')
+    with pytest.raises(ConnectionResetError):
+        s3Fetch.download_small_object(FakeS3(BrokenBody(b'changed bytes')), 'bucket', 'a.json', local_path)
+    assert open(local_path, 'rb').read() == b'good copy'
+    assert os.listdir(tmp_path) == ['a.json']
+
+
+def test_download_does_not_write_through_a_hardlink(tmp_path):
+    first_path = str(tmp_path / 'a.json')
+    second_path = str(tmp_path / 'b.json')
+    with open(first_path, 'wb') as local_file:
+        local_file.write(b'same')
+    os.link(first_path, second_path)
+    s3Fetch.download_small_object(FakeS3(io.BytesIO(b'CHANGED!')), 'bucket', 'a.json', first_path)
+    assert open(first_path, 'rb').read() == b'CHANGED!'
+    assert open(second_path, 'rb').read() == b'same'
@@ -0,0 +1,103 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+LAST_MODIFIED = 1727740800.0
+
+
+def make_catalog(objects):
+    catalog = s3Fetch.ObjectCatalog()
+    for key, (size, etag) in sorted(objects.items()):
+        catalog.add(key, size, etag, LAST_MODIFIED, 'STANDARD')
+    return catalog
+
+
+def write(download_dir, key, data, mtime=LAST_MODIFIED):
+    path = s3Fetch.local_file_path(download_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as local_file:
+        local_file.write(data)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def download_dir(tmp_path):
+    return str(tmp_path / 'bucket')
+
+
+@pytest.fixture
+def sync_state(tmp_path):
+    return s3Fetch.SyncState(str(tmp_path / 'cache' / 'sync.sqlite3'))
+
+
+def test_unknown_files_are_compared_with_size_and_last_modified(download_dir):
+    catalog = make_catalog({
+        'same.txt': (3, 'e1'),
+        'dir/same.txt': (3, 'e2'),
+        'older.txt': (3, 'e3'),
+        'resized.txt': (4, 'e4'),
+        'missing.txt': (3, 'e5'),
+    })
+    write(download_dir, 'same.txt', b'abc')
+    write(download_dir, 'dir/same.txt', b'abc', LAST_MODIFIED + 0.5)
+    write(download_dir, 'older.txt', b'abc', LAST_MODIFIED - 60)
+    write(download_dir, 'resized.txt', b'abc')
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', list(catalog), download_dir, catalog, None)
+    assert sorted(up_to_date) == ['dir/same.txt', 'same.txt']
+    assert sorted(to_download) == ['missing.txt', 'older.txt', 'resized.txt']
+
+
+def test_recorded_files_are_up_to_date(download_dir, sync_state):
+    catalog = make_catalog({'a.txt': (3, 'e1'), 'b/c.txt': (2, 'e2')})
+    write(download_dir, 'a.txt', b'abc', 0)
+    write(download_dir, 'b/c.txt', b'bc', 0)
+    s3Fetch.record_sync('bucket', list(catalog), download_dir, catalog, sync_state)
+    assert os.stat(os.path.join(download_dir, 'a.txt')).st_mtime == LAST_MODIFIED
+
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', list(catalog), download_dir, catalog, sync_state)
+    assert to_download == []
+    assert sorted(up_to_date) == ['a.txt', 'b/c.txt']
+
+
+def test_changed_object_is_downloaded_again(download_dir, sync_state):
+    catalog = make_catalog({'a.txt': (3, 'e1')})
+    write(download_dir, 'a.txt', b'abc')
+    s3Fetch.record_sync('bucket', ['a.txt'], download_dir, catalog, sync_state)
+
+    # Same size and LastModified, new ETag: only the recorded version tells.
+    changed = make_catalog({'a.txt': (3, 'e2')})
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', ['a.txt'], download_dir, changed, sync_state)
+    assert (to_download, up_to_date) == (['a.txt'], [])
+
+
+def test_locally_modified_file_is_downloaded_again(download_dir, sync_state):
+    catalog = make_catalog({'a.txt': (3, 'e1')})
+    path = write(download_dir, 'a.txt', b'abc')
+    s3Fetch.record_sync('bucket', ['a.txt'], download_dir, catalog, sync_state)
+    write(download_dir, 'a.txt', b'xyz', LAST_MODIFIED + 0.25)
+    assert os.path.getsize(path) == 3
+
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', ['a.txt'], download_dir, catalog, sync_state)
+    assert (to_download, up_to_date) == (['a.txt'], [])
+
+
+def test_file_synced_from_another_bucket_is_downloaded_again(download_dir, sync_state):
+    catalog = make_catalog({'a.txt': (3, 'e1')})
+    write(download_dir, 'a.txt', b'abc')
+    s3Fetch.record_sync('other-bucket', ['a.txt'], download_dir, catalog, sync_state)
+
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', ['a.txt'], download_dir, catalog, sync_state)
+    assert (to_download, up_to_date) == (['a.txt'], [])
+
+
+def test_key_missing_from_the_listing_is_downloaded(download_dir):
+    catalog = make_catalog({'a.txt': (3, 'e1')})
+    write(download_dir, 'gone.txt', b'abc')
+    to_download, up_to_date = s3Fetch.plan_sync('bucket', ['gone.txt'], download_dir, catalog, None)
+    assert (to_download, up_to_date) == (['gone.txt'], [])
@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import os
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3Fetch
+
+DATA = bytes(range(256)) * 100 + b'tail'
+PART_SIZE = 8192
+
+
+def parts(data, part_size):
+    return [data[start:start + part_size] for start in range(0, len(data), part_size)]
+
+
+def multipart_etag(data, part_size):
+    digests = [hashlib.md5(part).digest() for part in parts(data, part_size)]
+    return f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"'
+
+
+def crc32(data):
+    return zlib.crc32(data).to_bytes(4, 'big')
+
+
+def composite_crc32(data, part_size):
+    digests = [crc32(part) for part in parts(data, part_size)]
+    return f'{base64.b64encode(crc32(b"".join(digests))).decode()}-{len(digests)}'
+
+
+class FakeS3:
+    def __init__(self, part_length):
+        self.part_length = part_length
+        self.heads = []
+
+    def head_object(self, Bucket, Key, PartNumber, IfMatch):
+        self.heads.append((PartNumber, IfMatch))
+        return {'ContentLength': self.part_length}
+
+
+def feed(verifier, data, chunk_size, order=None):
+    chunks = [(start, data[start:start + chunk_size]) for start in range(0, len(data), chunk_size)]
+    for index in (order or range(len(chunks))):
+        verifier.update(*chunks[index])
+    return verifier.finish()
+
+
+def verifier(response, etag, part_length=PART_SIZE, data=DATA, read_back=None):
+    return s3Fetch.object_verifier(
+        FakeS3(part_length), 'bucket', 'key', len(data), etag, response, read_back
+    )
+
+
+def test_single_part_etag():
+    etag = '"' + hashlib.md5(DATA).hexdigest() + '"'
+    record = feed(verifier({}, etag), DATA, 1000)
+    assert record['status'] == 'verified'
+    assert record['checks'] == {'etag': 'ok'}
+
+
+def test_multipart_etag_from_out_of_order_ranges():
+    etag = multipart_etag(DATA, PART_SIZE)
+    # Ranges that do not line up with the upload parts, fed backwards.
+    chunks = -(-len(DATA) // 3000)
+    record = feed(verifier({}, etag), DATA, 3000, reversed(range(chunks)))
+    assert record['status'] == 'verified'
+    assert record['checks'] == {'etag': 'ok'}
+
+
+def test_multipart_etag_mismatch():
+    etag = multipart_etag(DATA, PART_SIZE)
+    corrupted = DATA[:9000] + b'X' + DATA[9001:]
+    record = feed(verifier({}, etag), corrupted, 4096)
+    assert record['status'] == 'mismatch'
+    assert str(s3Fetch.VerificationError(record)) == "key: downloaded bytes do not match the object's etag"
+
+
+def test_multipart_etag_with_unequal_parts_is_skipped():
+    etag = multipart_etag(DATA, PART_SIZE)
+    # Part 1 is smaller than the part count of the ETag allows.
+    record = feed(verifier({}, etag, part_length=4096), DATA, 4096)
+    assert record['status'] == 'unverified'
+    assert record['checks']['etag'].startswith('skipped')
+
+
+def test_full_object_checksum():
+    response = {'ChecksumCRC32': base64.b64encode(crc32(DATA)).decode(), 'ChecksumType': 'FULL_OBJECT'}
+    etag = '"' + hashlib.md5(DATA).hexdigest() + '"'
+    record = feed(verifier(response, etag), DATA, 5000)
+    assert record['checks'] == {'etag': 'ok', 'checksum_crc32': 'ok'}
+
+
+def test_composite_checksum():
+    response = {'ChecksumCRC32': composite_crc32(DATA, PART_SIZE), 'ChecksumType': 'COMPOSITE'}
+    record = feed(verifier(response, multipart_etag(DATA, PART_SIZE)), DATA, 2500)
+    assert record['status'] == 'verified'
+    assert record['checks'] == {'etag': 'ok', 'checksum_crc32': 'ok'}
+
+
+def test_composite_checksum_mismatch():
+    response = {'ChecksumCRC32': composite_crc32(DATA, PART_SIZE), 'ChecksumType': 'COMPOSITE'}
+    corrupted = DATA[:-1] + b'X'
+    record = feed(verifier(response, multipart_etag(DATA, PART_SIZE)), corrupted, 2500)
+    assert record['checks'] == {'etag': 'mismatch', 'checksum_crc32': 'mismatch'}
+
+
+def test_composite_checksum_of_a_kms_object():
+    # The ETag of a KMS-encrypted object is not an MD5, but the composite
+    # checksum still needs the part size.
+    response = {
+        'ChecksumCRC32': composite_crc32(DATA, PART_SIZE),
+        'ChecksumType': 'COMPOSITE',
+        'ServerSideEncryption': 'aws:kms',
+    }
+    record = feed(verifier(response, '"0123456789abcdef0123456789abcdef-4"'), DATA, 3000)
+    assert record['status'] == 'verified'
+    assert record['checks']['etag'].startswith('skipped')
+    assert record['checks']['checksum_crc32'] == 'ok'
+
+
+def test_kms_object_without_checksum_is_unverified():
+    record = feed(verifier({'ServerSideEncryption': 'aws:kms'}, '"0123"'), DATA, 3000)
+    assert record['status'] == 'unverified'
+
+
+def test_ranges_from_an_earlier_run_are_read_back():
+    etag = multipart_etag(DATA, PART_SIZE)
+    object_verifier = verifier({}, etag, read_back=lambda start, end: DATA[start:end])
+    object_verifier.skip(0, 10000)
+    object_verifier.update(20000, DATA[20000:])
+    object_verifier.update(10000, DATA[10000:20000])
+    assert object_verifier.finish()['status'] == 'verified'
+
+
+def test_missing_bytes_are_an_error():
+    object_verifier = verifier({}, '"' + hashlib.md5(DATA).hexdigest() + '"')
+    object_verifier.update(0, DATA[:100])
+    with pytest.raises(IOError):
+        object_verifier.finish()